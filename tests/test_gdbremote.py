@@ -0,0 +1,228 @@
+# Volatility
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+
+""" Tests of the gdb remote protocol client against a fake stub.
+
+The stub runs in a thread on one end of a socketpair, the RSPConnection
+under test on the other. Run with
+
+    python -m unittest discover -s tests
+"""
+
+import binascii
+import os
+import socket
+import struct
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import volatility.plugins.addrspaces.gdbremote as gdbremote
+
+def checksum(payload):
+    return sum(ord(c) for c in payload) & 0xff
+
+class FakeStub(object):
+    """ Serves memory and registers over the remote protocol.
+
+    packets records the payload of every packet received, acks every
+    acknowledgement character. corrupt is the number of replies whose
+    checksum is broken before they are sent correctly.
+    """
+    def __init__(self, sock, memory = '', packet_size = 0x1000, noack = True, registers = '', corrupt = 0):
+        self.sock = sock
+        self.memory = memory
+        self.packet_size = packet_size
+        self.noack = noack
+        self.registers = registers
+        self.corrupt = corrupt
+        self.ack_mode = True
+        self.packets = []
+        self.acks = []
+        self.bad_checksums = 0
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def reply(self, payload):
+        if self.ack_mode and self.corrupt:
+            self.corrupt -= 1
+            self.sock.sendall("${0}#{1:02x}".format(payload, (checksum(payload) + 1) & 0xff))
+        self.sock.sendall("${0}#{1:02x}".format(payload, checksum(payload)))
+
+    def handle(self, payload):
+        if payload.startswith("qSupported"):
+            self.reply("PacketSize={0:x};QStartNoAckMode{1}".format(self.packet_size, "+" if self.noack else "-"))
+        elif payload == "QStartNoAckMode":
+            self.reply("OK")
+            self.ack_mode = False
+        elif payload.startswith("m"):
+            addr, length = [int(x, 16) for x in payload[1:].split(",")]
+            if addr + length > len(self.memory):
+                self.reply("E14")
+            else:
+                self.reply(binascii.hexlify(self.memory[addr:addr + length]))
+        elif payload == "g":
+            self.reply(binascii.hexlify(self.registers))
+        elif payload.startswith("qRcmd,"):
+            self.reply("OK")
+        elif payload == "D":
+            self.reply("OK")
+        else:
+            self.reply("")
+
+    def run(self):
+        buf = ''
+        while True:
+            data = self.sock.recv(0x10000)
+            if not data:
+                return
+            buf += data
+            while buf:
+                if buf[0] in "+-":
+                    self.acks.append(buf[0])
+                    buf = buf[1:]
+                    continue
+                end = buf.find("#")
+                if end < 0 or len(buf) < end + 3:
+                    break
+                payload = buf[1:end]
+                if int(buf[end + 1:end + 3], 16) != checksum(payload):
+                    self.bad_checksums += 1
+                buf = buf[end + 3:]
+                self.packets.append(payload)
+                if self.ack_mode:
+                    self.sock.sendall("+")
+                self.handle(payload)
+
+def sync(conn):
+    """Makes sure the stub has seen everything sent before (acks included)"""
+    conn.request("qRcmd,")
+
+def connect(**kwargs):
+    ours, theirs = socket.socketpair()
+    stub = FakeStub(theirs, **kwargs)
+    return gdbremote.RSPConnection(sock = ours), stub
+
+class FakeProfile(object):
+    def __init__(self, memory_model):
+        self.metadata = dict(memory_model = memory_model)
+
+def remote_space(conn, memory_model = '32bit'):
+    """Builds a GdbRemoteAddressSpace over conn, without a gdb:// location"""
+    space = gdbremote.GdbRemoteAddressSpace.__new__(gdbremote.GdbRemoteAddressSpace)
+    space.conn = conn
+    space.profile = FakeProfile(memory_model)
+    space.size = 0xffffffff
+    return space
+
+class EscapeTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = "a#b$c}d*e" + ''.join(chr(i) for i in range(256))
+        escaped = gdbremote.RSPConnection.escape(data)
+        for c in "#$*":
+            self.assertEqual(escaped.count(c), 0)
+        self.assertEqual(gdbremote.RSPConnection.unescape(escaped), data)
+
+    def test_run_length(self):
+        # '0' then ord(' ') - 29 = 3 more of it
+        self.assertEqual(gdbremote.RSPConnection.unescape("a0* b"), "a0000b")
+
+    def test_plain(self):
+        self.assertEqual(gdbremote.RSPConnection.unescape("0123abcd"), "0123abcd")
+
+class ConnectionTest(unittest.TestCase):
+    def test_checksums(self):
+        conn, stub = connect()
+        conn.request("qRcmd," + binascii.hexlify("USE_PHYS_MEM"))
+        self.assertEqual(stub.bad_checksums, 0)
+        self.assertEqual(stub.packets[-1], "qRcmd," + binascii.hexlify("USE_PHYS_MEM"))
+
+    def test_no_ack(self):
+        conn, stub = connect(noack = True)
+        self.assertFalse(conn.ack_mode)
+        sync(conn)
+        acks = len(stub.acks)
+        conn.request("m0,1")
+        conn.request("m0,1")
+        sync(conn)
+        self.assertEqual(len(stub.acks), acks)
+
+    def test_ack_mode(self):
+        conn, stub = connect(noack = False, memory = "\x12\x34")
+        self.assertTrue(conn.ack_mode)
+        self.assertEqual(conn.request("m0,2"), "1234")
+        sync(conn)
+        # qSupported and m0,2
+        self.assertEqual(stub.acks[:2], ["+"] * 2)
+
+    def test_bad_checksum_is_retried(self):
+        conn, stub = connect(noack = False, memory = "\x56", corrupt = 1)
+        # The corrupt qSupported reply is refused and the good one taken
+        self.assertEqual(conn.packet_size, 0x1000)
+        self.assertEqual(conn.request("m0,1"), "56")
+        sync(conn)
+        self.assertEqual(stub.acks[:3], ["-", "+", "+"])
+
+    def test_packet_size(self):
+        conn, _stub = connect(packet_size = 0x200)
+        self.assertEqual(conn.packet_size, 0x200)
+
+class SpaceTest(unittest.TestCase):
+    def test_read_is_split(self):
+        memory = ''.join(chr(i & 0xff) for i in range(0x400))
+        conn, stub = connect(memory = memory, packet_size = 0x100)
+        space = remote_space(conn)
+        step = space.max_read
+        self.assertEqual(step, (0x100 - 0x10) / 2)
+
+        del stub.packets[:]
+        self.assertEqual(space.read(0x10, 0x200), memory[0x10:0x210])
+        sizes = [int(p.split(",")[1], 16) for p in stub.packets]
+        self.assertTrue(all(size <= step for size in sizes))
+        self.assertEqual(sum(sizes), 0x200)
+        self.assertEqual(len(sizes), (0x200 + step - 1) / step)
+
+    def test_failed_chunk(self):
+        conn, _stub = connect(memory = "\x00" * 0x100, packet_size = 0x100)
+        space = remote_space(conn)
+        self.assertEqual(space.read(0xf0, 0x80), None)
+        self.assertEqual(space.zread(0xf0, 0x80), "\x00" * 0x80)
+        # The stream stays in sync after a failed chunk
+        self.assertEqual(space.read(0, 0x10), "\x00" * 0x10)
+
+    def test_registers_i386(self):
+        values = range(1, 17)
+        conn, _stub = connect(registers = struct.pack("<16I", *values))
+        registers = remote_space(conn, '32bit').read_registers()
+        self.assertEqual(registers["eax"], 1)
+        self.assertEqual(registers["eip"], 9)
+        self.assertEqual(registers["gs"], 16)
+
+    def test_registers_amd64(self):
+        data = struct.pack("<17Q", *range(1, 18)) + struct.pack("<7I", *range(100, 107))
+        conn, _stub = connect(registers = data)
+        registers = remote_space(conn, '64bit').read_registers()
+        self.assertEqual(registers["rax"], 1)
+        self.assertEqual(registers["rip"], 17)
+        self.assertEqual(registers["eflags"], 100)
+        self.assertEqual(registers["gs"], 106)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#  -*- mode: python; -*-
+#
+# Volatility
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details. 
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA 
+#
+
+"""
+Measures the memory and creation time of volatility objects.
+
+Builds the members of _EPROCESS structs laid over a zero filled buffer
+and reports, for a native member, a pointer and an embedded struct,
+sys.getsizeof of the instance plus its __dict__ (if one was allocated),
+then the time it takes to create count members.
+
+    python tools/objbench.py [--profile WinXPSP2x86] [--count 100000]
+"""
+
+from optparse import OptionParser
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import volatility.conf as conf
+import volatility.registry as registry
+import volatility.commands as commands
+import volatility.addrspace as addrspace
+import volatility.obj as obj
+
+def object_size(o):
+    """Returns the bytes taken by an object and its __dict__, if it has one"""
+    size = sys.getsizeof(o)
+    try:
+        state = object.__getattribute__(o, '__dict__')
+    except AttributeError:
+        return size
+    if state:
+        size += sys.getsizeof(state)
+    return size
+
+def main():
+    parser = OptionParser(usage = "%prog [--profile PROFILE] [--count N]")
+    parser.add_option("--profile", default = "WinXPSP2x86",
+                      help = "Profile whose _EPROCESS is built")
+    parser.add_option("--count", type = "int", default = 100000,
+                      help = "Number of members to create")
+    (opts, _args) = parser.parse_args()
+
+    config = conf.ConfObject()
+    registry.PluginImporter()
+    registry.register_global_options(config, commands.Command)
+    registry.register_global_options(config, addrspace.BaseAddressSpace)
+    config.PROFILE = opts.profile
+
+    buf = addrspace.BufferAddressSpace(config, data = '\x00' * 0x10000)
+    eprocess = obj.Object("_EPROCESS", offset = 0, vm = buf)
+    size = eprocess.size()
+
+    print "{0} ({1} bytes), {2}".format(eprocess.obj_type, size, opts.profile)
+    for kind, member in [("native", "UniqueProcessId"),
+                         ("pointer", "Peb"),
+                         ("struct", "Pcb")]:
+        print "{0:8} {1:20} {2:5} bytes".format(kind, member, object_size(eprocess.m(member)))
+
+    members = eprocess.members.keys()
+    structs = (opts.count + len(members) - 1) / len(members)
+    start = time.time()
+    created = 0
+    for i in xrange(structs):
+        e = obj.Object("_EPROCESS", offset = (i * size) % (0x10000 - size), vm = buf)
+        for name in members:
+            e.m(name)
+            created += 1
+    elapsed = time.time() - start
+    print "{0} members of {1} structs in {2:.3f}s ({3:.2f}us each)".format(
+        created, structs, elapsed, elapsed * 1e6 / created)
+
+if __name__ == "__main__":
+    main()
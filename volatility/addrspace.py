@@ -32,6 +32,8 @@
 
 #pylint: disable-msg=C0111
 
+import collections
+import weakref
 import volatility.obj as obj
 import volatility.registry as registry
 import volatility.debug as debug
@@ -59,6 +61,56 @@ def check_valid_profile(option, _opt_str, value, parser):
             debug.error("Invalid profile " + value + " selected")
         setattr(parser.values, option.dest, value)
 
+def coalesce_ranges(requests, gap = 0):
+    """ Sorts (addr, length) requests and merges the ones that overlap or
+    lie within gap bytes of each other.
+
+    Returns a list of (start, length, members) where members are the
+    indexes of the requests covered by that merged range.
+    """
+    runs = []
+    for i in sorted(range(len(requests)), key = lambda i: requests[i][0]):
+        addr, length = requests[i]
+        if runs and addr <= runs[-1][1] + gap:
+            runs[-1][1] = max(runs[-1][1], addr + length)
+            runs[-1][2].append(i)
+        else:
+            runs.append([addr, addr + length, [i]])
+    return [(start, end - start, members) for start, end, members in runs]
+
+class StopCounter(object):
+    """ Counts how often a live target was resumed or stopped.
+
+    This is the generation every AS reading a live target reports, no
+    matter which backend it reads through, so anything cached from the
+    target (pages, translations, registers, decoded code) goes stale
+    together. It is bumped from gdb's cont and stop events and by the
+    commands which let the target run.
+    """
+    def __init__(self):
+        self.value = 0
+
+    def bump(self, *_args):
+        self.value += 1
+
+## The generation of all live targets
+target_stops = StopCounter()
+
+class ReadSession(object):
+    """ A context manager grouping a batch of reads on an address space.
+
+    Address spaces which have no per-batch setup cost hand out this
+    no-op session, so callers can always write:
+
+        with space.read_session():
+            ...
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        return False
+
 class BaseAddressSpace(object):
     """ This is the base class of all Address Spaces. """
     def __init__(self, base, config, *_args, **_kwargs):
@@ -124,14 +176,75 @@ class BaseAddressSpace(object):
         """ Read some data from a certain offset """
 
     def find(self, addr, length, pattern):
-        return addr + find_offset
+        """ Returns the address of the first match of pattern, or None """
+        ret = self.find_offset(addr, length, pattern)
+        if ret != None:
+            ret = ret + addr
+        return ret
 
     def find_offset(self, addr, length, pattern):
-        return self.read(addr, length).find(str(pattern), 0)
+        """ Returns the offset from addr of the first match of pattern, or None """
+        data = self.read(addr, length)
+        if not data:
+            return None
+        found = data.find(str(pattern), 0)
+        if found < 0:
+            return None
+        return found
 
     def zread(self, addr, length):
         """ Read data from a certain offset padded with \x00 where data is not available """
 
+    def read_many(self, requests):
+        """ Reads a batch of (addr, length) requests.
+
+            Returns a list with the data of each request, in request order,
+            holding None for the requests which could not be read.
+        """
+        return [self.read(addr, length) or None for addr, length in requests]
+
+    def _read_coalesced(self, requests, gap = 0):
+        """ read_many helper for address spaces where each read is costly.
+
+            Adjacent requests are merged so that every merged range is
+            fetched with a single read. If a merged read fails, its
+            requests are retried one by one.
+        """
+        results = [None] * len(requests)
+        for start, length, members in coalesce_ranges(requests, gap):
+            data = self.read(start, length)
+            for i in members:
+                addr, size = requests[i]
+                if data:
+                    chunk = data[addr - start:addr - start + size]
+                else:
+                    chunk = self.read(addr, size)
+                if chunk and len(chunk) == size:
+                    results[i] = chunk
+        return results
+
+    def read_session(self):
+        """ Returns a context manager for a batch of reads.
+
+            By default the session of the base AS is used, so a paged AS
+            stacked on a live target shares the target's session.
+        """
+        if self.base is not None:
+            return self.base.read_session()
+        return ReadSession()
+
+    def get_generation(self):
+        """ Returns a counter which changes whenever memory may have changed.
+
+            Static images never change, ASes reading a live target report
+            target_stops, which changes each time the target runs or
+            stops. Anything cached from memory (eg. translations) is only
+            valid for the generation it was read in.
+        """
+        if self.base is not None:
+            return self.base.get_generation()
+        return 0
+
     def get_available_addresses(self):
         """ Return a generator of address ranges as (offset, size) covered by this AS sorted by offset.
 
@@ -167,6 +280,47 @@ class AbstractVirtualAddressSpace(BaseAddressSpace):
     def vtop(self, vaddr):
         raise NotImplementedError("This is a virtual class and should not be referenced directly")
 
+class DTBSpaceRegistry(object):
+    """ Shares the paged address spaces built for a given DTB.
+
+    Building a paged AS reads the page directory and runs the profile's
+    validity check, which is wasteful when the same process is looked at
+    over and over. Spaces are kept by (class, base, dtb) with weak
+    references, plus strong references to the few most recently used
+    ones so they survive between commands. A space is rebuilt once the
+    generation of its base changes (eg. a live target was resumed).
+    """
+    def __init__(self, keep = 8):
+        self.spaces = weakref.WeakValueDictionary()
+        self.recent = collections.deque(maxlen = keep)
+
+    def get(self, kernel_space, dtb):
+        """ Returns an AS of the same kind as kernel_space for dtb.
+
+            Raises AssertionError (like the AS constructor) if no such
+            AS can be built.
+        """
+        base = kernel_space.base
+        key = (kernel_space.__class__, id(base), dtb)
+        generation = base.get_generation()
+
+        space = self.spaces.get(key)
+        if space is None or space.base is not base or space.dtb_generation != generation:
+            space = kernel_space.__class__(base, kernel_space.get_config(), dtb = dtb)
+            space.dtb_generation = generation
+            self.spaces[key] = space
+
+        if not self.recent or self.recent[-1] is not space:
+            self.recent.append(space)
+        return space
+
+    def clear(self):
+        self.spaces.clear()
+        self.recent.clear()
+
+## Process address spaces shared by all the profiles
+dtb_spaces = DTBSpaceRegistry()
+
 ## This is a specialised AS for use internally - Its used to provide
 ## transparent support for a string buffer so types can be
 ## instantiated off the buffer.
@@ -33,7 +33,7 @@ if __name__ == '__main__':
     sys.path.append("..")
 
 import cPickle as pickle # pickle implementation must match that in volatility.cache
-import struct, copy, operator
+import struct, copy, operator, types
 import volatility.debug as debug
 import volatility.fmtspec as fmtspec
 import volatility.exceptions as exceptions
@@ -44,6 +44,27 @@ import functools
 
 Curry = functools.partial
 
+def flat_curry(factory, **kwargs):
+    """ Curries factory with kwargs, merging nested Curry objects so
+    that instantiation goes through a single partial call.
+    """
+    if isinstance(factory, functools.partial):
+        keywords = dict(factory.keywords or {})
+        keywords.update(kwargs)
+        return Curry(factory.func, *factory.args, **keywords)
+    return Curry(factory, **kwargs)
+
+## Compiled struct.Struct objects keyed by format string, shared by all profiles
+struct_cache = {}
+
+def get_struct(format_string):
+    """ Returns the compiled struct.Struct for format_string """
+    try:
+        return struct_cache[format_string]
+    except KeyError:
+        result = struct_cache[format_string] = struct.Struct(format_string)
+        return result
+
 import traceback
 
 class classproperty(property):
@@ -181,7 +202,25 @@ def Object(theType, offset, vm, name = None, **kwargs):
     ## This is a serious error.
     debug.warning("Cant find object {0} in profile {1}?".format(theType, vm.profile))
 
+def slot_names(cls):
+    """ Returns the names of all the __slots__ of cls and its bases """
+    names = []
+    for klass in cls.__mro__:
+        for name, value in klass.__dict__.items():
+            if isinstance(value, types.MemberDescriptorType):
+                names.append(name)
+    return names
+
 class BaseObject(object):
+    """ The base of all objects.
+
+    The attributes every object carries live in __slots__. A __dict__ is
+    still available, but only allocated when something outside of the
+    slots is set (eg. by newattr or by subclasses), which keeps most
+    objects small. Objects can still be weakly referenced.
+    """
+    __slots__ = ('_vol_theType', '_vol_offset', '_vol_vm', '_vol_native_vm',
+                 '_vol_parent', '_vol_name', '__dict__', '__weakref__')
 
     # We have **kwargs here, but it's unclear if it's a good idea
     # Benefit is objects will never fail with duff parameters
@@ -349,8 +388,8 @@ class BaseObject(object):
             for arg in self.__init__.func_code.co_varnames:
                 if (arg not in result and
                     arg not in "self parent profile args".split()):
-                    result[arg] = self.__dict__[arg]
-        except KeyError:
+                    result[arg] = object.__getattribute__(self, arg)
+        except AttributeError:
             debug.post_mortem()
             raise pickle.PicklingError("Object {0} at 0x{1:08x} cannot be cached because of missing attribute {2}".format(self.obj_name, self.obj_offset, arg))
 
@@ -368,7 +407,12 @@ class BaseObject(object):
         ## needed because __setstate__ can not return a new object,
         ## but must update the current object instead. I'm sure ikelos
         ## will object!!! I am open to suggestions ...
-        self.__dict__ = new_object.__dict__
+        for name in slot_names(new_object.__class__):
+            try:
+                object.__setattr__(self, name, object.__getattribute__(new_object, name))
+            except AttributeError:
+                pass
+        object.__setattr__(self, '__dict__', new_object.__dict__)
 
 def CreateMixIn(mixin):
     def make_method(name):
@@ -397,6 +441,8 @@ def CreateMixIn(mixin):
 
 class NumericProxyMixIn(object):
     """ This MixIn implements the numeric protocol """
+    __slots__ = ()
+
     _specials = [
         ## Number protocols
         '__add__', '__sub__', '__mul__', '__floordiv__', '__mod__', '__divmod__',
@@ -418,28 +464,39 @@ class NumericProxyMixIn(object):
 CreateMixIn(NumericProxyMixIn)
 
 class NativeType(BaseObject, NumericProxyMixIn):
+    __slots__ = ('format_string',)
+
     def __init__(self, theType, offset, vm, format_string = None, **kwargs):
         BaseObject.__init__(self, theType, offset, vm, **kwargs)
         NumericProxyMixIn.__init__(self)
         self.format_string = format_string
 
+    @property
+    def obj_struct(self):
+        """ The compiled struct.Struct for our format string """
+        try:
+            return struct_cache[self.format_string]
+        except KeyError:
+            return get_struct(self.format_string)
+
     def write(self, data):
         """Writes the data back into the address space"""
-        output = struct.pack(self.format_string, data)
+        output = self.obj_struct.pack(data)
         return self.obj_vm.write(self.obj_offset, output)
 
     def proxied(self, attr):
         return self.v()
 
     def size(self):
-        return struct.calcsize(self.format_string)
+        return self.obj_struct.size
 
     def v(self):
-        data = self.obj_vm.read(self.obj_offset, self.size())
+        compiled = self.obj_struct
+        data = self._vol_vm.read(self._vol_offset, compiled.size)
         if not data:
-            return NoneObject("Unable to read {0} bytes from {1}".format(self.size(), self.obj_offset))
+            return NoneObject("Unable to read {0} bytes from {1}".format(compiled.size, self.obj_offset))
 
-        (val,) = struct.unpack(self.format_string, data)
+        (val,) = compiled.unpack(data)
 
         # Ensure that integer NativeTypes are converted to longs
         # to avoid integer boundaries when doing __rand__ proxying
@@ -461,6 +518,8 @@ class NativeType(BaseObject, NumericProxyMixIn):
 
 class BitField(NativeType):
     """ A class splitting an integer into a bunch of bit. """
+    __slots__ = ('start_bit', 'end_bit', 'native_type')
+
     def __init__(self, theType, offset, vm, start_bit = 0, end_bit = 32, native_type = None, **kwargs):
         # Defaults to profile-endian address, but can be overridden by native_type
         format_string = vm.profile.native_types.get(native_type, vm.profile.native_types['address'])[1]
@@ -479,6 +538,8 @@ class BitField(NativeType):
 
 
 class Pointer(NativeType):
+    __slots__ = ('target',)
+
     def __init__(self, theType, offset, vm, target = None, **kwargs):
         # Default to profile-endian address
         # We don't allow native_type overriding for pointers since we can't dereference invalid pointers anyway
@@ -552,6 +613,8 @@ class Pointer(NativeType):
         return NativeType.v(self) & 0xffffffffffff
 
 class Void(NativeType):
+    __slots__ = ()
+
     def __init__(self, theType, offset, vm, **kwargs):
         # Default to profile-endian unsigned long
         # This should never need to be overridden, but can be by changing the 'Void' value in a profile's object_classes
@@ -572,6 +635,8 @@ class Void(NativeType):
 
 class Array(BaseObject):
     """ An array of objects of the same size """
+    __slots__ = ('count', 'original_offset', 'target', 'current')
+
     def __init__(self, theType, offset, vm, parent = None,
                  count = 1, targetType = None, target = None, name = None, **kwargs):
         ## Instantiate the first object on the offset:
@@ -673,23 +738,192 @@ class Array(BaseObject):
         if item != None:
             item.write(value)
 
+    def read_elements(self):
+        """ Reads the memory of the whole array in one batch.
+
+            Returns (data, holes) where data covers the whole array with
+            unreadable pages zero filled, and holes lists the (offset,
+            length) of those pages relative to the start of the array.
+        """
+        start = self.original_offset
+        end = start + self.size()
+        pieces = []
+        addr = start
+        while addr < end:
+            chunk_len = min(end - addr, 0x1000 - (addr % 0x1000))
+            pieces.append((addr, chunk_len))
+            addr += chunk_len
+
+        data = []
+        holes = []
+        for (addr, chunk_len), buf in zip(pieces, self.obj_vm.read_many(pieces)):
+            if not buf or len(buf) != chunk_len:
+                holes.append((addr - start, chunk_len))
+                buf = '\x00' * chunk_len
+            data.append(buf)
+        return ''.join(data), holes
+
+    def values(self):
+        """ Returns the values of all the elements, decoded in bulk.
+
+            The array is read with as few reads as the address space
+            allows and unpacked in one step. Elements which lie (even
+            partly) in an unreadable page come back as None. Arrays of
+            anything but plain native types are decoded element by
+            element instead.
+        """
+        element = self.current
+        if not isinstance(element, NativeType) or type(element).v.im_func not in (NativeType.v.im_func, Pointer.v.im_func):
+            result = []
+            for i in xrange(self.count):
+                value = self[i].v()
+                result.append(None if isinstance(value, NoneObject) else value)
+            return result
+
+        compiled = element.obj_struct
+        size = compiled.size
+        data, holes = self.read_elements()
+
+        format_string = element.format_string
+        if format_string[:1] in "@=<>!" and len(format_string) == 2:
+            # One value per element, so unpack everything in one call
+            result = list(get_struct(format_string[0] + str(self.count) + format_string[1]).unpack(data))
+        else:
+            result = [compiled.unpack_from(data, i * size)[0] for i in xrange(self.count)]
+
+        if isinstance(element, Pointer):
+            result = [value & 0xffffffffffff for value in result]
+
+        for hole_start, hole_length in holes:
+            first = hole_start / size
+            last = min(self.count, (hole_start + hole_length + size - 1) / size)
+            for i in xrange(first, last):
+                result[i] = None
+
+        return result
+
+class SnapshotVM(object):
+    """ Serves reads of a struct from a copy taken with a single read.
+
+    Reads which fall outside of the struct (or any read once the
+    snapshot was invalidated, or once the generation of the real
+    address space moved on, eg. because a live target ran) go to the
+    real address space, which also answers for all other attributes.
+    Writes go through to the real address space and update the copy.
+    """
+    def __init__(self, vm, offset, data):
+        self.vm = vm
+        self.offset = offset
+        self.assign(data)
+
+    def assign(self, data):
+        self.data = data
+        self.end = self.offset + len(data or '')
+        self.generation = self.vm.get_generation()
+
+    def invalidate(self):
+        self.assign(None)
+
+    def _holds(self, addr, length):
+        """Tells whether the copy is current and covers [addr, addr + length)"""
+        if self.data is None or not (self.offset <= addr and addr + length <= self.end):
+            return False
+        if self.vm.get_generation() != self.generation:
+            self.data = None
+            return False
+        return True
+
+    def read(self, addr, length):
+        if self._holds(addr, length):
+            start = addr - self.offset
+            return self.data[start:start + length]
+        return self.vm.read(addr, length)
+
+    def zread(self, addr, length):
+        if self._holds(addr, length):
+            return self.read(addr, length)
+        return self.vm.zread(addr, length)
+
+    def is_valid_address(self, addr):
+        if self._holds(addr, 1):
+            return True
+        return self.vm.is_valid_address(addr)
+
+    def write(self, addr, data):
+        result = self.vm.write(addr, data)
+        if result and self._holds(addr, len(data)):
+            start = addr - self.offset
+            self.data = self.data[:start] + data + self.data[start + len(data):]
+        return result
+
+    def __getattr__(self, attr):
+        return getattr(self.vm, attr)
+
+    def __eq__(self, other):
+        return self.vm == getattr(other, 'vm', other)
+
+    def __ne__(self, other):
+        return not self == other
+
 class CType(BaseObject):
     """ A CType is an object which represents a c struct """
-    def __init__(self, theType, offset, vm, name = None, members = None, struct_size = 0, **kwargs):
+    __slots__ = ('members', 'struct_size', 'layout', 'snapshot', 'snapshot_vm', '__initialized')
+
+    def __init__(self, theType, offset, vm, name = None, members = None, struct_size = 0, snapshot = False, layout = None, **kwargs):
         """ This must be instantiated with a dict of members. The keys
         are the offsets, the values are Curried Object classes that
         will be instantiated when accessed.
+
+        layout is the flat (offset, class) table of the members at fixed
+        offsets, which Profile.compile precomputes for each struct.
+
+        With snapshot set, the whole struct is read at once and its
+        members are decoded from that copy (see refresh()).
         """
         if not members:
             # Warn rather than raise an error, since some types (_HARDWARE_PTE, for example) are generated without members
             debug.debug("No members specified for CType {0} named {1}".format(theType, name), level = 2)
             members = {}
 
+        object.__setattr__(self, '_CType__initialized', False)
         self.members = members
         self.struct_size = struct_size
+        self.layout = layout or {}
+        self.snapshot = snapshot
+        self.snapshot_vm = None
         BaseObject.__init__(self, theType, offset, vm, name = name, **kwargs)
         self.__initialized = True
 
+        if snapshot:
+            self.refresh()
+
+    def refresh(self):
+        """ (Re)reads the whole struct in one go and decodes members from it
+
+            Members (and embedded structs) created from this object share
+            the copy, so they see the new contents as well. Returns False
+            if the struct could not be read, in which case members are
+            read from memory as usual.
+        """
+        data = self.obj_vm.read(self.obj_offset, self.struct_size)
+        if not data or len(data) != self.struct_size:
+            self.invalidate()
+            return False
+
+        if self.snapshot_vm is None:
+            # Pointers must still be followed in the real address space
+            self.set_native_vm(self.obj_native_vm)
+            self.snapshot_vm = SnapshotVM(self.obj_vm, self.obj_offset, data)
+        else:
+            self.snapshot_vm.assign(data)
+        return True
+
+    def invalidate(self):
+        """ Drops the snapshot, members go back to reading memory directly """
+        if self.snapshot_vm is not None:
+            self.snapshot_vm.invalidate()
+            self.snapshot_vm = None
+
     def size(self):
         return self.struct_size
 
@@ -712,12 +946,35 @@ class CType(BaseObject):
         return long(self.obj_offset)
 
     def m(self, attr):
+        if attr in self.layout:
+            # Fixed offset members come straight from the flat layout
+            offset, cls = self.layout[attr]
+            offset = offset + int(self._vol_offset)
+        else:
+            offset, cls = self._resolve_member(attr)
+            if cls is None:
+                # An alias, already resolved
+                return offset
+
+        try:
+            result = cls(offset = offset, vm = self.snapshot_vm or self._vol_vm, parent = self, name = attr, native_vm = self.obj_native_vm)
+        except InvalidOffsetError, e:
+            return NoneObject(str(e))
+
+        return result
+
+    def _resolve_member(self, attr):
+        """ Looks up a member which is not in the flat layout.
+
+            Returns (absolute offset, class), or (result, None) for
+            members which are callables (eg. aliases).
+        """
         if attr in self.members:
             # Allow the element to be a callable rather than a list - this is
             # useful for aliasing member names
             element = self.members[attr]
             if callable(element):
-                return element(self)
+                return element(self), None
 
             offset, cls = element
         elif attr.find('__') > 0 and attr[attr.find('__'):] in self.members:
@@ -735,12 +992,7 @@ class CType(BaseObject):
             ## Otherwise its relative to the start of our struct
             offset = int(offset) + int(self.obj_offset)
 
-        try:
-            result = cls(offset = offset, vm = self.obj_vm, parent = self, name = attr, native_vm = self.obj_native_vm)
-        except InvalidOffsetError, e:
-            return NoneObject(str(e))
-
-        return result
+        return offset, cls
 
     def __getattr__(self, attr):
         return self.m(attr)
@@ -748,9 +1000,15 @@ class CType(BaseObject):
     def __setattr__(self, attr, value):
         """Change underlying members"""
         # Special magic to allow initialization
-        if not self.__dict__.has_key('_CType__initialized'):  # this test allows attributes to be set in the __init__ method
+        try:
+            initialized = object.__getattribute__(self, '_CType__initialized')
+        except AttributeError:
+            initialized = False
+
+        if not initialized:  # this test allows attributes to be set in the __init__ method
             return BaseObject.__setattr__(self, attr, value)
-        elif self.__dict__.has_key(attr):       # any normal attributes are handled normally
+        elif (isinstance(getattr(self.__class__, attr, None), types.MemberDescriptorType) or
+              self.__dict__.has_key(attr)):       # any normal attributes are handled normally
             return BaseObject.__setattr__(self, attr, value)
         else:
             obj = self.m(attr)
@@ -763,6 +1021,7 @@ class CType(BaseObject):
 
 class VolatilityMagic(BaseObject):
     """Class to contain Volatility Magic value"""
+    __slots__ = ('configname', 'value')
 
     # TODO: At some point, make it possible to use these without requiring .v()
     # by making them inherit from NumericProxyMixIn when they're supposed to be numeric values
@@ -950,6 +1209,7 @@ class Profile(object):
         self.types = {}
         for nt, value in self.native_types.items():
             if type(value) == list:
+                get_struct(value[1])
                 self.types[nt] = Curry(NativeType, nt, format_string = value[1])
 
         # Go through the vtypes, creating the stubs for object creation at
@@ -1169,7 +1429,7 @@ class Profile(object):
 
         ## This is a list which refers to a type which is already defined
         if typeList[0] in self.types:
-            return Curry(self.types[typeList[0]], name = name)
+            return flat_curry(self.types[typeList[0]], name = name)
 
         ## Does it refer to a type which will be defined in future? in
         ## this case we just curry the Object function to provide
@@ -1188,7 +1448,7 @@ class Profile(object):
         ## If we get here we have no idea what this list is
         #raise RuntimeError("Error in parsing list {0}".format(typeList))
         debug.warning("Unable to find a type for {0}, assuming int".format(typeList[0]))
-        return Curry(self.types['int'], name = name)
+        return flat_curry(self.types['int'], name = name)
 
     def _convert_members(self, cname):
         """ Convert the structure named by cname from the c description
@@ -1213,6 +1473,7 @@ class Profile(object):
         """
         size, raw_members = self.vtypes.get(cname)
         members = {}
+        layout = {}
         for k, v in raw_members.items():
             if callable(v):
                 members[k] = v
@@ -1220,6 +1481,9 @@ class Profile(object):
                 debug.warning("{0} has no offset in object {1}. Check that vtypes has a concrete definition for it.".format(k, cname))
             else:
                 members[k] = (v[0], self._list_to_type(k, v[1], self.vtypes))
+                ## Members at a fixed offset also go in the flat layout
+                if not callable(v[0]):
+                    layout[k] = (int(v[0]), members[k][1])
 
         ## Allow the plugins to over ride the class constructor here
         if self.object_classes and cname in self.object_classes:
@@ -1227,7 +1491,7 @@ class Profile(object):
         else:
             cls = CType
 
-        return Curry(cls, cname, members = members, struct_size = size)
+        return Curry(cls, cname, members = members, struct_size = size, layout = layout)
 
 class ProfileModification(object):
     """ Class for modifying profiles for additional functionality """
@@ -112,41 +112,40 @@ class AMD64PagedMemory(intel.JKIA32PagedMemoryPae):
         '''
         return (pdpte & 0xfffffc0000000) | (vaddr & 0x3fffffff)
 
-    def vtop(self, vaddr):
+    def translate_page(self, vaddr):
         '''
-        Translates virtual addresses into physical offsets.
-        The function returns either None (no valid mapping)
-        or the offset in physical memory where the address maps.
+        Walks the page tables for vaddr, bypassing the TLB. Returns the
+        physical offset (None if not mapped) and the size of the page.
         '''
         vaddr = long(vaddr)
         pml4e = self.get_pml4e(vaddr)
         if not self.entry_present(pml4e):
             # Add support for paged out PML4E
-            return None
+            return None, 0x8000000000
 
         pdpte = self.get_pdpte(vaddr, pml4e)
         if not self.entry_present(pdpte):
             # Add support for paged out PDPTE
             # Insert buffalo here!
-            return None
+            return None, 0x40000000
 
         if self.page_size_flag(pdpte):
-            return self.get_one_gig_paddr(vaddr, pdpte)
+            return self.get_one_gig_paddr(vaddr, pdpte), 0x40000000
 
         pde = self.get_pde(vaddr, pdpte)
         if not self.entry_present(pde):
             # Add support for paged out PDE
-            return None
+            return None, 0x200000
 
         if self.page_size_flag(pde):
-            return self.get_two_meg_paddr(vaddr, pde)
+            return self.get_two_meg_paddr(vaddr, pde), 0x200000
 
         pte = self.get_pte(vaddr, pde)
         if not self.entry_present(pte):
             # Add support for paged out PTE
-            return None
+            return None, 0x1000
 
-        return self.get_phys_addr(vaddr, pte)
+        return self.get_phys_addr(vaddr, pte), 0x1000
 
     def get_available_pages(self):
         '''
@@ -157,33 +156,19 @@ class AMD64PagedMemory(intel.JKIA32PagedMemoryPae):
 
         # Pages that hold PDEs and PTEs are 0x1000 bytes each.
         # Each PDE and PTE is eight bytes. Thus there are 0x1000 / 8 = 0x200
-        # PDEs and PTEs we must test.
-        for pml4e in range(0, 0x200):
-            vaddr = pml4e << 39
-            pml4e_value = self.get_pml4e(vaddr)
-            if not self.entry_present(pml4e_value):
-                continue
-            for pdpte in range(0, 0x200):
+        # PDEs and PTEs we must test. Every table is read as a whole.
+        if self.cache:
+            pml4es = self.pml4e_cache
+        else:
+            pml4es = self.read_tables([self.dtb & 0xffffffffff000], intel.table64)[0]
+
+        for pml4e, pml4e_value in self.present_entries(pml4es):
+            pdptes = self.read_tables([pml4e_value & 0xffffffffff000], intel.table64)[0]
+            for pdpte, pdpte_value in self.present_entries(pdptes):
                 vaddr = (pml4e << 39) | (pdpte << 30)
-                pdpte_value = self.get_pdpte(vaddr, pml4e_value)
-                if not self.entry_present(pdpte_value):
-                    continue
                 if self.page_size_flag(pdpte_value):
                     yield (vaddr, 0x40000000)
                     continue
-                tmp2 = vaddr
-                for pde in range(0, 0x200):
-                    vaddr = tmp2 | (pde << 21)
-                    pde_value = self.get_pde(vaddr, pdpte_value)
-                    if not self.entry_present(pde_value):
-                        continue
-                    if self.page_size_flag(pde_value):
-                        yield (vaddr, 0x200000)
-                        continue
-
-                    tmp = vaddr
-                    for pte in range(0, 0x200):
-                        vaddr = tmp | (pte << 12)
-                        pte_value = self.get_pte(vaddr, pde_value)
-                        if self.entry_present(pte_value):
-                            yield (vaddr, 0x1000)
+                pdes = self.read_tables([pdpte_value & 0xffffffffff000], intel.table64)[0]
+                for page in self._available_in_directory(vaddr, pdes):
+                    yield page
@@ -0,0 +1,360 @@
+# Volatility
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+
+""" An address space speaking the gdb remote serial protocol directly.
+
+This talks to a gdbstub (eg. QEMU's -gdb tcp::1234) over its socket, so
+plugins can run outside of a gdb session. Memory reads are split into the
+largest packets the stub accepts and several requests are kept in flight
+at once.
+"""
+
+import socket
+import struct
+import binascii
+import volatility.addrspace as addrspace
+
+#pylint: disable-msg=C0111
+
+## Register layout of the i386 'g' packet, as sent by QEMU
+i386_registers = ["eax", "ecx", "edx", "ebx", "esp", "ebp", "esi", "edi",
+                  "eip", "eflags", "cs", "ss", "ds", "es", "fs", "gs"]
+
+## Register layout of the x86-64 'g' packet, as sent by QEMU: the general
+## registers and rip are 8 bytes, eflags and the segments 4
+amd64_registers = [(name, 'Q') for name in
+                   ["rax", "rbx", "rcx", "rdx", "rsi", "rdi", "rbp", "rsp",
+                    "r8", "r9", "r10", "r11", "r12", "r13", "r14", "r15", "rip"]] + \
+                  [(name, 'I') for name in ["eflags", "cs", "ss", "ds", "es", "fs", "gs"]]
+
+class RSPError(IOError):
+    """Raised when the stub answers a request with an error"""
+    pass
+
+class RSPConnection(object):
+    """ A minimal gdb remote serial protocol client
+
+    Connects to host:port, or talks over an already connected sock.
+    """
+
+    ## Used until the stub tells us its real PacketSize
+    default_packet_size = 0x400
+
+    def __init__(self, host = None, port = None, timeout = 10, sock = None):
+        if sock is None:
+            sock = socket.create_connection((host, port), timeout)
+        self.sock = sock
+        self.buf = ''
+        self.ack_mode = True
+        self.packet_size = self.default_packet_size
+        self.features = {}
+        self._negotiate()
+
+    def _negotiate(self):
+        for feature in self.request("qSupported:multiprocess-;swbreak+;hwbreak+").split(';'):
+            if feature.find('=') > 0:
+                name, value = feature.split('=', 1)
+                self.features[name] = value
+            elif feature:
+                self.features[feature[:-1]] = feature[-1] == '+'
+
+        if 'PacketSize' in self.features:
+            self.packet_size = int(self.features['PacketSize'], 16)
+
+        if self.features.get('QStartNoAckMode') and self.request("QStartNoAckMode") == 'OK':
+            self.ack_mode = False
+
+    @staticmethod
+    def escape(data):
+        """Escapes the characters which are special inside a packet"""
+        out = []
+        for c in data:
+            if c in '#$}*':
+                out.append('}' + chr(ord(c) ^ 0x20))
+            else:
+                out.append(c)
+        return ''.join(out)
+
+    @staticmethod
+    def unescape(data):
+        """Undoes binary escaping and run length encoding in a reply"""
+        if data.find('}') < 0 and data.find('*') < 0:
+            return data
+        out = []
+        i = 0
+        while i < len(data):
+            c = data[i]
+            if c == '}':
+                i += 1
+                out.append(chr(ord(data[i]) ^ 0x20))
+            elif c == '*':
+                i += 1
+                out.append(out[-1][-1] * (ord(data[i]) - 29))
+            else:
+                out.append(c)
+            i += 1
+        return ''.join(out)
+
+    def send(self, payload):
+        """Frames and sends a packet without waiting for the reply"""
+        checksum = sum(ord(c) for c in payload) & 0xff
+        self.sock.sendall("${0}#{1:02x}".format(payload, checksum))
+
+    def _fill(self):
+        data = self.sock.recv(0x10000)
+        if not data:
+            raise IOError("gdbstub closed the connection")
+        self.buf += data
+
+    def receive(self):
+        """Returns the payload of the next reply packet"""
+        while True:
+            start = self.buf.find('$')
+            while start < 0:
+                # Only acknowledgements (or garbage) before the packet
+                self.buf = ''
+                self._fill()
+                start = self.buf.find('$')
+
+            end = self.buf.find('#', start)
+            while end < 0 or len(self.buf) < end + 3:
+                self._fill()
+                end = self.buf.find('#', start)
+
+            payload = self.buf[start + 1:end]
+            checksum = self.buf[end + 1:end + 3]
+            self.buf = self.buf[end + 3:]
+
+            if self.ack_mode:
+                if (sum(ord(c) for c in payload) & 0xff) != int(checksum, 16):
+                    self.sock.sendall('-')
+                    continue
+                self.sock.sendall('+')
+            return payload
+
+    def request(self, payload):
+        """Sends a packet and returns its reply"""
+        self.send(payload)
+        return self.receive()
+
+    def pipeline(self, payloads, depth):
+        """Sends a batch of packets keeping up to depth of them in flight
+
+            The replies are yielded in request order.
+        """
+        payloads = list(payloads)
+        sent = 0
+        while sent < min(depth, len(payloads)):
+            self.send(payloads[sent])
+            sent += 1
+        for _ in range(len(payloads)):
+            reply = self.receive()
+            if sent < len(payloads):
+                self.send(payloads[sent])
+                sent += 1
+            yield reply
+
+    def monitor(self, command):
+        """Runs a monitor command (qRcmd) and returns its console output"""
+        output = []
+        reply = self.request("qRcmd," + binascii.hexlify(command))
+        while reply.startswith('O') and reply != 'OK':
+            output.append(binascii.unhexlify(reply[1:]))
+            reply = self.receive()
+        if reply.startswith('E'):
+            raise RSPError("monitor {0} failed: {1}".format(command, reply))
+        return ''.join(output)
+
+    def close(self, detach = False):
+        """Closes the connection, the target is only resumed when detaching"""
+        try:
+            if detach:
+                self.send("D")
+        finally:
+            self.sock.close()
+
+class GdbRemoteAddressSpace(addrspace.BaseAddressSpace):
+    """ A physical AS reading guest memory straight from a gdbstub.
+
+    For this AS to be instantiated, we need
+
+    1) A location of the form gdb://host:port
+
+    2) base == None (we need to be at the bottom of the AS stack)
+
+    The stub is switched to physical memory mode (monitor USE_PHYS_MEM)
+    once, when connecting, and stays there since nobody else shares the
+    connection. Closing the AS leaves the guest halted, unless GDB-DETACH
+    asks to detach from it (which resumes it).
+    """
+    ## Try us before the in-gdb AS, we only accept gdb:// locations
+    order = 98
+
+    ## How many memory requests we keep outstanding at once
+    pipeline_depth = 16
+
+    def __init__(self, base, config, layered = False, **kwargs):
+        self.as_assert(base == None or layered, 'Must be first Address Space')
+        self.as_assert(config.LOCATION and config.LOCATION.startswith("gdb://"), 'Location is not of gdb scheme')
+        addrspace.BaseAddressSpace.__init__(self, base, config, **kwargs)
+
+        netloc = config.LOCATION[6:].strip('/')
+        host, _, port = netloc.rpartition(':')
+        try:
+            self.conn = RSPConnection(host or 'localhost', int(port))
+        except (ValueError, socket.error), e:
+            self.as_assert(False, "Unable to connect to gdbstub at {0}: {1}".format(netloc, e))
+
+        self.name = "gdbstub at " + netloc
+        self.fname = netloc
+        self.offset = 0
+        self.size = 0xffffffff
+        self.set_phys_mode(True)
+
+    @staticmethod
+    def register_options(config):
+        config.add_option("GDB-DETACH", action = "store_true", default = False,
+                          help = "Detach from the gdbstub (resuming the guest) when closing")
+
+    def monitor(self, command):
+        return self.conn.monitor(command)
+
+    def set_phys_mode(self, phys):
+        """Selects whether the stub reads physical or virtual memory"""
+        if phys:
+            self.monitor("USE_PHYS_MEM")
+        else:
+            self.monitor("USE_VIRT_MEM")
+
+    @property
+    def max_read(self):
+        """The largest read fitting in a single reply packet"""
+        # Each byte is sent as two hex digits, leave room for the framing
+        return max(0x10, (self.conn.packet_size - 0x10) / 2)
+
+    def _read_chunks(self, addr, length):
+        """Yields (offset, data) for every chunk, with None for failed chunks"""
+        step = self.max_read
+        offsets = range(addr, addr + length, step)
+        requests = ["m{0:x},{1:x}".format(offset, min(step, addr + length - offset)) for offset in offsets]
+        for offset, reply in zip(offsets, self.conn.pipeline(requests, self.pipeline_depth)):
+            reply = self.conn.unescape(reply)
+            if not reply or reply.startswith('E'):
+                yield offset, None
+            else:
+                yield offset, binascii.unhexlify(reply)
+
+    def read(self, addr, length):
+        data = []
+        ok = True
+        for _offset, chunk in self._read_chunks(addr, length):
+            # Drain all replies even after a failure to keep the stream in sync
+            if chunk is None:
+                ok = False
+            data.append(chunk)
+        if not ok:
+            return None
+        return ''.join(data)
+
+    def zread(self, addr, length):
+        data = []
+        for offset, chunk in self._read_chunks(addr, length):
+            if chunk is None:
+                chunk = '\x00' * min(self.max_read, addr + length - offset)
+            data.append(chunk)
+        return ''.join(data)
+
+    def read_many(self, requests):
+        return self._read_coalesced(requests, gap = self.max_read)
+
+    def read_long(self, addr):
+        string = self.read(addr, 4)
+        (longval,) = struct.unpack('=I', string)
+        return longval
+
+    def read_registers(self):
+        """ Returns the general registers from a single 'g' packet.
+
+            The layout of the packet depends on the architecture of the
+            stub, which is taken to match the memory model of the profile
+            (i386 for 32bit, x86-64 for 64bit).
+        """
+        if self.profile.metadata.get('memory_model', '32bit') == '64bit':
+            layout = amd64_registers
+        else:
+            layout = [(name, 'I') for name in i386_registers]
+
+        data = binascii.unhexlify(self.conn.unescape(self.conn.request("g")))
+        registers = {}
+        pos = 0
+        for name, fmt in layout:
+            size = struct.calcsize('<' + fmt)
+            if pos + size > len(data):
+                break
+            registers[name] = struct.unpack_from('<' + fmt, data, pos)[0]
+            pos += size
+        return registers
+
+    def find_offset(self, addr, length, pattern):
+        """Searches on the stub side, falling back to a local search"""
+        pattern = str(pattern)
+        reply = self.conn.request("qSearch:memory:{0:x};{1:x};{2}".format(addr, length, self.conn.escape(pattern)))
+        if reply.startswith('1,'):
+            return int(reply[2:], 16) - addr
+        if reply == '0':
+            return None
+
+        # The stub does not support searching, read large blocks instead
+        step = max(self.max_read * self.pipeline_depth, len(pattern) * 2)
+        offset = 0
+        while offset < length:
+            block = self.zread(addr + offset, min(step + len(pattern) - 1, length - offset))
+            found = block.find(pattern)
+            if found >= 0:
+                return offset + found
+            offset += step
+        return None
+
+    def find(self, addr, length, pattern):
+        ret = self.find_offset(addr, length, pattern)
+        if ret != None:
+            ret = ret + addr
+        return ret
+
+    def get_available_addresses(self):
+        yield (0, self.size)
+
+    def get_generation(self):
+        return addrspace.target_stops.value
+
+    def is_valid_address(self, addr):
+        if addr == None:
+            return False
+        return addr < self.size
+
+    def write(self, addr, data):
+        if not self._config.WRITE:
+            return False
+        reply = self.conn.request("M{0:x},{1:x}:{2}".format(addr, len(data), binascii.hexlify(data)))
+        return reply == 'OK'
+
+    def close(self):
+        self.set_phys_mode(False)
+        self.conn.close(detach = self._config.GDB_DETACH)
+
+    def __eq__(self, other):
+        return self.__class__ == other.__class__ and self.base == other.base and self.fname == other.fname
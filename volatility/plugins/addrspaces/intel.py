@@ -27,6 +27,10 @@ import volatility.addrspace as addrspace
 import volatility.obj as obj
 import volatility.debug as debug #pylint: disable-msg=W0611
 
+## Layouts of a whole 4KB paging structure, with 4 or 8 byte entries
+table32 = struct.Struct('<' + 'I' * 0x400)
+table64 = struct.Struct('<' + 'Q' * 0x200)
+
 # WritablePagedMemory must be BEFORE base address, since it adds the concrete method get_available_addresses
 # If it's second, BaseAddressSpace's abstract version will take priority
 class JKIA32PagedMemory(standard.AbstractWritablePagedMemory, addrspace.BaseAddressSpace):
@@ -44,6 +48,11 @@ class JKIA32PagedMemory(standard.AbstractWritablePagedMemory, addrspace.BaseAddr
     for extra performance. The cache option requires an additional 4KB of
     space.
 
+    Translations are kept in a software TLB keyed by virtual page number,
+    holding both mapped and unmapped results. It is bounded by --tlb-size
+    entries and is flushed whenever the generation of the base AS changes
+    (eg. a live target was resumed), or explicitly with flush_tlb().
+
     Comments in this class mostly come from the Intel(R) 64 and IA-32 
     Architectures Software Developer's Manual Volume 3A: System Programming 
     Guide, Part 1, revision 031, pages 4-8 to 4-15. This book is available
@@ -56,6 +65,8 @@ class JKIA32PagedMemory(standard.AbstractWritablePagedMemory, addrspace.BaseAddr
     pae = False
     paging_address_space = True
     checkname = 'IA32ValidAS'
+    ## Page tables read with each read_many of get_available_pages
+    tables_per_batch = 64
 
     def __init__(self, base, config, dtb = 0, *args, **kwargs):
         ## We must be stacked on someone else:
@@ -82,6 +93,10 @@ class JKIA32PagedMemory(standard.AbstractWritablePagedMemory, addrspace.BaseAddr
         if self.cache:
             self._cache_values()
 
+        self.tlb = {}
+        self.tlb_size = config.TLB_SIZE or 0
+        self.tlb_generation = self.base.get_generation()
+
         volmag = obj.VolMagic(self)
         if hasattr(volmag, self.checkname):
             self.as_assert(getattr(volmag, self.checkname).v(), "Failed valid Address Space check")
@@ -101,6 +116,9 @@ class JKIA32PagedMemory(standard.AbstractWritablePagedMemory, addrspace.BaseAddr
         config.add_option("CACHE-DTB", action = "store_false", default = True,
                           help = "Cache virtual to physical mappings")
 
+        config.add_option("TLB-SIZE", type = 'int', default = 0x10000,
+                          help = "Number of page translations to cache (0 disables)")
+
     def __getstate__(self):
         result = addrspace.BaseAddressSpace.__getstate__(self)
         result['dtb'] = self.dtb
@@ -216,11 +234,58 @@ class JKIA32PagedMemory(standard.AbstractWritablePagedMemory, addrspace.BaseAddr
 
 
     def find(self, vaddr, length, pattern):
-        addr = self.vtop(vaddr)
-        ret = self.base.find_offset(addr, length, pattern)
-        if(ret != None): 
-            ret = ret + vaddr
-        return ret
+        '''
+        Returns the virtual address of the first match of pattern in
+        [vaddr, vaddr + length), or None.
+
+        Each physically contiguous run is searched by the base AS in one
+        go (on a live target the search happens on the stub side). Matches
+        crossing the edge between two runs are looked for in the few bytes
+        around every edge.
+        '''
+        pattern = str(pattern)
+        vaddr, length = int(vaddr), int(length)
+        overlap = len(pattern) - 1
+
+        with self.read_session():
+            runs = list(self.translate_range(vaddr, length))
+            extent_start = None
+            previous_end = None
+            for index, (run_vaddr, run_paddr, run_len) in enumerate(runs):
+                if run_vaddr != previous_end:
+                    # A new stretch of mapped memory, nothing to stitch
+                    extent_start = run_vaddr
+                elif overlap > 0:
+                    # Look for a match starting in the tail of the
+                    # previous runs and ending in this one
+                    extent_end = run_vaddr
+                    for next_vaddr, _next_paddr, next_len in runs[index:]:
+                        if next_vaddr != extent_end or extent_end >= run_vaddr + overlap:
+                            break
+                        extent_end = next_vaddr + next_len
+                    window_start = max(extent_start, run_vaddr - overlap)
+                    window_end = min(extent_end, run_vaddr + overlap)
+                    window = self.read(window_start, window_end - window_start)
+                    found = window.find(pattern) if window else -1
+                    if found >= 0:
+                        return window_start + found
+
+                ret = self.base.find_offset(run_paddr, run_len, pattern)
+                if ret != None:
+                    return run_vaddr + ret
+                previous_end = run_vaddr + run_len
+
+        return None
+
+    def flush_tlb(self):
+        '''
+        Forgets all cached translations. The cached Page Directory
+        Entries are reloaded as well, since they may be just as stale.
+        '''
+        self.tlb.clear()
+        self.tlb_generation = self.base.get_generation()
+        if self.cache:
+            self._cache_values()
 
     def vtop(self, vaddr):
         '''
@@ -228,68 +293,120 @@ class JKIA32PagedMemory(standard.AbstractWritablePagedMemory, addrspace.BaseAddr
         The function should return either None (no valid mapping)
         or the offset in physical memory where the address maps.
         '''
+        return self.vtop_page(vaddr)[0]
+
+    def vtop_page(self, vaddr):
+        '''
+        Returns the physical offset of vaddr (or None) along with the
+        size of the page, or of the unmapped region, holding it.
+
+        Results are looked up in the TLB first and the page tables
+        are only walked on a miss.
+        '''
+        if not self.tlb_size:
+            return self.translate_page(vaddr)
+
+        if self.base.get_generation() != self.tlb_generation:
+            self.flush_tlb()
+
+        vaddr = long(vaddr)
+        vpn = vaddr >> 12
+        try:
+            page, page_size = self.tlb[vpn]
+        except KeyError:
+            page, page_size = self.translate_page(vpn << 12)
+            if len(self.tlb) >= self.tlb_size:
+                self.tlb.clear()
+            self.tlb[vpn] = (page, page_size)
+
+        if page is None:
+            return None, page_size
+        return page | (vaddr & 0xfff), page_size
+
+    def translate(self, vaddr):
+        '''
+        Walks the page tables to translate a virtual address, bypassing
+        the TLB. Returns None if there is no valid mapping.
+        '''
+        return self.translate_page(vaddr)[0]
+
+    def translate_page(self, vaddr):
+        '''
+        Walks the page tables for vaddr, bypassing the TLB. Returns the
+        physical offset (None if not mapped) and the size of the page,
+        so 4MB pages can be handled in one go.
+        '''
         pde_value = self.get_pde(vaddr)
         if not self.entry_present(pde_value):
             # Add support for paged out PDE
             # (insert buffalo here!)
-            return None
+            return None, 0x400000
 
         if self.page_size_flag(pde_value):
-            return self.get_four_meg_paddr(vaddr, pde_value)
+            return self.get_four_meg_paddr(vaddr, pde_value), 0x400000
 
         pte_value = self.get_pte(vaddr, pde_value)
         if not self.entry_present(pte_value):
             # Add support for paged out PTE
-            return None
+            return None, 0x1000
 
-        return self.get_phys_addr(vaddr, pte_value)
+        return self.get_phys_addr(vaddr, pte_value), 0x1000
 
-    def __read_chunk(self, vaddr, length):
+    def __read_run(self, paddr, length):
         """
-        Read 'length' bytes from the virtual address 'vaddr'.
-        If vaddr does not have a valid mapping, return None.
-
-        This function should not be called from outside this class
-        as it doesn't take page breaks into account. That is,
-        the bytes at virtual addresses 0x1fff and 0x2000 are not
-        guarenteed to be contigious. Calling functions are responsible
-        for determining contiguious blocks.
+        Reads one physically contiguous run from the base, returning
+        None if any of it is not available.
         """
-        paddr = self.vtop(vaddr)
-        if paddr is None:
+        if not self.base.is_valid_address(paddr) or not self.base.is_valid_address(paddr + length - 1):
             return None
-
-        if not self.base.is_valid_address(paddr):
+        buf = self.base.read(paddr, length)
+        if not buf or len(buf) != length:
             return None
-
-        return self.base.read(paddr, length)
-
+        return buf
 
     def __read_bytes(self, vaddr, length, pad):
         """
         Read 'length' bytes from the virtual address 'vaddr'.
         The 'pad' parameter controls whether unavailable bytes 
         are padded with zeros.
+
+        Every physically contiguous run is fetched with a single base
+        read. When padding, a run which cannot be read as a whole is
+        retried page by page so only the missing pages become zeros.
         """
         vaddr, length = int(vaddr), int(length)
-
-        ret = ''
-
-        while length > 0:
-            chunk_len = min(length, 0x1000 - (vaddr % 0x1000))
-
-            buf = self.__read_chunk(vaddr, chunk_len)
-            if not buf:
-                if pad:
-                    buf = '\x00' * chunk_len
+        end = vaddr + length
+        position = vaddr
+        ret = []
+
+        # Page table lookups and data reads all go to the base, so
+        # batch them into a single session
+        with self.read_session():
+            for run_vaddr, run_paddr, run_len in self.translate_range(vaddr, length):
+                if run_vaddr > position:
+                    if not pad:
+                        return obj.NoneObject("Could not read_chunks from addr " + hex(position) + " of size " + hex(run_vaddr - position))
+                    ret.append('\x00' * (run_vaddr - position))
+
+                buf = self.__read_run(run_paddr, run_len)
+                if buf is None:
+                    if not pad:
+                        return obj.NoneObject("Could not read_chunks from addr " + hex(run_vaddr) + " of size " + hex(run_len))
+                    offset = 0
+                    while offset < run_len:
+                        chunk_len = min(run_len - offset, 0x1000 - ((run_paddr + offset) % 0x1000))
+                        ret.append(self.__read_run(run_paddr + offset, chunk_len) or '\x00' * chunk_len)
+                        offset += chunk_len
                 else:
-                    return obj.NoneObject("Could not read_chunks from addr " + hex(vaddr) + " of size " + hex(chunk_len))
+                    ret.append(buf)
+                position = run_vaddr + run_len
 
-            ret += buf
-            vaddr += chunk_len
-            length -= chunk_len
+            if position < end:
+                if not pad:
+                    return obj.NoneObject("Could not read_chunks from addr " + hex(position) + " of size " + hex(end - position))
+                ret.append('\x00' * (end - position))
 
-        return ret
+        return ''.join(ret)
 
 
     def read(self, vaddr, length):
@@ -320,6 +437,51 @@ class JKIA32PagedMemory(standard.AbstractWritablePagedMemory, addrspace.BaseAddr
         (longval,) = struct.unpack('<I', string)
         return longval
 
+    def read_tables(self, paddrs, table = table32):
+        '''
+        Reads whole paging structures (one 4KB page each) at the
+        physical addresses paddrs, with a single read_many on the base.
+        Returns a list holding a tuple of entries for each structure,
+        or None where the structure could not be read.
+        '''
+        tables = []
+        for buf in self.base.read_many([(paddr, 0x1000) for paddr in paddrs]):
+            if buf and len(buf) == 0x1000:
+                tables.append(table.unpack(buf))
+            else:
+                tables.append(None)
+        return tables
+
+    def present_entries(self, entries):
+        '''
+        Yields (index, entry) for the present entries of a paging
+        structure. Empty slots are skipped without further checks.
+        '''
+        if not entries:
+            return
+        for index, entry in enumerate(entries):
+            if entry and self.entry_present(entry):
+                yield index, entry
+
+    def _available_in_tables(self, tables, large_size, table = table32):
+        '''
+        Yields the available pages under a list of (vaddr, paddr) page
+        directory entries, paddr being the page table of the entry or
+        None for a large page. The page tables are read in batches of
+        tables_per_batch, the pages of each batch being yielded as soon
+        as it is decoded.
+        '''
+        for start in range(0, len(tables), self.tables_per_batch):
+            batch = tables[start:start + self.tables_per_batch]
+            ptes_list = self.read_tables([paddr for _vaddr, paddr in batch if paddr is not None], table)
+            ptes_list.reverse()
+            for vaddr, paddr in batch:
+                if paddr is None:
+                    yield (vaddr, large_size)
+                    continue
+                for pte, _pte_value in self.present_entries(ptes_list.pop()):
+                    yield (vaddr | (pte << 12), 0x1000)
+
     def get_available_pages(self):
         '''
         Return a list of lists of available memory pages.
@@ -328,22 +490,23 @@ class JKIA32PagedMemory(standard.AbstractWritablePagedMemory, addrspace.BaseAddr
         '''
         # Pages that hold PDEs and PTEs are 0x1000 bytes each.
         # Each PDE and PTE is four bytes. Thus there are 0x1000 / 4 = 0x400
-        # PDEs and PTEs we must test
+        # PDEs and PTEs we must test. Every table is read as a whole and
+        # the page tables are fetched a batch at a time.
+        if self.cache:
+            pdes = self.pde_cache
+        else:
+            pdes = self.read_tables([self.dtb & 0xfffff000])[0]
 
-        for pde in range(0, 0x400):
+        tables = []
+        for pde, pde_value in self.present_entries(pdes):
             vaddr = pde << 22
-            pde_value = self.get_pde(vaddr)
-            if not self.entry_present(pde_value):
-                continue
             if self.page_size_flag(pde_value):
-                yield (vaddr, 0x400000)
+                tables.append((vaddr, None))
             else:
-                tmp = vaddr
-                for pte in range(0, 0x400):
-                    vaddr = tmp | (pte << 12)
-                    pte_value = self.get_pte(vaddr, pde_value)
-                    if self.entry_present(pte_value):
-                        yield (vaddr, 0x1000)
+                tables.append((vaddr, pde_value & 0xfffff000))
+
+        for page in self._available_in_tables(tables, 0x400000):
+            yield page
 
 
 class JKIA32PagedMemoryPae(JKIA32PagedMemory):
@@ -439,39 +602,31 @@ class JKIA32PagedMemoryPae(JKIA32PagedMemory):
         '''
         return (pte & 0xffffffffff000) | (vaddr & 0xfff)
 
-    def find(self, vaddr, length, pattern):
-        addr = self.vtop(vaddr)
-        ret = self.base.find_offset(addr, length, pattern)
-        if(ret != None): 
-            ret = ret + vaddr
-        return ret
-
-    def vtop(self, vaddr):
+    def translate_page(self, vaddr):
         '''
-        Translates virtual addresses into physical offsets.
-        The function returns either None (no valid mapping)
-        or the offset in physical memory where the address maps.
+        Walks the page tables for vaddr, bypassing the TLB. Returns the
+        physical offset (None if not mapped) and the size of the page.
         '''
         pdpte = self.get_pdpte(vaddr)
         if not self.entry_present(pdpte):
             # Add support for paged out PDPTE
             # Insert buffalo here!
-            return None
+            return None, 0x40000000
 
         pde = self.get_pde(vaddr, pdpte)
         if not self.entry_present(pde):
             # Add support for paged out PDE
-            return None
+            return None, 0x200000
 
         if self.page_size_flag(pde):
-            return self.get_two_meg_paddr(vaddr, pde)
+            return self.get_two_meg_paddr(vaddr, pde), 0x200000
 
         pte = self.get_pte(vaddr, pde)
         if not self.entry_present(pte):
             # Add support for paged out PTE
-            return None
+            return None, 0x1000
 
-        return self.get_phys_addr(vaddr, pte)
+        return self.get_phys_addr(vaddr, pte), 0x1000
 
     def _read_long_long_phys(self, addr):
         '''
@@ -502,18 +657,21 @@ class JKIA32PagedMemoryPae(JKIA32PagedMemory):
             pdpte_value = self.get_pdpte(vaddr)
             if not self.entry_present(pdpte_value):
                 continue
-            for pde in range(0, 0x200):
-                vaddr = pdpte << 30 | (pde << 21)
-                pde_value = self.get_pde(vaddr, pdpte_value)
-                if not self.entry_present(pde_value):
-                    continue
-                if self.page_size_flag(pde_value):
-                    yield (vaddr, 0x200000)
-                    continue
+            pdes = self.read_tables([pdpte_value & 0xffffffffff000], table64)[0]
+            for page in self._available_in_directory(vaddr, pdes):
+                yield page
+
+    def _available_in_directory(self, vaddr, pdes):
+        '''
+        Yields the available pages under one page directory, given its
+        entries. Its page tables are read a batch at a time.
+        '''
+        tables = []
+        for pde, pde_value in self.present_entries(pdes):
+            if self.page_size_flag(pde_value):
+                tables.append((vaddr | (pde << 21), None))
+            else:
+                tables.append((vaddr | (pde << 21), pde_value & 0xffffffffff000))
 
-                tmp = vaddr
-                for pte in range(0, 0x200):
-                    vaddr = tmp | (pte << 12)
-                    pte_value = self.get_pte(vaddr, pde_value)
-                    if self.entry_present(pte_value):
-                        yield (vaddr, 0x1000)
+        for page in self._available_in_tables(tables, 0x200000, table64):
+            yield page
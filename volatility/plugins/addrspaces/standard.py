@@ -28,6 +28,8 @@ import volatility.addrspace as addrspace
 import volatility.debug as debug #pylint: disable-msg=W0611
 import urllib
 import os
+import collections
+import mmap
 import volatility.conf as conf
 
 config = conf.ConfObject()
@@ -66,6 +68,66 @@ def write_callback(option, _opt_str, _value, parser, *_args, **_kwargs):
                 return
         print "Write support disabled."
 
+class GdbReadSession(object):
+    """ Keeps the gdb stub in physical memory mode for a batch of reads.
+
+    Sessions nest: the stub is switched to physical mode by the first
+    read that actually reaches the target and back to virtual mode when
+    the outermost session ends.
+    """
+    def __init__(self, space):
+        self.space = space
+
+    def __enter__(self):
+        self.space.begin_session()
+        return self.space
+
+    def __exit__(self, *_exc_info):
+        self.space.end_session()
+        return False
+
+class GdbPageCache(object):
+    """ A page granular LRU cache of physical memory read over gdb.
+
+    The contents are only valid while the target stays halted, so the
+    cache empties itself as soon as the generation of the live target
+    (addrspace.target_stops) changes.
+    """
+    page_size = 0x1000
+
+    def __init__(self, budget = 0):
+        self.budget = budget
+        self.pages = collections.OrderedDict()
+        self.generation = addrspace.target_stops.value
+
+    def _check_generation(self):
+        if self.generation != addrspace.target_stops.value:
+            self.pages.clear()
+            self.generation = addrspace.target_stops.value
+
+    def get(self, page):
+        """Returns the cached page (marking it recently used) or None"""
+        self._check_generation()
+        data = self.pages.pop(page, None)
+        if data is not None:
+            self.pages[page] = data
+        return data
+
+    def put(self, page, data):
+        """Stores a page, evicting the least recently used ones over budget"""
+        if self.budget < self.page_size:
+            return
+        self._check_generation()
+        self.pages.pop(page, None)
+        self.pages[page] = data
+        while len(self.pages) * self.page_size > self.budget:
+            self.pages.popitem(last = False)
+
+    def flush(self):
+        """Forgets the cached pages, and everything else cached from the target"""
+        addrspace.target_stops.bump()
+        self._check_generation()
+
 class GdbAddressSpace(addrspace.BaseAddressSpace):
     """ This is a direct GDB AS.
 
@@ -77,10 +139,23 @@ class GdbAddressSpace(addrspace.BaseAddressSpace):
     
     3) base == None (we dont operate on anyone else so we need to be
     right at the bottom of the AS stack.)
+
+    Every read needs the stub in physical memory mode (monitor
+    USE_PHYS_MEM) while gdb itself expects virtual mode. A batch of
+    reads can be wrapped in read_session() so the mode is switched only
+    once for the whole batch instead of twice per read.
+
+    Reads are served page by page from a GdbPageCache while the target
+    is halted. Its byte budget is set with --gdb-cache-size.
     """
     ## We should be the AS of last resort
     order = 99
 
+    ## The memory mode belongs to the stub, so it is shared by all instances
+    _session_depth = 0
+    _phys_mode = False
+    page_cache = GdbPageCache()
+
     def __init__(self, base, config, layered = False, **kwargs):
         addrspace.BaseAddressSpace.__init__(self, base, config, **kwargs)
         self.as_assert(base == None or layered, 'Must be first Address Space')
@@ -89,6 +164,7 @@ class GdbAddressSpace(addrspace.BaseAddressSpace):
         self.inferior = gdb.inferiors()[0]
         self.gdb_seek_pos = 0
         self.gdb_size = 0xffffffff
+        self.page_cache.budget = config.GDB_CACHE_SIZE or 0
     
 
     # Abstract Classes cannot register options, and since this checks config.WRITE in __init__, we define the option here
@@ -97,17 +173,101 @@ class GdbAddressSpace(addrspace.BaseAddressSpace):
         # TODO: ability to choose write support?
         # config.add_option("WRITE", short_option = 'w', action = "callback", default = False,
         #                   help = "Enable write support", callback = write_callback)
-        pass
+        config.add_option("GDB-CACHE-SIZE", type = 'int', default = 0x1000000,
+                          help = "Bytes of physical memory cached while a gdb target is halted (0 disables)")
+
+    @classmethod
+    def invalidate_cache(cls):
+        """Forgets all cached memory, to be called whenever the target runs"""
+        cls.page_cache.flush()
+
+    @classmethod
+    def _set_phys_mode(cls, phys):
+        if phys == cls._phys_mode:
+            return
+        if phys:
+            gdb.execute('monitor USE_PHYS_MEM')
+        else:
+            gdb.execute('monitor USE_VIRT_MEM')
+        cls._phys_mode = phys
+
+    @classmethod
+    def begin_session(cls):
+        """Enters a (possibly nested) physical read session"""
+        cls._session_depth += 1
+
+    @classmethod
+    def end_session(cls):
+        """Leaves a read session, restoring virtual mode after the outermost one"""
+        if cls._session_depth > 0:
+            cls._session_depth -= 1
+        if cls._session_depth == 0:
+            cls._set_phys_mode(False)
+
+    @classmethod
+    def reset_session(cls):
+        """Drops any open sessions and returns the stub to virtual mode"""
+        cls._session_depth = 0
+        cls._set_phys_mode(False)
 
+    def read_session(self):
+        return GdbReadSession(self)
+
+    def get_generation(self):
+        return addrspace.target_stops.value
+
+    @staticmethod
+    def _page_runs(pages, page_size):
+        """Groups sorted page addresses into (start, length) runs"""
+        run_start = run_end = None
+        for page in pages:
+            if page != run_end:
+                if run_start is not None:
+                    yield run_start, run_end - run_start
+                run_start = page
+            run_end = page + page_size
+        if run_start is not None:
+            yield run_start, run_end - run_start
+
+    def _read_memory(self, addr, length):
+        """Reads physical memory, going to the target only for uncached pages"""
+        cache = self.page_cache
+        if cache.budget < cache.page_size:
+            with self.read_session():
+                self._set_phys_mode(True)
+                return str(gdb.Inferior.read_memory(self.inferior, addr, length))
+
+        page_size = cache.page_size
+        first = addr - (addr % page_size)
+        end = addr + length
+
+        pages = {}
+        missing = []
+        for page in xrange(first, end, page_size):
+            data = cache.get(page)
+            if data is None:
+                missing.append(page)
+            else:
+                pages[page] = data
+
+        if missing:
+            with self.read_session():
+                self._set_phys_mode(True)
+                # Fetch each run of adjacent missing pages with one read
+                for run_start, run_length in self._page_runs(missing, page_size):
+                    data = str(gdb.Inferior.read_memory(self.inferior, run_start, run_length))
+                    for offset in xrange(0, run_length, page_size):
+                        page_data = data[offset:offset + page_size]
+                        pages[run_start + offset] = page_data
+                        cache.put(run_start + offset, page_data)
+
+        data = ''.join([pages[page] for page in xrange(first, end, page_size)])
+        return data[addr - first:end - first]
 
     def fread(self, length):
 #        return self.fhandle.read(length)
         try:
-            gdb.execute('monitor USE_PHYS_MEM')
-            ret = str(gdb.Inferior.read_memory(self.inferior, self.gdb_seek_pos, length))
-            gdb.execute('monitor USE_VIRT_MEM')
-
-            return ret
+            return self._read_memory(self.gdb_seek_pos, length)
         except Exception, e:
             return 0
 
@@ -115,21 +275,19 @@ class GdbAddressSpace(addrspace.BaseAddressSpace):
 #        self.fhandle.seek(addr)
 #        return self.fhandle.read(length)
         try:
-            gdb.execute('monitor USE_PHYS_MEM')
-            ret = str(gdb.Inferior.read_memory(self.inferior, addr, length))
-            gdb.execute('monitor USE_VIRT_MEM')
-
-            return ret
+            return self._read_memory(addr, length)
         except Exception, e:
             return 0
 
     def zread(self, addr, length):
 #        return self.read(addr, length)
-        gdb.execute('monitor USE_PHYS_MEM')
-        ret = str(gdb.Inferior.read_memory(self.inferior, addr, length))
-        gdb.execute('monitor USE_VIRT_MEM')
+        return self._read_memory(addr, length)
 
-        return ret
+    def read_many(self, requests):
+        # Every round trip costs far more than the bytes, so requests
+        # in the same or neighbouring pages are fetched together
+        with self.read_session():
+            return self._read_coalesced(requests, gap = self.page_cache.page_size)
 
     def find(self, addr, length, pattern):
         ret = self.find_offset(addr, length, pattern)
@@ -143,7 +301,10 @@ class GdbAddressSpace(addrspace.BaseAddressSpace):
         for c in pattern:
             pattern_dec += "%02x" % ord(c)
         #calculate offset (necessary fot phys to virt translation)
-        found_addr = self.inferior.search_memory(addr, length, pattern_dec)
+        # The search runs on the stub side, which must be in physical mode
+        with self.read_session():
+            self._set_phys_mode(True)
+            found_addr = self.inferior.search_memory(addr, length, pattern_dec)
         if(found_addr != None):
             return found_addr - addr
         return None
@@ -153,11 +314,7 @@ class GdbAddressSpace(addrspace.BaseAddressSpace):
 #        (longval,) = struct.unpack('=I', string)
 #        return longval
         try:
-            gdb.execute('monitor USE_PHYS_MEM')
-            ret = str(gdb.Inferior.read_memory(self.inferior, addr, 4))
-            gdb.execute('monitor USE_VIRT_MEM')
-
-            return ret
+            return self._read_memory(addr, 4)
         except Exception, e:
             return 0
 
@@ -180,6 +337,184 @@ class GdbAddressSpace(addrspace.BaseAddressSpace):
     def __eq__(self, other):
         return self.__class__ == other.__class__ and self.base == other.base and self.fname == other.fname
 
+def _reset_gdb_session(*_args):
+    """Makes sure gdb gets its virtual memory view back before the user does"""
+    GdbAddressSpace.reset_session()
+
+if config.GDB:
+    if hasattr(gdb.events, 'before_prompt'):
+        gdb.events.before_prompt.connect(_reset_gdb_session)
+    # Whatever was read from the target goes stale as soon as it runs
+    gdb.events.cont.connect(addrspace.target_stops.bump)
+    gdb.events.stop.connect(addrspace.target_stops.bump)
+
+
+class GuestRamAddressSpace(addrspace.BaseAddressSpace):
+    """ A physical AS mapping QEMU's guest RAM file straight into memory.
+
+    When QEMU runs with -object memory-backend-file,share=on,mem-path=...
+    all of guest RAM is visible as a host file. Given that file with
+    --guest-ram, memory is read from the mapping without any syscalls
+    or gdb round trips, while gdb (if we run inside it) is still used
+    for registers and execution control.
+
+    Guests with enough RAM have part of it placed at 4GB instead, where
+    the split lies depends on the machine type (--guest-ram-machine) or is
+    given with --guest-ram-below-4g. File offsets past the split are
+    moved up accordingly.
+    """
+    ## Must be tried before the gdb ASes, we only stand in when asked to
+    order = 97
+
+    ## QEMU's (RAM size from which RAM is split, RAM kept below 4GB) by machine type
+    machine_splits = {
+        "pc": (0xe0000000, 0xc0000000),
+        "q35": (0xb0000000, 0x80000000),
+        }
+
+    def __init__(self, base, config, layered = False, **kwargs):
+        addrspace.BaseAddressSpace.__init__(self, base, config, **kwargs)
+        self.as_assert(base == None or layered, 'Must be first Address Space')
+        self.as_assert(config.GUEST_RAM, 'No guest RAM file given')
+
+        path = config.GUEST_RAM
+        if path.startswith("file://"):
+            path = urllib.url2pathname(path[7:])
+        self.as_assert(os.path.exists(path), 'Guest RAM file must exist')
+        self.name = os.path.abspath(path)
+        self.fname = self.name
+
+        if config.WRITE:
+            self.fhandle = open(self.fname, 'rb+')
+            access = mmap.ACCESS_WRITE
+        else:
+            self.fhandle = open(self.fname, 'rb')
+            access = mmap.ACCESS_READ
+        self.map = mmap.mmap(self.fhandle.fileno(), 0, access = access)
+        self.fsize = self.map.size()
+        self.offset = 0
+
+        machine = (config.GUEST_RAM_MACHINE or "pc").lower()
+        self.as_assert(machine in self.machine_splits, 'Unknown guest machine type ' + machine)
+        split_threshold, below_4g = self.machine_splits[machine]
+        if config.GUEST_RAM_BELOW_4G is not None:
+            split_threshold = below_4g = config.GUEST_RAM_BELOW_4G
+        self.below_4g = min(below_4g, self.fsize)
+
+        # (physical start, file offset, length)
+        if self.fsize > self.below_4g and self.fsize >= split_threshold:
+            self.runs = [(0, 0, self.below_4g),
+                         (0x100000000, self.below_4g, self.fsize - self.below_4g)]
+        else:
+            self.below_4g = self.fsize
+            self.runs = [(0, 0, self.fsize)]
+
+    @staticmethod
+    def register_options(config):
+        config.add_option("GUEST-RAM", default = None,
+                          help = "Guest RAM file shared by QEMU's memory-backend-file")
+        config.add_option("GUEST-RAM-MACHINE", default = "pc",
+                          help = "QEMU machine type of the guest (pc or q35), tells where its RAM is split around 4GB")
+        config.add_option("GUEST-RAM-BELOW-4G", type = 'int', default = None,
+                          help = "Bytes of guest RAM below 4GB, the rest being at 4GB (overrides the machine type)")
+
+    def _file_offset(self, addr, length):
+        """Returns the file offset of [addr, addr + length) or None if not inside one run"""
+        for start, foffset, size in self.runs:
+            if start <= addr and addr + length <= start + size:
+                return foffset + addr - start
+        return None
+
+    def read_view(self, addr, length):
+        """Returns a zero-copy buffer over the guest memory, or None"""
+        foffset = self._file_offset(addr, length)
+        if foffset is None:
+            return None
+        return buffer(self.map, foffset, length)
+
+    def read(self, addr, length):
+        foffset = self._file_offset(addr, length)
+        if foffset is None:
+            return self._read_runs(addr, length, pad = False)
+        return self.map[foffset:foffset + length]
+
+    def zread(self, addr, length):
+        foffset = self._file_offset(addr, length)
+        if foffset is None:
+            return self._read_runs(addr, length, pad = True)
+        return self.map[foffset:foffset + length]
+
+    def _read_runs(self, addr, length, pad):
+        """Reads a block crossing run boundaries or the end of RAM"""
+        data = []
+        end = addr + length
+        while addr < end:
+            for start, foffset, size in self.runs:
+                if start <= addr < start + size:
+                    chunk = min(end, start + size) - addr
+                    data.append(self.map[foffset + addr - start:foffset + addr - start + chunk])
+                    break
+            else:
+                if not pad:
+                    return None
+                # Pad up to the next run (or the end of the read)
+                chunk = min([start - addr for start, _, _ in self.runs if start > addr] + [end - addr])
+                data.append('\x00' * chunk)
+            addr += chunk
+        return ''.join(data)
+
+    def read_long(self, addr):
+        string = self.read(addr, 4)
+        (longval,) = struct.unpack('=I', string)
+        return longval
+
+    def find_offset(self, addr, length, pattern):
+        end = addr + length
+        for start, foffset, size in self.runs:
+            lo = max(addr, start)
+            hi = min(end, start + size)
+            if lo >= hi:
+                continue
+            found = self.map.find(str(pattern), foffset + lo - start, foffset + hi - start)
+            if found >= 0:
+                return found - foffset + start - addr
+        return None
+
+    def find(self, addr, length, pattern):
+        ret = self.find_offset(addr, length, pattern)
+        if ret != None:
+            ret = ret + addr
+        return ret
+
+    def get_available_addresses(self):
+        for start, _foffset, size in self.runs:
+            yield (start, size)
+
+    def get_generation(self):
+        # The file is guest RAM itself, it changes whenever the guest runs
+        return addrspace.target_stops.value
+
+    def is_valid_address(self, addr):
+        if addr == None:
+            return False
+        return self._file_offset(addr, 1) is not None
+
+    def close(self):
+        self.map.close()
+        self.fhandle.close()
+
+    def write(self, addr, data):
+        if not self._config.WRITE:
+            return False
+        foffset = self._file_offset(addr, len(data))
+        if foffset is None:
+            return False
+        self.map[foffset:foffset + len(data)] = data
+        return True
+
+    def __eq__(self, other):
+        return self.__class__ == other.__class__ and self.base == other.base and self.fname == other.fname
+
 
 class FileAddressSpace(addrspace.BaseAddressSpace):
     """ This is a direct file AS.
@@ -228,6 +563,9 @@ class FileAddressSpace(addrspace.BaseAddressSpace):
     def zread(self, addr, length):
         return self.read(addr, length)
 
+    def read_many(self, requests):
+        return self._read_coalesced(requests)
+
     def read_long(self, addr):
         string = self.read(addr, 4)
         (longval,) = struct.unpack('=I', string)
@@ -270,6 +608,42 @@ class AbstractPagedMemory(addrspace.AbstractVirtualAddressSpace):
         """Abstract function that converts virtual (paged) addresses to physical addresses"""
         pass
 
+    def vtop_page(self, addr):
+        """Returns (paddr, page_size) for the page holding addr, paddr is None if unmapped
+
+        Spaces with large pages override this so that whole large pages
+        can be handled at once.
+        """
+        return self.vtop(addr), 0x1000
+
+    def translate_range(self, vaddr, length):
+        """A generator that returns (vaddr, paddr, length) runs covering a virtual range
+
+        Each run is contiguous in both virtual and physical memory.
+        Unmapped parts of the range are left out, so callers spot holes
+        by the gaps between runs.
+        """
+        vaddr, length = int(vaddr), int(length)
+        end = vaddr + length
+        run_vaddr = run_paddr = None
+        run_length = 0
+        while vaddr < end:
+            paddr, page_size = self.vtop_page(vaddr)
+            chunk_len = min(end - vaddr, page_size - (vaddr % page_size))
+            if paddr is None:
+                if run_length:
+                    yield (run_vaddr, run_paddr, run_length)
+                    run_length = 0
+            elif run_length and run_paddr + run_length == paddr:
+                run_length += chunk_len
+            else:
+                if run_length:
+                    yield (run_vaddr, run_paddr, run_length)
+                run_vaddr, run_paddr, run_length = vaddr, paddr, chunk_len
+            vaddr += chunk_len
+        if run_length:
+            yield (run_vaddr, run_paddr, run_length)
+
     def get_available_pages(self):
         """A generator that returns (addr, size) for each of the virtual addresses present, sorted by offset"""
         pass
@@ -297,13 +671,48 @@ class AbstractPagedMemory(addrspace.AbstractVirtualAddressSpace):
         """Returns whether a virtual address is valid"""
         if vaddr == None:
             return False
-        try:
-            paddr = self.vtop(vaddr)
-        except BaseException:
-            return False
-        if paddr == None:
-            return False
-        return self.base.is_valid_address(paddr)
+        with self.read_session():
+            try:
+                paddr = self.vtop(vaddr)
+            except BaseException:
+                return False
+            if paddr == None:
+                return False
+            return self.base.is_valid_address(paddr)
+
+    def read_many(self, requests):
+        """ Reads a batch of (vaddr, length) requests.
+
+            Every request is translated into its physical runs, and all
+            runs are handed to the base AS in one read_many call so it can
+            coalesce them. A request comes back as None if any part of it
+            is not mapped or cannot be read.
+        """
+        pieces = []
+        owners = []
+        with self.read_session():
+            for vaddr, length in requests:
+                members = []
+                position = vaddr = int(vaddr)
+                for run_vaddr, run_paddr, run_len in self.translate_range(vaddr, length):
+                    if run_vaddr != position:
+                        break
+                    members.append(len(pieces))
+                    pieces.append((run_paddr, run_len))
+                    position += run_len
+                if position != vaddr + int(length):
+                    members = None
+                owners.append(members)
+
+            data = self.base.read_many(pieces)
+
+        results = []
+        for members in owners:
+            if members is None or [i for i in members if data[i] is None]:
+                results.append(None)
+            else:
+                results.append(''.join([data[i] for i in members]))
+        return results
 
 
 class AbstractWritablePagedMemory(AbstractPagedMemory):
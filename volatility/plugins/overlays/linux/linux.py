@@ -33,6 +33,7 @@ import volatility.plugins.overlays.basic as basic
 import volatility.plugins.overlays.native_types as native_types
 import volatility.exceptions as exceptions
 import volatility.obj as obj
+import volatility.addrspace as addrspace
 import volatility.debug as debug
 import volatility.dwarf as dwarf
 
@@ -596,8 +597,7 @@ class task_struct(obj.CType):
         directory_table_base = self.obj_vm.vtop(self.mm.pgd.v())
 
         try:
-            process_as = self.obj_vm.__class__(
-                self.obj_vm.base, self.obj_vm.get_config(), dtb = directory_table_base)
+            process_as = addrspace.dtb_spaces.get(self.obj_vm, directory_table_base)
 
         except AssertionError, _e:
             return obj.NoneObject("Unable to get process AS")
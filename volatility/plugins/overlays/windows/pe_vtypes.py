@@ -77,47 +77,94 @@ class _IMAGE_EXPORT_DIRECTORY(obj.CType):
                       offset = self.obj_parent.DllBase + name_rva,
                       vm = self.obj_native_vm, length = 128)
 
-    def _exported_functions(self):
+    def _names(self, name_rvas):
         """
-        Generator for exported functions.
+        Return a dict mapping each name RVA to the name's string.
 
-        @return: tuple (Ordinal, FunctionRVA, Name)
+        The names of an export directory are usually packed together, so
+        rather than reading each one separately (see _name), every run of
+        names is read in one batch. Names starting in a paged region map
+        to None. The 128 character limit of _name applies here too. 
+        """
+        mod_base = self.obj_parent.DllBase.v()
+        names = {}
+
+        # Group the names into runs with no more than a page between them
+        runs = []
+        for rva in sorted(set(name_rvas)):
+            if runs and rva - runs[-1][-1] <= 0x1000:
+                runs[-1].append(rva)
+            else:
+                runs.append([rva])
+
+        for run in runs:
+            start = run[0]
+            region = obj.Object('Array', offset = mod_base + start,
+                                targetType = 'unsigned char',
+                                count = run[-1] - start + 128,
+                                vm = self.obj_native_vm)
+            data, holes = region.read_elements()
+
+            for rva in run:
+                offset = rva - start
+                paged = False
+                for hole_start, hole_length in holes:
+                    if hole_start <= offset < hole_start + hole_length:
+                        paged = True
+                        break
+                if paged:
+                    names[rva] = None
+                else:
+                    names[rva] = data[offset:offset + 128].split('\x00', 1)[0]
+
+        return names
+
+    def _export_entries(self):
+        """
+        Generator for the raw export table entries.
 
-        Ordinal is an integer and should never be None. If the function 
-        is forwarded, FunctionRVA is None. Otherwise, FunctionRVA is an
-        RVA to the function's code (relative to module base). Name is a
-        String containing the exported function's name. If the Name is 
-        paged, it will be None. If the function is forwarded, Name is the
-        forwarded function name including the DLL (ntdll.EtwLogTraceEvent). 
+        @return: tuple (Ordinal, FunctionRVA, NameRVA)
+
+        This follows the rules of _exported_functions, but gives the RVA
+        of the name instead of a String. If the function is forwarded,
+        FunctionRVA is None and NameRVA points to the forwarded name. If
+        the function is only exported by ordinal, NameRVA is None. 
         """
 
         mod_base = self.obj_parent.DllBase
         exp_dir = self.obj_parent.export_dir()
 
+        number_of_functions = int(self.NumberOfFunctions)
+        number_of_names = int(self.NumberOfNames)
+        ordinal_base = int(self.Base)
+        forward_start = int(exp_dir.VirtualAddress)
+        forward_end = forward_start + int(exp_dir.Size)
+
         # PE files with a large number of functions will have arrays
         # that spans multiple pages. Thus the first entries may be valid, 
         # last entries may be valid, but middle entries may be invalid
         # (paged). In the various checks below, we test for None (paged)
-        # and zero (non-paged but invalid RVA). 
+        # and zero (non-paged but invalid RVA). Each array is decoded 
+        # in bulk, with paged entries coming back as None. 
 
         # Array of RVAs to function code 
         address_of_functions = obj.Object('Array',
                                     offset = mod_base + self.AddressOfFunctions,
                                     targetType = 'unsigned int',
-                                    count = self.NumberOfFunctions,
-                                    vm = self.obj_native_vm)
+                                    count = number_of_functions,
+                                    vm = self.obj_native_vm).values()
         # Array of RVAs to function names 
         address_of_names = obj.Object('Array',
                                     offset = mod_base + self.AddressOfNames,
                                     targetType = 'unsigned int',
-                                    count = self.NumberOfNames,
-                                    vm = self.obj_native_vm)
+                                    count = number_of_names,
+                                    vm = self.obj_native_vm).values()
         # Array of RVAs to function ordinals 
         address_of_name_ordinals = obj.Object('Array',
                                     offset = mod_base + self.AddressOfNameOrdinals,
                                     targetType = 'unsigned short',
-                                    count = self.NumberOfNames,
-                                    vm = self.obj_native_vm)
+                                    count = number_of_names,
+                                    vm = self.obj_native_vm).values()
 
         # When functions are exported by Name, it will increase
         # NumberOfNames by 1 and NumberOfFunctions by 1. When 
@@ -126,10 +173,10 @@ class _IMAGE_EXPORT_DIRECTORY(obj.CType):
         # and track their corresponding Ordinals, so that when we enum
         # functions exported by Ordinal only, we don't duplicate. 
 
-        seen_ordinals = []
+        seen_ordinals = set()
 
         # Handle functions exported by name *and* ordinal 
-        for i in range(self.NumberOfNames):
+        for i in range(number_of_names):
 
             name_rva = address_of_names[i]
             ordinal = address_of_name_ordinals[i]
@@ -138,7 +185,7 @@ class _IMAGE_EXPORT_DIRECTORY(obj.CType):
                 continue
 
             # Check the sanity of ordinal values before using it as an index
-            if ordinal == None or ordinal >= self.NumberOfFunctions:
+            if ordinal == None or ordinal >= number_of_functions:
                 continue
 
             func_rva = address_of_functions[ordinal]
@@ -151,24 +198,20 @@ class _IMAGE_EXPORT_DIRECTORY(obj.CType):
             # DataDirectory), the symbol is forwarded. Return the name of the 
             # forwarded function and None as the function address. 
 
-            if (func_rva >= exp_dir.VirtualAddress and
-                    func_rva < exp_dir.VirtualAddress + exp_dir.Size):
-                n = self._name(func_rva)
-                f = obj.NoneObject("This function is forwarded")
-            else:
-                n = self._name(name_rva)
-                f = func_rva
+            if forward_start <= func_rva < forward_end:
+                name_rva = func_rva
+                func_rva = None
 
             # Add the ordinal base and save it 
-            ordinal += self.Base
-            seen_ordinals.append(ordinal)
+            ordinal += ordinal_base
+            seen_ordinals.add(ordinal)
 
-            yield ordinal, f, n
+            yield ordinal, func_rva, name_rva
 
         # Handle functions exported by ordinal only 
-        for i in range(self.NumberOfFunctions):
+        for i in range(number_of_functions):
 
-            ordinal = self.Base + i
+            ordinal = ordinal_base + i
 
             # Skip functions already enumberated above 
             if ordinal not in seen_ordinals:
@@ -178,10 +221,50 @@ class _IMAGE_EXPORT_DIRECTORY(obj.CType):
                 if func_rva in (0, None):
                     continue
 
-                seen_ordinals.append(ordinal)
+                seen_ordinals.add(ordinal)
 
                 # There is no name RVA 
-                yield ordinal, func_rva, obj.NoneObject("Name RVA not accessible")
+                yield ordinal, func_rva, None
+
+    def _exported_functions(self):
+        """
+        Generator for exported functions.
+
+        @return: tuple (Ordinal, FunctionRVA, Name)
+
+        Ordinal is an integer and should never be None. If the function 
+        is forwarded, FunctionRVA is None. Otherwise, FunctionRVA is an
+        RVA to the function's code (relative to module base). Name is a
+        String containing the exported function's name. If the Name is 
+        paged, it will be None. If the function is forwarded, Name is the
+        forwarded function name including the DLL (ntdll.EtwLogTraceEvent). 
+        """
+
+        for ordinal, func_rva, name_rva in self._export_entries():
+            if func_rva == None:
+                func_rva = obj.NoneObject("This function is forwarded")
+            if name_rva == None:
+                name = obj.NoneObject("Name RVA not accessible")
+            else:
+                name = self._name(name_rva)
+            yield ordinal, func_rva, name
+
+    def export_symbols(self):
+        """
+        Generator for exported functions with plain values.
+
+        @return: tuple (Ordinal, FunctionRVA, Name)
+
+        Like _exported_functions, except that FunctionRVA is None for 
+        forwarded functions and Name is a str (or None when it has no
+        name or it is paged). All the names are read in bulk. 
+        """
+
+        entries = list(self._export_entries())
+        names = self._names([name_rva for _, _, name_rva in entries if name_rva != None])
+
+        for ordinal, func_rva, name_rva in entries:
+            yield ordinal, func_rva, names.get(name_rva)
 
 class _IMAGE_IMPORT_DESCRIPTOR(obj.CType):
     """Handles IID entries for imported functions"""
@@ -226,15 +309,15 @@ class _IMAGE_IMPORT_DESCRIPTOR(obj.CType):
         is paged, then FunctionVA will be None. 
         """
 
-        i = 0
-        while 1:
-            thunk = obj.Object('_IMAGE_THUNK_DATA',
-                       offset = self.obj_parent.DllBase + self.OriginalFirstThunk +
-                       i * self.obj_vm.profile.get_obj_size('_IMAGE_THUNK_DATA'),
-                       vm = self.obj_native_vm)
+        thunk_size = self.obj_vm.profile.get_obj_size('_IMAGE_THUNK_DATA')
+        ordinal_bit = 1 << (thunk_size * 8 - 1)
+
+        first_thunks = self._thunks(self.FirstThunk, thunk_size)
+
+        for thunk in self._thunks(self.OriginalFirstThunk, thunk_size):
 
             # We've reached the end when the element is zero 
-            if thunk == None or thunk.AddressOfData == 0:
+            if thunk == None or thunk == 0:
                 break
 
             o = obj.NoneObject("Ordinal not accessible?")
@@ -245,26 +328,37 @@ class _IMAGE_IMPORT_DESCRIPTOR(obj.CType):
             # imported by ordinal and the lowest 16-bits contain the ordinal value. 
             # Otherwise, the lowest bits (0-31 for x86 and 0-63 for x64) contain an 
             # RVA to an _IMAGE_IMPORT_BY_NAME struct. 
-            if thunk.OrdinalBit == 1:
-                o = thunk.Ordinal & 0xFFFF
+            if thunk & ordinal_bit:
+                o = thunk & 0xFFFF
             else:
                 iibn = obj.Object("_IMAGE_IMPORT_BY_NAME",
-                                  offset = self.obj_parent.DllBase +
-                                  thunk.AddressOfData,
+                                  offset = self.obj_parent.DllBase + thunk,
                                   vm = self.obj_native_vm)
                 o = iibn.Hint
                 n = iibn.Name
 
             # See if the import is bound (i.e. resolved)
-            first_thunk = obj.Object('_IMAGE_THUNK_DATA',
-                            offset = self.obj_parent.DllBase + self.FirstThunk +
-                            i * self.obj_vm.profile.get_obj_size('_IMAGE_THUNK_DATA'),
-                            vm = self.obj_native_vm)
-            if first_thunk:
-                f = first_thunk.Function.v()
+            first_thunk = first_thunks.next()
+            if first_thunk != None:
+                f = first_thunk & 0xffffffffffff
 
             yield o, f, n
-            i += 1
+
+    def _thunks(self, rva, thunk_size):
+        """Yields the _IMAGE_THUNK_DATA values of a thunk array at rva.
+
+        The thunks are decoded a page worth at a time. Paged thunks are
+        yielded as None, the generator never ends on its own. 
+        """
+        target = {4: 'unsigned int', 8: 'unsigned long long'}[thunk_size]
+        count = 0x1000 / thunk_size
+        offset = self.obj_parent.DllBase + rva
+        while 1:
+            block = obj.Object('Array', offset = offset, targetType = target,
+                               count = count, vm = self.obj_native_vm)
+            for value in block.values():
+                yield value
+            offset += count * thunk_size
 
     def is_list_end(self):
         """Returns True if we've reached the list end"""
@@ -386,6 +480,50 @@ class _LDR_DATA_TABLE_ENTRY(obj.CType):
             for o, f, n in expdir._exported_functions():
                 yield o, f, n
 
+    def export_symbols(self):
+        """Returns a list of the PE's exported functions as plain values
+
+        See _IMAGE_EXPORT_DIRECTORY.export_symbols. Unlike exports(), the
+        export table is parsed right away. 
+        """
+
+        try:
+            data_dir = self.export_dir()
+        except ValueError:
+            return []
+
+        expdir = obj.Object('_IMAGE_EXPORT_DIRECTORY',
+                            offset = self.DllBase + data_dir.VirtualAddress,
+                            vm = self.obj_native_vm,
+                            parent = self)
+
+        if not expdir.valid(self._nt_header()):
+            return []
+
+        return list(expdir.export_symbols())
+
+    def export_name_count(self):
+        """Returns the number of functions the PE exports by name
+
+        This is 0 if the PE has no export directory, and None if the
+        directory can not be read. 
+        """
+
+        try:
+            data_dir = self.export_dir()
+        except ValueError:
+            return 0
+
+        expdir = obj.Object('_IMAGE_EXPORT_DIRECTORY',
+                            offset = self.DllBase + data_dir.VirtualAddress,
+                            vm = self.obj_native_vm,
+                            parent = self)
+
+        if not expdir.valid(self._nt_header()):
+            return None
+
+        return int(expdir.NumberOfNames)
+
 class WinPEVTypes(obj.ProfileModification):
     before = ['WindowsOverlay']
     conditions = {'os': lambda x : x == 'windows'}
@@ -199,6 +199,12 @@ class _UNICODE_STRING(obj.CType):
 class _LIST_ENTRY(obj.CType):
     """ Adds iterators for _LIST_ENTRY types """
     def list_of_type(self, type, member, forward = True, head_sentinel = True):
+        """ Yields the type structs linked through their member list entry.
+
+            The address of each element is only known once the link of the
+            one before it was read, so the walk can not be batched with
+            read_many; each element is read as it is reached.
+        """
         if not self.is_valid():
             return
 
@@ -323,7 +329,7 @@ class _EPROCESS(obj.CType):
         directory_table_base = self.Pcb.DirectoryTableBase.v()
 
         try:
-            process_as = self.obj_vm.__class__(self.obj_vm.base, self.obj_vm.get_config(), dtb = directory_table_base)
+            process_as = addrspace.dtb_spaces.get(self.obj_vm, directory_table_base)
         except AssertionError, _e:
             return obj.NoneObject("Unable to get process AS")
 
@@ -423,42 +429,55 @@ class _HANDLE_TABLE(obj.CType):
         table = obj.Object("Array", offset = offset, vm = self.obj_vm, count = count,
                            targetType = targetType, parent = self, native_vm = self.obj_native_vm)
 
-        if table:
-            for entry in table:
-                if not entry.is_valid():
+        if not table:
+            return
+
+        if level > 0:
+            # The pointers to the next level are decoded in bulk
+            for pointer in table.values():
+                if pointer is None:
                     break
 
-                if level > 0:
-                    ## We need to go deeper:
-                    for h in self._make_handle_array(entry, level - 1, depth):
-                        yield h
-                    depth += 1
-                else:
+                ## We need to go deeper:
+                for h in self._make_handle_array(pointer, level - 1, depth):
+                    yield h
+                depth += 1
+            return
 
-                    # All handle values are multiples of four, on both x86 and x64. 
-                    handle_multiplier = 4
-                    # Calculate the starting handle value for this level. 
-                    handle_level_base = depth * count * handle_multiplier
-                    # The size of a handle table entry.
-                    handle_entry_size = self.obj_vm.profile.get_obj_size("_HANDLE_TABLE_ENTRY")
-                    # Finally, compute the handle value for this object. 
-                    handle_value = ((entry.obj_offset - offset) /
-                                   (handle_entry_size / handle_multiplier)) + handle_level_base
-
-                    ## OK We got to the bottom table, we just resolve
-                    ## objects here:
-                    item = self.get_item(entry, handle_value)
-
-                    if item == None:
-                        continue
-
-                    try:
-                        # New object header
-                        if item.TypeIndex != 0x0:
-                            yield item
-                    except AttributeError:
-                        if item.Type.Name:
-                            yield item
+        # Read the whole table at once and decode the entries from that
+        # copy, up to the first unreadable one
+        handle_entry_size = self.obj_vm.profile.get_obj_size("_HANDLE_TABLE_ENTRY")
+        data, holes = table.read_elements()
+        readable = count
+        if holes:
+            readable = min(count, holes[0][0] / handle_entry_size)
+        table = obj.Object("Array", offset = offset, vm = obj.SnapshotVM(self.obj_vm, offset, data),
+                           count = readable, targetType = targetType, parent = self,
+                           native_vm = self.obj_native_vm)
+
+        for entry in table:
+            # All handle values are multiples of four, on both x86 and x64. 
+            handle_multiplier = 4
+            # Calculate the starting handle value for this level. 
+            handle_level_base = depth * count * handle_multiplier
+            # Finally, compute the handle value for this object. 
+            handle_value = ((entry.obj_offset - offset) /
+                           (handle_entry_size / handle_multiplier)) + handle_level_base
+
+            ## OK We got to the bottom table, we just resolve
+            ## objects here:
+            item = self.get_item(entry, handle_value)
+
+            if item == None:
+                continue
+
+            try:
+                # New object header
+                if item.TypeIndex != 0x0:
+                    yield item
+            except AttributeError:
+                if item.Type.Name:
+                    yield item
 
     def handles(self):
         """ A generator which yields this process's handles
@@ -586,9 +605,10 @@ class _MMVAD(obj.CType):
         ## specialist methods to the _MMVAD class.
 
         ## We must not polute Object's constructor by providing the
-        ## members or struct_size we were instantiated with
+        ## members, struct_size or layout we were instantiated with
         args.pop('struct_size', None)
         args.pop('members', None)
+        args.pop('layout', None)
 
         # Start off with an _MMVAD_LONG
         result = obj.Object('_MMVAD_LONG', offset = offset, vm = vm, parent = parent, **args)
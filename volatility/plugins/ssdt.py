@@ -183,16 +183,21 @@ class SSDT(common.AbstractWindowsCommand):
         # Print out the entries for each table
         for idx, table, n, vm, mods, mod_addrs in data:
             outfd.write("SSDT[{0}] at {1:x} with {2} entries\n".format(idx, table, n))
-            for i in range(n):
-                if bits32:
-                    # These are absolute function addresses in kernel memory. 
-                    syscall_addr = obj.Object('address', table + (i * 4), vm).v()
+            if bits32:
+                # These are absolute function addresses in kernel memory. 
+                entries = obj.Object('Array', table, vm, targetType = 'address', count = n)
+            else:
+                # These must be signed long for x64 because they are RVAs relative
+                # to the base of the table and can be negative. 
+                entries = obj.Object('Array', table, vm, targetType = 'long', count = n)
+            for i, entry in enumerate(entries.values()):
+                if entry == None:
+                    syscall_addr = obj.NoneObject("Unable to read SSDT entry {0}".format(i))
+                elif bits32:
+                    syscall_addr = entry
                 else:
-                    # These must be signed long for x64 because they are RVAs relative
-                    # to the base of the table and can be negative. 
-                    offset = obj.Object('long', table + (i * 4), vm).v()
                     # The offset is the top 20 bits of the 32 bit number. 
-                    syscall_addr = table + (offset >> 4)
+                    syscall_addr = table + (entry >> 4)
                 try:
                     syscall_name = syscalls[idx][i]
                 except IndexError:
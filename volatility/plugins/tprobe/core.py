@@ -29,6 +29,7 @@ import volatility.commands as commands
 import volatility.utils as utils
 import volatility.obj as obj
 import volatility.conf as conf
+import volatility.plugins.tprobe.symbols as symbols
 cfg = conf.ConfObject()
 
 # temporary debug
@@ -52,45 +53,103 @@ class Breakpoint(object):
         self.cond = cond
 
 class BptIndex(object):
+    """ The breakpoints set in gdb, by address.
+
+    Breakpoints are managed through gdb's Python API rather than by
+    running 'info break' and parsing its output after every change.
+    bpts maps each address to a dict of the Breakpoint records at that
+    address by breakpoint number. It is updated in place on every
+    change, including breakpoints created or deleted from the gdb
+    prompt, when this gdb reports breakpoint events. gdb's internal
+    breakpoints (eg. the temporary ones nb runs to) are left out.
+    """
     def __init__(self):
         self.bpts = {}
+        self.batching = False
         self.readBpts()
-        
+        if hasattr(gdb.events, "breakpoint_created"):
+            gdb.events.breakpoint_created.connect(self._track)
+            gdb.events.breakpoint_modified.connect(self._track)
+            gdb.events.breakpoint_deleted.connect(self._untrack)
+
+    @staticmethod
+    def _address(gdb_bp):
+        """Returns the address of a breakpoint set as *address, or None"""
+        location = gdb_bp.location or ''
+        if not location.startswith('*'):
+            return None
+        try:
+            return int(location[1:], 0)
+        except ValueError:
+            return None
+
+    def _record(self, gdb_bp):
+        """Returns the Breakpoint record of a user breakpoint set as *address, or None"""
+        if gdb_bp.number < 0 or not getattr(gdb_bp, 'visible', True):
+            return None
+        address = self._address(gdb_bp)
+        if address is None:
+            return None
+        bp = Breakpoint(address = address, num = gdb_bp.number, type = 'breakpoint',
+                        disp = 'del' if gdb_bp.temporary else 'keep',
+                        enb = 'y' if gdb_bp.enabled else 'n', cond = gdb_bp.condition)
+        bp.gdb_bp = gdb_bp
+        return bp
+
+    def _index(self, records):
+        for bp in records:
+            if bp is not None:
+                self.bpts.setdefault(bp.address, {})[bp.num] = bp
+
+    def _track(self, gdb_bp):
+        # addBpts indexes its own breakpoints once they are all set
+        if self.batching:
+            return None
+        bp = self._record(gdb_bp)
+        self._index([bp])
+        return bp
+
+    def _untrack(self, gdb_bp):
+        address = self._address(gdb_bp)
+        at_address = self.bpts.get(address)
+        if at_address is not None:
+            at_address.pop(gdb_bp.number, None)
+            if not at_address:
+                del self.bpts[address]
+
+    def __contains__(self, address):
+        return address in self.bpts
+
     def addBpt(self, bp, dtb=None):
-        if(dtb is None): 
-            gdb.execute('b *{0}'.format(bp.address),False, True)
-        else:
-            gdb.execute('b *{0} if $cr3=={1}'.format(bp.address, dtb),False, True)
-        self.readBpts()
+        return self.addBpts([bp], dtb)[0]
+
+    def addBpts(self, bps, dtb=None):
+        """Sets a batch of breakpoints, updating the index once at the end"""
+        gdb_bps = []
+        self.batching = True
+        try:
+            for bp in bps:
+                gdb_bp = gdb.Breakpoint('*{0}'.format(bp.address))
+                if(dtb is not None):
+                    gdb_bp.condition = '$cr3=={0}'.format(dtb)
+                gdb_bps.append(gdb_bp)
+        finally:
+            self.batching = False
+            records = [self._record(gdb_bp) for gdb_bp in gdb_bps]
+            self._index(records)
+        return records
 
     def delBpt(self, address):
-        bpt = self.bpts["0x%08x" % address]
-        gdb.execute('del {0}'.format(bpt.num),False, True)
-        self.readBpts()
+        """Deletes all the breakpoints at address"""
+        for bp in self.bpts.pop(address, {}).values():
+            if bp.gdb_bp.is_valid():
+                bp.gdb_bp.delete()
 
     def readBpts(self):
+        """Rebuilds the index from all the breakpoints gdb has"""
         self.bpts = {}
-        data = gdb.execute("info break", False, True)
-        if(data == None): return
-
-        bp = Breakpoint()
-        for line in data.split("\n"):
-            print line
-            if(line.find("No breakpoints")>=0): return
-            if(len(line) >0):
-                if(line[0] != "\t"):
-                    if(bp.num != None and bp.num != "Num"):
-#                        self.addBpt(bp, False, True)
-                        self.bpts[bp.address] = bp
-                    try:
-                        bp.num, bp.type, bp.disp, bp.enb, bp.address, bp.what = line.split()
-                    except:
-                        bp.num, bp.type, bp.disp, bp.enb, bp.address = line.split()
-                else:
-                    cond = line.find("stop")
-                    if(cond <0): cond = None
-                    bp.cond = cond
-        self.bpts[bp.address] = bp
+        self._index([self._record(gdb_bp) for gdb_bp in gdb.breakpoints() or ()
+                     if gdb_bp.type == gdb.BP_BREAKPOINT])
 
 class TProbeVolatilityDTB(obj.VolatilityMagic):
     def generate_suggestions(self):
@@ -312,10 +371,13 @@ class tprobe(commands.Command):
         self.config = config
         self.current_EPROCESS = None
 
-        self.symbols_by_name = {}
-        self.symbols_by_offset = {}
-        self.kernel_symbols_by_name = {}
-        self.kernel_symbols_by_offset = {}
+        self.symbol_store = None
+        target_symbols = symbols.SymbolTable()
+        kernel_symbols = symbols.SymbolTable()
+        self.symbols_by_name = target_symbols.by_name
+        self.symbols_by_offset = target_symbols.by_offset
+        self.kernel_symbols_by_name = kernel_symbols.by_name
+        self.kernel_symbols_by_offset = kernel_symbols.by_offset
         self.current_modules = {}
         self.current_symbols = {}
 
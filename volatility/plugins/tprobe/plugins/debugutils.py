@@ -1,9 +1,15 @@
 import volatility.plugins.tprobe.core as tprobe
 import volatility.utils as utils
 import volatility.obj as obj
+import volatility.plugins.addrspaces.standard as standard
+import volatility.plugins.tprobe.symbols as symbols
+import volatility.plugins.tprobe.trace as trace
 import struct
+import hashlib
+import collections
 import gdb
 import sys
+import os
 import distorm3
 from volatility.plugins.tprobe.core import Breakpoint
 
@@ -12,6 +18,57 @@ import pickle
 def get_reg(reg):
     return (reg, int(gdb.execute('info register {0}'.format(reg),False, True).split('\t')[0].split(' ')[-1],0))
 
+class RegisterSnapshot(object):
+    """ The registers of the target at one stop.
+
+    The general, segment, flag and control registers are all read when
+    the snapshot is taken, from the selected frame (or, on a gdb without
+    Frame.read_register, by parsing one 'info registers'). This replaces
+    an 'info register' command and the parsing of its output for every
+    single register. Other registers are read on first use.
+    """
+    prefetch = ["eax", "ebx", "ecx", "edx", "edi", "esi", "ebp", "esp", "eip", "eflags",
+                "cs", "ss", "ds", "es", "fs", "gs", "cr0", "cr2", "cr3", "cr4"]
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.values = {}
+        try:
+            self.frame = gdb.selected_frame()
+        except gdb.error:
+            self.frame = None
+
+        if self.frame is not None and hasattr(self.frame, "read_register"):
+            for name in self.prefetch:
+                value = self._from_frame(name)
+                if value is not None:
+                    self.values[name] = value
+        else:
+            self._from_info(gdb.execute('info registers', False, True))
+
+    def _from_frame(self, name):
+        try:
+            value = self.frame.read_register(name)
+            return int(value) & ((1 << (8 * value.type.sizeof)) - 1)
+        except (ValueError, gdb.error):
+            return None
+
+    def _from_info(self, text):
+        for line in text.splitlines():
+            fields = line.split()
+            if len(fields) >= 2 and fields[1].startswith("0x"):
+                self.values[fields[0]] = int(fields[1], 16)
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            value = None
+            if self.frame is not None and hasattr(self.frame, "read_register"):
+                value = self._from_frame(name)
+            if value is None:
+                value = get_reg(name)[1]
+            self.values[name] = value
+        return self.values[name]
+
 class ViewRegisters(tprobe.AbstractTProbePlugin):
     name = 'regs'
 
@@ -83,7 +140,7 @@ class ViewRegisters4(tprobe.AbstractTProbePlugin):
     def calculate(self):
         regs = []
         for reg in ["cr3"]:
-            regs.append(get_reg(reg))
+            regs.append((reg, self.functions.gr.calculate(reg)))
         return regs
 
     def render_text(self, regs):
@@ -91,10 +148,34 @@ class ViewRegisters4(tprobe.AbstractTProbePlugin):
             print("%s: 0x%08x" % (reg[0], reg[1]))
 
 class GetRegister(tprobe.AbstractTProbeApiFunction):
+    """ Reads registers from a snapshot shared by all the commands.
+
+    The snapshot is dropped whenever gdb reports the target resumed or
+    stopped or a register written (eg. 'set $eax=1'), and a new one taken
+    once the generation of the address space changed. Call invalidate()
+    after changing registers behind gdb's back.
+    """
     name = 'gr'
 
+    def __init__(self, *args, **kwargs):
+        tprobe.AbstractTProbeApiFunction.__init__(self, *args, **kwargs)
+        self.current = None
+        for event in ["stop", "cont", "register_changed"]:
+            if hasattr(gdb.events, event):
+                getattr(gdb.events, event).connect(self.invalidate)
+
+    def snapshot(self):
+        """Returns the RegisterSnapshot of the current stop"""
+        generation = self.core.addrspace.get_generation()
+        if self.current is None or self.current.generation != generation:
+            self.current = RegisterSnapshot(generation)
+        return self.current
+
+    def invalidate(self, *_args):
+        self.current = None
+
     def calculate(self, regname):
-        return int(gdb.execute('info register {0}'.format(regname),False, True).split('\t')[0].split(' ')[-1],0)
+        return self.snapshot()[regname]
 
 class SetBpDtb(tprobe.AbstractTProbeApiFunction):
     name = 'bd'
@@ -122,24 +203,49 @@ class StackUnwind(tprobe.AbstractTProbePlugin):
 
     def render_text(self, stack_entries):
         for entry in stack_entries:
-            print("0x%08x" % entry)
+            target = self.core.symbols_by_offset.symbolize(entry)
+            if(target is not None):
+                print("0x%08x %s" % (entry, target))
+            else:
+                print("0x%08x" % entry)
 
 class Continue(tprobe.AbstractTProbePlugin):
     name = 'c'
 
     def calculate(self, location=None, dtb = None):
         gdb.execute('c',False, True)
+        standard.GdbAddressSpace.invalidate_cache()
 
 class LoadBpList(tprobe.AbstractTProbePlugin):
     name = 'bpl'
 
     def calculate(self, path, eproc):
+        if(isinstance(eproc, int)):
+            dtb = self.functions.e2d.calculate(eproc)
+        else:
+            dtb = self.functions.e2d.calculate(eproc.v())
+
+        # Resolve the whole list first, then set the breakpoints in a batch
+        bps = []
         f = open(path, "r")
         for bp in f.readlines():
-            print("Setting bp on: %s" % bp[:-1])
-            self.core.functions.b.calculate(bp[:-1], eproc)
+            location = bp.strip()
+            if not location:
+                continue
+            try:
+                address = self.core.symbols_by_name[location]
+            except KeyError:
+                try:
+                    address = int(location, 0)
+                except ValueError:
+                    print("No symbol found: %s" % location)
+                    continue
+            print("Setting bp on: %s" % location)
+            bps.append(Breakpoint(address))
         f.close()
 
+        self.core.bp_index.addBpts(bps, dtb)
+
 class SetSystemWideBp(tprobe.AbstractTProbePlugin):
     name = 'swb'
 
@@ -273,6 +379,7 @@ class WaitForRet(tprobe.AbstractTProbePlugin):
 
     def calculate(self):
         gdb.execute('finish')
+        standard.GdbAddressSpace.invalidate_cache()
         return
 
     def render_text(self):
@@ -280,18 +387,13 @@ class WaitForRet(tprobe.AbstractTProbePlugin):
 
 class WaitForRetScan(tprobe.AbstractTProbePlugin):
     name = 'retWaitScan'
+    dependencies = ['nb']
 
     def calculate(self):
-        import time
-        while True:
-            opcode = gdb.execute('x/bx $eip', False, True).split('\t')[1].strip()
-            if(opcode in ['0xc2', '0xc3']):
-                break
-            if(opcode in ['0xe8', '0x9a', '0xff']):
-                self.core.functions.ni()
-            else:
-                self.core.functions.ni()
-        gdb.execute('si')
+        if self.core.functions.nb.run_to_ret():
+            self.core.functions.si()
+        else:
+            self.core.functions.uce.calculate()
         return
 
     def render_text(self):
@@ -479,20 +581,12 @@ class ReloadTargetSymbols(tprobe.AbstractTProbePlugin):
     name = 'reload_target_symbols'
 
     def calculate(self, eproc):
-        symbols_by_name = {}
-        symbols_by_offset = {}
-        print("Resolving symbols, patience")
-        for mod in self.core.functions.e2imoml.calculate(eproc):
-            base = mod.DllBase
-            name = mod.BaseDllName
-            for export in mod.exports():
-                if(not export[2].is_valid()): continue
-                resolvedName = "%s!%s" % (name, str(export[2]))
-                resolvedOffset = base.v() + export[1]
-                symbols_by_name[resolvedName] = resolvedOffset
-                symbols_by_offset[resolvedOffset] = resolvedName
-        self.core.symbols_by_name = symbols_by_name
-        self.core.symbols_by_offset = symbols_by_offset
+        # Only the module list is walked here, the exports of each
+        # module are parsed the first time one of its symbols is used
+        with self.core.addrspace.read_session():
+            table = symbols.SymbolTable(self.core.functions.e2imoml.calculate(eproc), self.core.symbol_store)
+        self.core.symbols_by_name = table.by_name
+        self.core.symbols_by_offset = table.by_offset
         self.core.symbols_by_name.update(self.core.kernel_symbols_by_name)
         self.core.symbols_by_offset.update(self.core.kernel_symbols_by_offset)
 
@@ -504,12 +598,8 @@ class ReloadModuleSymbols(tprobe.AbstractTProbePlugin):
 
     def calculate(self, module_name):
         module = self.core.current_modules[module_name]
-        self.core.current_symbols[module_name] = {}
-
-        for export in module.exports():
-            if(not export[2].is_valid()): continue
-            resolvedOffset = module.DllBase.v() + export[1]
-            self.core.current_symbols[module_name][export[2]] = resolvedOffset
+        with self.core.addrspace.read_session():
+            self.core.current_symbols[module_name] = dict(symbols.ModuleSymbols(module, self.core.symbol_store).exports())
 
         return self.core.current_symbols
 
@@ -537,20 +627,11 @@ class ReloadSymbols(tprobe.AbstractTProbePlugin):
     name = 'reload_symbols'
 
     def calculate(self):
-        symbols_by_name = {}
-        symbols_by_offset = {}
         module = self.core.functions.get_EPROCESS(self.core.current_EPROCESS.v())
-        for mod in self.core.functions.e2imoml.calculate(module):
-            base = mod.DllBase
-            name = mod.BaseDllName
-            for export in mod.exports():
-                if(not export[2].is_valid()): continue
-                resolvedName = "%s!%s" % (name, str(export[2]))
-                resolvedOffset = base.v() + export[1]
-                symbols_by_name[resolvedName] = resolvedOffset
-                symbols_by_offset[resolvedOffset] = resolvedName
-        self.core.symbols_by_name = symbols_by_name
-        self.core.symbols_by_offset = symbols_by_offset
+        with self.core.addrspace.read_session():
+            table = symbols.SymbolTable(self.core.functions.e2imoml.calculate(module), self.core.symbol_store)
+        self.core.symbols_by_name = table.by_name
+        self.core.symbols_by_offset = table.by_offset
         self.core.symbols_by_name.update(self.core.kernel_symbols_by_name)
         self.core.symbols_by_offset.update(self.core.kernel_symbols_by_offset)
 
@@ -563,19 +644,10 @@ class ReloadKernelSymbols(tprobe.AbstractTProbePlugin):
     name = 'reload_kernel_symbols'
 
     def calculate(self):
-        kernel_symbols_by_name = {}
-        kernel_symbols_by_offset = {}
-        for mod in win32.modules.lsmod(self.core.addrspace):
-            base = mod.DllBase
-            name = mod.BaseDllName
-            for export in mod.exports():
-                if(not export[2].is_valid()): continue
-                resolvedName = "%s!%s" % (name, str(export[2]))
-                resolvedOffset = base.v() + export[1]
-                kernel_symbols_by_name[resolvedName] = resolvedOffset
-                kernel_symbols_by_offset[resolvedOffset] = resolvedName
-        self.core.kernel_symbols_by_name = kernel_symbols_by_name
-        self.core.kernel_symbols_by_offset = kernel_symbols_by_offset
+        with self.core.addrspace.read_session():
+            table = symbols.SymbolTable(win32.modules.lsmod(self.core.addrspace), self.core.symbol_store)
+        self.core.kernel_symbols_by_name = table.by_name
+        self.core.kernel_symbols_by_offset = table.by_offset
         self.core.symbols_by_name.update(self.core.kernel_symbols_by_name)
         self.core.symbols_by_offset.update(self.core.kernel_symbols_by_offset)
 
@@ -587,10 +659,9 @@ class ResolveSymbol(tprobe.AbstractTProbePlugin):
 
     def calculate(self, name):
         found = 0
-        for symbol_name in self.core.symbols_by_name.keys():
-            if name in symbol_name:
-                print('0x%08x: %s' % (self.core.symbols_by_name[symbol_name], symbol_name))
-                found = 1
+        for symbol_name in self.core.symbols_by_name.search(name):
+            print('0x%08x: %s' % (self.core.symbols_by_name[symbol_name], symbol_name))
+            found = 1
 
         if not found:
             print('Not found. Try reloading symbols.')
@@ -601,23 +672,26 @@ class ResolveSymbol(tprobe.AbstractTProbePlugin):
 class DecodeOp1(tprobe.AbstractTProbeApiFunction):
     name = 'dec_op1'
 
-    def calculate(self, op1):
-        return self.decode_op1(op1)
+    def calculate(self, op1, space = None):
+        return self.decode_op1(op1, space)
 
     def get_register(self, reg):
         return self.core.functions.gr(reg)
 
-    def read(self, addr, length):
-        space = self.core.current_EPROCESS.get_process_address_space() 
+    def read(self, addr, length, space = None):
+        if space is None:
+            space = self.core.current_EPROCESS.get_process_address_space() 
         return space.read(addr, length)
 
-    def decode_op1(self, op1):
+    def decode_op1(self, op1, space = None):
+        """Evaluates an operand, memory operands are read from space
+        (the current process by default)"""
         regs = ["EAX", "EBX", "ECX", "EDX", "ESI", "EDI", "EBP", "ESP", "EIP"]
 
         my_op = op1
         if(my_op[0] == '['):
-            my_op = self.decode_op1(my_op[1:-1])
-            my_op = int(struct.unpack("<i", "".join(self.read(my_op, 4)))[0]) & 0xffffffff
+            my_op = self.decode_op1(my_op[1:-1], space)
+            my_op = int(struct.unpack("<i", "".join(self.read(my_op, 4, space)))[0]) & 0xffffffff
             return my_op
         for reg in regs:
             if(my_op.upper() == reg):
@@ -625,58 +699,370 @@ class DecodeOp1(tprobe.AbstractTProbeApiFunction):
                 return my_op & 0xffffffff
         if(len(my_op.split("+")) >1):
             (a,b) = my_op.split("+")
-            a = self.decode_op1(a)
-            b = self.decode_op1(b)
+            a = self.decode_op1(a, space)
+            b = self.decode_op1(b, space)
             my_op = a+b
             return my_op & 0xffffffff
         if(len(my_op.split("-")) >1):
             (a,b) = my_op.split("-")
-            a = self.decode_op1(a)
-            b = self.decode_op1(b)
+            a = self.decode_op1(a, space)
+            b = self.decode_op1(b, space)
             my_op = a-b
             return my_op & 0xffffffff
         if(len(my_op.split("*")) >1):
             (a,b) = my_op.split("*")
-            a = self.decode_op1(a)
-            b = self.decode_op1(b)
+            a = self.decode_op1(a, space)
+            b = self.decode_op1(b, space)
             my_op = a*b
             return my_op & 0xffffffff
         return int(my_op, 16) & 0xffffffff
 
+## The longest x86 instruction
+max_insn_size = 15
+
+## Prefixes distorm puts before the mnemonic (eg. "REP RET")
+insn_prefixes = ["REP", "REPZ", "REPE", "REPNZ", "REPNE", "LOCK", "BND"]
+
+## Leaving a block through these needs a single step to tell where to
+unpredictable_insns = ["RETF", "IRET", "IRETD", "INT", "INT1", "INT3", "INTO",
+                       "SYSENTER", "SYSEXIT", "SYSCALL", "SYSRET", "UD2", "HLT", "DB"]
+
+class BasicBlock(object):
+    """ A run of instructions up to the first control transfer.
+
+    instructions holds (offset, size, instruction) tuples, the last one
+    being the exit of the block. kind tells how the block is left:
+
+        'ret'    - through a near return
+        'call'   - through a call, execution goes on at successors[0]
+                   once the callee returns
+        'branch' - through a direct jump to one of successors
+        'step'   - through an indirect jump, an interrupt or bytes we
+                   could not decode, which have to be single stepped
+        'split'  - the decoded code ran out before any transfer, the
+                   block goes on at successors[0]
+    """
+    def __init__(self, instructions, kind, successors = ()):
+        self.instructions = instructions
+        self.kind = kind
+        self.successors = list(successors)
+
+    @property
+    def start(self):
+        return self.instructions[0][0]
+
+    @property
+    def exit(self):
+        return self.instructions[-1][0]
+
+def split_insn(instruction):
+    """Returns (mnemonic, operands) of a decoded instruction, without prefixes"""
+    fields = instruction.split(' ', 1)
+    while fields[0] in insn_prefixes and len(fields) > 1:
+        fields = fields[1].split(' ', 1)
+    return fields[0], fields[1] if len(fields) > 1 else ''
+
+def _classify(offset, size, instruction):
+    """Returns (kind, successors) for an instruction ending a block, or None"""
+    mnemonic, operand = split_insn(instruction)
+    if mnemonic in ["RET", "RETN"]:
+        return 'ret', ()
+    if mnemonic == "CALL":
+        return 'call', (offset + size,)
+    if mnemonic in unpredictable_insns:
+        return 'step', ()
+    if mnemonic == "JMP" or mnemonic.startswith("J") or mnemonic.startswith("LOOP"):
+        try:
+            target = int(operand, 16)
+        except ValueError:
+            # JMP EAX, JMP DWORD [...], JMP FAR ...
+            return 'step', ()
+        if mnemonic == "JMP":
+            return 'branch', (target,)
+        return 'branch', (target, offset + size)
+    return None
+
+def decode_block(space, address, length = 0x100):
+    """Decodes the basic block starting at address.
+
+    The code is read from space (so it comes from the page cache while
+    the target stays halted) and decoded locally.
+    """
+    # Read past the end of the page only when the next one is mapped
+    page_end = (address | 0xfff) + 1
+    data = space.read(address, min(length, page_end + max_insn_size - address))
+    if not data:
+        data = space.read(address, min(length, page_end - address))
+    if not data:
+        return BasicBlock([(address, 0, None)], 'step')
+
+    end = address + len(data)
+    instructions = []
+    for offset, size, instruction, _hexdump in distorm3.DecodeGenerator(address, data, distorm3.Decode32Bits):
+        if offset + max_insn_size > end:
+            # The instruction may be cut short, decode it with the next block
+            if not instructions:
+                return BasicBlock([(offset, size, instruction)], 'step')
+            return BasicBlock(instructions, 'split', (offset,))
+        instructions.append((offset, size, instruction))
+        transfer = _classify(offset, size, instruction)
+        if transfer is not None:
+            return BasicBlock(instructions, *transfer)
+    return BasicBlock(instructions, 'split', (end,))
+
+class DisassemblyCache(object):
+    """ Decoded instructions by (dtb, page), checked against the page contents.
+
+    Each page keeps the runs of instructions decoded so far, by the
+    address the decoding started at (x86 code decodes differently
+    depending on where one starts). A run is decoded as far as it was
+    asked for, at most until the end of the page; its last instruction
+    may spill into the next page.
+
+    The contents of a page are hashed (including the bytes spilling
+    into the next page) and checked again once per generation of the
+    address space, so while the target stays halted a page is not even
+    read again. Pages whose contents changed are decoded again.
+    """
+    page_size = 0x1000
+    chunk_size = 0x100
+
+    def __init__(self, max_pages = 256):
+        self.max_pages = max_pages
+        self.pages = collections.OrderedDict()
+
+    def clear(self):
+        self.pages.clear()
+
+    def _page(self, space, page, mode):
+        """Returns the (current) cache entry of a page, or None if it is unreadable"""
+        key = (getattr(space, "dtb", None), page, mode)
+        generation = space.get_generation()
+        entry = self.pages.pop(key, None)
+        if entry is None or entry["generation"] != generation:
+            data = space.read(page, self.page_size + max_insn_size) or space.read(page, self.page_size)
+            if not data:
+                return None
+            digest = hashlib.md5(data).digest()
+            if entry is None or entry["hash"] != digest:
+                entry = dict(hash = digest, data = data, runs = {})
+            entry["generation"] = generation
+        self.pages[key] = entry
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last = False)
+        return entry
+
+    def _run(self, entry, page, start, mode, end):
+        """Returns (instructions, next offset) decoded from start, up to end at least.
+
+        Runs are decoded a chunk at a time and extended on later calls,
+        but never past the end of the page.
+        """
+        run = entry["runs"].setdefault(start, [[], start])
+        instructions, position = run
+        page_end = page + self.page_size
+        while position < min(end, page_end):
+            chunk_end = position + self.chunk_size
+            data = entry["data"][position - page:chunk_end - page + max_insn_size]
+            for offset, size, instruction, _hexdump in distorm3.DecodeGenerator(position, data, mode):
+                if offset >= min(chunk_end, page_end):
+                    break
+                instructions.append((offset, size, instruction))
+            if not instructions or instructions[-1][0] + instructions[-1][1] <= position:
+                break
+            position = run[1] = instructions[-1][0] + instructions[-1][1]
+        return instructions, position
+
+    def decode(self, space, address, length, mode):
+        """Returns (offset, size, instruction) for the code in [address, address + length)"""
+        instructions = []
+        start = address
+        end = address + length
+        while start < end:
+            page = start & ~(self.page_size - 1)
+            entry = self._page(space, page, mode)
+            if entry is None:
+                break
+            run, position = self._run(entry, page, start, mode, end)
+            for instruction in run:
+                if instruction[0] >= end:
+                    return instructions
+                instructions.append(instruction)
+            if position <= start:
+                break
+            start = position
+        return instructions
+
+## Decoded code shared by the disassembly commands
+disassembly_cache = DisassemblyCache()
+
+class StepBlock(tprobe.AbstractTProbePlugin):
+    """ Steps the target a basic block at a time.
+
+    The block at eip is decoded locally and one temporary breakpoint is
+    put where it is left (on the fallthrough of a call, on the targets of
+    a direct jump), so the target runs through the whole block on a
+    single resume. Only indirect jumps, interrupts and returns are single
+    stepped. The breakpoints are limited to the current process with a
+    $cr3 condition.
+    """
+    name = 'nb'
+    dependencies = ['gr', 'uce']
+
+    def decode(self, address = None):
+        if address is None:
+            address = self.core.functions.gr("eip")
+        space = self.core.current_EPROCESS.get_process_address_space()
+        return decode_block(space, address)
+
+    def run_to(self, addresses):
+        """Resumes the target until it reaches one of addresses.
+
+        Returns True if it did, False if it stopped anywhere else (eg. on
+        a user breakpoint).
+        """
+        condition = '$cr3=={0}'.format(self.core.functions.gr("cr3"))
+        bps = []
+        try:
+            for address in set(addresses):
+                bp = gdb.Breakpoint('*0x{0:x}'.format(address), internal = True)
+                bp.condition = condition
+                bps.append(bp)
+            gdb.execute('c', False, True)
+        finally:
+            for bp in bps:
+                if bp.is_valid():
+                    bp.delete()
+            standard.GdbAddressSpace.invalidate_cache()
+        return self.core.functions.gr("eip") in addresses
+
+    def step(self, into = False):
+        """Runs to the exit of the block at eip, or past it when already there.
+
+        Calls are stepped over, unless into is set: then a direct call is
+        followed to its target and an indirect one is single stepped, so
+        the next stop is the first block of the callee. Returns False if
+        the target stopped somewhere unexpected.
+        """
+        eip = self.core.functions.gr("eip")
+        block = self.decode(eip)
+        kind = block.kind
+        if into and kind == 'call':
+            _mnemonic, operand = split_insn(block.instructions[-1][2])
+            try:
+                return self.run_to([int(operand, 16)])
+            except ValueError:
+                # CALL EAX, CALL DWORD [...], CALL FAR ...
+                kind = 'step'
+        if kind in ['ret', 'step']:
+            if block.exit == eip:
+                gdb.execute('si', False, True)
+                standard.GdbAddressSpace.invalidate_cache()
+                return True
+            return self.run_to([block.exit])
+        return self.run_to(block.successors)
+
+    def run_to_ret(self):
+        """Runs until eip is on a return of the current function.
+
+        Calls are stepped over. Returns False if the target stopped
+        somewhere else on the way.
+        """
+        while True:
+            eip = self.core.functions.gr("eip")
+            block = self.decode(eip)
+            if block.kind == 'ret' and block.exit == eip:
+                return True
+            if not self.step():
+                return False
+
+    def calculate(self):
+        self.step()
+        self.core.functions.uce.calculate()
+
+class Trace(tprobe.AbstractTProbePlugin):
+    """ Records the blocks the current process runs through.
+
+    The target is stepped a block at a time with nb, following calls into
+    their callees, and every stop is recorded (address and changed
+    registers) into a TraceBuffer. The
+    most recent budget bytes of the trace stay in memory, for trace_show,
+    and the whole trace is written to path if one is given.
+    """
+    name = 'trace'
+    dependencies = ['nb', 'gr', 'uce']
+
+    def __init__(self, *args, **kwargs):
+        tprobe.AbstractTProbePlugin.__init__(self, *args, **kwargs)
+        self.buffer = None
+
+    def calculate(self, path = None, count = 10000, budget = 0x100000):
+        stream = None
+        if path is not None:
+            stream = open(path, "wb")
+        self.buffer = trace.TraceBuffer(budget = budget, stream = stream,
+                                        dtb = self.core.functions.gr("cr3"))
+        try:
+            for _ in range(count):
+                regs = self.core.functions.gr.snapshot()
+                self.buffer.record(regs["eip"], regs)
+                if not self.core.functions.nb.step(into = True):
+                    break
+            regs = self.core.functions.gr.snapshot()
+            self.buffer.record(regs["eip"], regs)
+        finally:
+            self.buffer.close()
+        self.core.functions.uce.calculate()
+        return self.buffer
+
+    def render_text(self, buf):
+        print("Recorded {0} stops, {1} bytes kept in memory".format(buf.count, buf.size))
+        if buf.dropped:
+            print("The oldest {0} stops were dropped from memory".format(buf.dropped))
+
+class TraceShow(tprobe.AbstractTProbePlugin):
+    """ Prints a trace with symbols.
+
+    Reads the trace file at path, or the trace last recorded in memory.
+    """
+    name = 'trace_show'
+    dependencies = ['trace']
+
+    def calculate(self, path = None):
+        if path is not None:
+            records = trace.TraceReader(path).records()
+        elif self.core.functions.trace.buffer is not None:
+            records = self.core.functions.trace.buffer.records()
+        else:
+            records = []
+        for address, changed in records:
+            yield address, self.core.symbols_by_offset.symbolize(address), changed
+
+    def render_text(self, records):
+        for address, symbol, changed in records:
+            regs = " ".join("{0}={1:#x}".format(name, changed[name]) for name in sorted(changed))
+            print("0x%08x %-40s %s" % (address, symbol or "", regs))
+
 class Si(tprobe.AbstractTProbePlugin):
     name = 'si'
 
     def calculate(self):
         gdb.execute("si")
+        standard.GdbAddressSpace.invalidate_cache()
         self.core.functions.uce.calculate()
 
 class Ni(tprobe.AbstractTProbePlugin):
     name = 'ni'
+    dependencies = ['nb']
 
     def calculate(self):
-        eip = self.core.functions.gr("eip")
-        space = self.core.current_EPROCESS.get_process_address_space() 
-        factor = 0x20
-#        while(factor > 0x0):
-#            try:
-        data = space.read(eip, factor)
-        iterable = distorm3.DecodeGenerator(eip, data, distorm3.Decode32Bits)
-        _, size, instruction, _ = iterable.next()
-#            except Exception:
-#                print("reducing")
-#                factor -= 0x1
-#                continue
-        if(instruction.find("CALL ") > -1):
-#        if True:
-            neip = eip + size
-#            self.core.functions.update_EPROCESS.calculate()
-#            self.core.gshell.log("test")
-#            self.core.bp_index.addBpt(Breakpoint(neip), self.core.current_EPROCESS)
-#            gdb.execute("cont")
-#            self.core.bp_index.delBpt(neip)
-            gdb.execute("until *0x%x" % neip)
+        stepper = self.core.functions.nb
+        block = stepper.decode()
+        if block.kind == 'call' and block.exit == block.start:
+            stepper.run_to(block.successors)
         else:
-            self.core.functions.si()
+            gdb.execute("si")
+            standard.GdbAddressSpace.invalidate_cache()
         # we need to update EPROCESS
         self.core.functions.uce.calculate()
 
@@ -685,6 +1071,7 @@ class Until(tprobe.AbstractTProbePlugin):
     
     def calculate(self, addr):
         gdb.execute("until *0x%x" % addr)
+        standard.GdbAddressSpace.invalidate_cache()
         self.core.functions.uce.calculate()
 
 class SiAndDis(tprobe.AbstractTProbePlugin):
@@ -698,6 +1085,11 @@ class Disassemble(tprobe.AbstractTProbePlugin):
     name = 'dis'
     dependencies = ['get_EPROCESS', 'dec_op1']
 
+    def __init__(self, *args, **kwargs):
+        tprobe.AbstractTProbePlugin.__init__(self, *args, **kwargs)
+        # Pointers read for calls through memory, by (dtb, operand, generation)
+        self.pointers = {}
+
     def calculate(self, address = None, length = 128, space = None, mode = None):
         """Disassemble code at a given address.
 
@@ -730,26 +1122,46 @@ class Disassemble(tprobe.AbstractTProbePlugin):
         else:
             distorm_mode = distorm3.Decode64Bits
 
-        data = space.read(address, length)
-        iterable = distorm3.DecodeGenerator(address, data, distorm_mode)
-
+        eip = self.core.functions.gr("eip")
         lines = []
-        for (offset, _size, instruction, hexdump) in iterable:
+        for (offset, _size, instruction) in disassembly_cache.decode(space, address, length, distorm_mode):
             if(instruction.find("CALL ") > -1):
                 try:
-                    op1 = instruction[5:]
-                    if(op1.find("DWORD ") == 0):
-                        op1 = op1[6:]
-                    dst = self.functions.dec_op1(op1)
-                    if(self.core.symbols_by_offset.has_key(int(dst))):
-                        target = self.core.symbols_by_offset[int(dst)]
-                        instruction = "CALL %s" % target
+                    dst = self.call_target(offset, instruction, eip, space)
+                    if(dst is not None):
+                        target = self.core.symbols_by_offset.symbolize(int(dst))
+                        if(target is not None):
+                            instruction = "CALL %s" % target
                 except Exception:
                     print(instruction)
 #            lines.append((offset, hexdump, instruction))
             lines.append((offset, instruction))
         return lines
 
+    def call_target(self, offset, instruction, eip, space):
+        """Returns where a CALL goes to, or None if that is not known here.
+
+        Direct calls and calls through a fixed address (eg. the IAT) are
+        resolved anywhere, the pointers read once per generation. Calls
+        through registers are only resolved at eip, the only place the
+        current registers mean anything for.
+        """
+        op1 = split_insn(instruction)[1]
+        if(op1.find("DWORD ") == 0):
+            op1 = op1[6:]
+        if(op1.startswith("0x")):
+            return int(op1, 16)
+        if(op1.startswith("[0x") and op1.endswith("]")):
+            key = (getattr(space, "dtb", None), op1, space.get_generation())
+            if key not in self.pointers:
+                if len(self.pointers) > 0x1000:
+                    self.pointers.clear()
+                self.pointers[key] = self.functions.dec_op1(op1, space)
+            return self.pointers[key]
+        if(offset == eip):
+            return self.functions.dec_op1(op1, space)
+        return None
+
     def render_text(self, lines):
 #        for offset, hexdump, instruction in lines:
         for offset, instruction in lines:
@@ -804,14 +1216,35 @@ class RestoreSymbols(tprobe.AbstractTProbePlugin):
     name = 'restore_symbols'
 
     def calculate(self, filee):
+        if symbols.SymbolStore.is_store(filee):
+            # Exports of modules are now read from the database and
+            # rebased, the tables pick it up as they load each module
+            store = symbols.SymbolStore(filee)
+            self.core.symbol_store = store
+            self.core.symbols_by_name.table.set_store(store)
+            self.core.kernel_symbols_by_name.table.set_store(store)
+            self.core.symbols_by_name.table.add_symbols(store.get_symbols("process").iteritems())
+            self.core.kernel_symbols_by_name.table.add_symbols(store.get_symbols("kernel").iteritems())
+            return
+
+        # Symbols stored by older versions, a pickle of plain dicts
         f = open(filee, "r")
         symbols_by_name, symbols_by_offset, kernel_symbols_by_name, kernel_symbols_by_offset = pickle.load(f)
-        self.core.symbols_by_name = symbols_by_name
-        self.core.symbols_by_offset = symbols_by_offset
-        self.core.kernel_symbols_by_name = kernel_symbols_by_name
-        self.core.kernel_symbols_by_offset = kernel_symbols_by_offset
         f.close()
 
+        # Index the stored symbols again
+        target_symbols = symbols.SymbolTable()
+        target_symbols.by_name.update(symbols_by_name)
+        target_symbols.by_offset.update(symbols_by_offset)
+        kernel_symbols = symbols.SymbolTable()
+        kernel_symbols.by_name.update(kernel_symbols_by_name)
+        kernel_symbols.by_offset.update(kernel_symbols_by_offset)
+
+        self.core.symbols_by_name = target_symbols.by_name
+        self.core.symbols_by_offset = target_symbols.by_offset
+        self.core.kernel_symbols_by_name = kernel_symbols.by_name
+        self.core.kernel_symbols_by_offset = kernel_symbols.by_offset
+
     def render_text(self, sth):
         print("Restored")
 
@@ -819,17 +1252,37 @@ class StoreSymbols(tprobe.AbstractTProbePlugin):
     name = 'store_symbols'
 
     def calculate(self, filee):
-        f = open(filee, "w")
-        symbols_by_name = self.core.symbols_by_name
-        symbols_by_offset = self.core.symbols_by_offset
-        kernel_symbols_by_name = self.core.kernel_symbols_by_name
-        kernel_symbols_by_offset = self.core.kernel_symbols_by_offset
-        symbols = [symbols_by_name, symbols_by_offset, kernel_symbols_by_name, kernel_symbols_by_offset]
-        pickle.dump(symbols, f)
-        f.close()
-
-    def render_text(self, sth):
+        if self.core.symbol_store is not None and self.core.symbol_store.path == filee:
+            store = self.core.symbol_store
+        elif os.path.isfile(filee) and os.path.getsize(filee) and not symbols.SymbolStore.is_store(filee):
+            # Most likely symbols pickled by an older version, leave them be
+            print("{0} is not a symbol database, not overwriting it. Restore it with "
+                  "restore_symbols and store the symbols to a new file".format(filee))
+            return None
+        else:
+            store = symbols.SymbolStore(filee)
+
+        # Modules already in the database are skipped, new ones are parsed
+        with self.core.addrspace.read_session():
+            incomplete = self.core.symbols_by_name.table.save(store)
+            incomplete += self.core.kernel_symbols_by_name.table.save(store)
+        # Symbols not exported by any module are kept as they are
+        store.put_symbols("process", self.core.symbols_by_name.table.added)
+        store.put_symbols("kernel", self.core.kernel_symbols_by_name.table.added)
+
+        # Keep using it so modules are only parsed once from now on
+        self.core.symbol_store = store
+        self.core.symbols_by_name.table.set_store(store)
+        self.core.kernel_symbols_by_name.table.set_store(store)
+        return incomplete
+
+    def render_text(self, incomplete):
+        if incomplete is None:
+            return
         print("Stored")
+        if incomplete:
+            print("Not stored, exports partly paged out: {0}".format(
+                ", ".join(sorted(set(module.name for module in incomplete)))))
 
 
                 
@@ -10,17 +10,177 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk as gtk
 from gi.repository import Gdk as gdk
+from gi.repository import GLib
 
 
 import sys
 #from debugutils import BptIndex,Breakpoint
 import struct
+import collections
+import traceback
 from gdb import execute
 import volatility.conf as conf
 cfg = conf.ConfObject()
 from shell import GdbConsole
 from volatility.plugins.tprobe.core import Breakpoint
-from threading import Thread
+from threading import Thread, Condition
+
+## (name, bit) of the flags shown in the registers view
+eflags_bits = [("CF", 0), ("PF", 2), ("AF", 4), ("ZF", 6), ("SF", 7), ("TF", 8), ("IF", 9), ("DF", 10), ("OF", 11)]
+
+def update_store(store, old_rows, rows):
+    """Makes store (showing old_rows) show rows, only touching the rows which changed"""
+    for i, row in enumerate(rows):
+        if i >= len(old_rows):
+            store.append(row)
+        elif old_rows[i] != row:
+            store[i] = row
+    for i in range(len(old_rows) - 1, len(rows) - 1, -1):
+        store.remove(store.get_iter(i))
+
+class FrameModel(object):
+    """ What the views show of the target at one stop.
+
+    The registers, the current EPROCESS and its address space, the
+    process list, the memory windows of the views and the disassembly
+    are fetched once per stop and shared by all the views, instead of
+    every view querying the target on its own. Views subscribe to the
+    model; those with a memory_range() method get that memory read
+    in one batch when the model is refreshed.
+
+    The model is refreshed again only once the target ran (the address
+    space generation changed) or another EPROCESS was selected.
+    """
+    def __init__(self, gshell):
+        self.gshell = gshell
+        self.core = gshell.core
+        self.functions = gshell.functions
+        self.subscribers = []
+        self.key = None
+        self.regs = None
+        self.eprocess = None
+        self.space = None
+        self.memory = {}
+        self.code = {}
+        self.process_list = None
+
+    def subscribe(self, view):
+        self.subscribers.append(view)
+
+    def unsubscribe(self, view):
+        if view in self.subscribers:
+            self.subscribers.remove(view)
+
+    def invalidate(self):
+        """Forces a refetch, eg. after the symbols changed"""
+        self.key = None
+
+    def refresh(self):
+        """Fetches the current stop, returns False if it was already fetched"""
+        eprocess = self.core.current_EPROCESS
+        key = (self.core.addrspace.get_generation(), eprocess.v())
+        if key == self.key:
+            return False
+
+        self.regs = self.functions.gr.snapshot()
+        self.eprocess = eprocess
+        self.space = eprocess.get_process_address_space()
+        self.memory = {}
+        self.code = {}
+        self.process_list = None
+        self.key = key
+
+        ranges = list(set(view.memory_range() for view in self.subscribers if hasattr(view, "memory_range")))
+        with self.space.read_session():
+            for memory_range, data in zip(ranges, self.space.read_many(ranges)):
+                self.memory[memory_range] = data
+        return True
+
+    def read(self, offset, length):
+        """Returns memory of the current process as of this stop"""
+        if (offset, length) not in self.memory:
+            self.memory[(offset, length)] = self.space.read(offset, length)
+        return self.memory[(offset, length)]
+
+    def disassemble(self, offset = None):
+        """Returns the disassembly at offset (default: eip) as of this stop"""
+        if offset is None:
+            offset = self.regs["eip"]
+        if offset not in self.code:
+            self.code[offset] = self.functions.dis.calculate(offset, space = self.space) or []
+        return self.code[offset]
+
+    def processes(self):
+        """Returns (name, offset) of every process as of this stop"""
+        if self.process_list is None:
+            self.process_list = [(str(self.functions.get_process_name(proc)), proc.v())
+                                 for proc in self.functions.get_process_list.calculate()]
+        return self.process_list
+
+class TargetWorker(object):
+    """ Runs everything which touches the target on a single thread.
+
+    gdb and the address spaces must not be used from two threads at
+    once, and a slow pslist or symbol reload must not block the GTK main
+    loop. The views post requests here instead. Each request is a
+    function run on the worker thread and an optional callback, which
+    gets the result on the GTK thread (through GLib.idle_add).
+
+    A request posted with a key replaces the pending request with the
+    same key, so eg. only the latest scroll position of a view is read.
+    """
+    def __init__(self):
+        self.condition = Condition()
+        self.pending = collections.OrderedDict()
+        self.serial = 0
+        self.running = True
+
+    def post(self, func, callback = None, key = None):
+        with self.condition:
+            if key is None:
+                key = self.serial
+                self.serial += 1
+            # The newer request also moves to the back of the queue
+            self.pending.pop(key, None)
+            self.pending[key] = (func, callback)
+            self.condition.notify()
+
+    def cancel(self, key):
+        with self.condition:
+            self.pending.pop(key, None)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def _next(self):
+        with self.condition:
+            while self.running and not self.pending:
+                # Waiting with a timeout keeps the thread interruptible
+                self.condition.wait(0.5)
+            if not self.running:
+                return None
+            return self.pending.popitem(last = False)[1]
+
+    def run(self):
+        while True:
+            request = self._next()
+            if request is None:
+                return
+            func, callback = request
+            try:
+                result = func()
+            except Exception:
+                traceback.print_exc()
+                continue
+            if callback is not None:
+                GLib.idle_add(self._deliver, callback, result)
+
+    @staticmethod
+    def _deliver(callback, result):
+        callback(result)
+        return False
 
 class TProbeShell(object):
     def __init__(self, gshell):
@@ -58,9 +218,6 @@ class TProbeShell(object):
         adj.set_value( adj.get_upper() - adj.get_page_size() )
 
     def enter_callback(self, widget, data=None):
-        bp = sys.stdout
-        sys.stdout = StringIO()
-
         cmd = self.input.get_text()
         if(cmd == ""):
             return 
@@ -73,10 +230,19 @@ class TProbeShell(object):
 #        self.gshell.log("History content: %s" % self.history)
 
         self.input.set_text("")
-        self.gshell.console.runsource(cmd)
-        out = sys.stdout.getvalue()
+        self.gshell.run(lambda: self.run_command(cmd), self.show_output)
+
+    def run_command(self, cmd):
+        bp = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.gshell.console.runsource(cmd)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = bp
+
+    def show_output(self, out):
         self.textBuffer.insert(self.textBuffer.get_end_iter(), out)
-        sys.stdout = bp
 
     def key_pressed(self, widget, data):
 #        self.gshell.log(str(data.keyval)+"\n")
@@ -96,16 +262,19 @@ class TProbeShell(object):
         return False
 
 class MemoryView(object):
+    length = 0x100
+
     def __init__(self, gshell, address=None):
         self.gshell = gshell
+        self.frame = gshell.frame
         if(address == None):
             self.sync_reg = "esi"
-            self.offset = self.gshell.functions.gr(self.sync_reg)
-            self.data = self.gshell.core.addrspace.read(self.offset, 0x100)
+            self.offset = self.frame.regs[self.sync_reg]
         else:
             self.sync_reg = None
             self.offset = address
-            self.data = self.gshell.core.addrspace.read(self.offset, 0x100)
+        self.sync_pending = False
+        self.frame.subscribe(self)
 
         self.window = gtk.Window(gtk.WindowType.TOPLEVEL, title="Memory View")
 
@@ -176,18 +345,43 @@ class MemoryView(object):
         self.treeview.append_column(col)
 
         self.window.connect('scroll-event', self.onScroll)
+        self.window.connect('destroy', self.closed)
 #        self.window.add(self.vbox)
         self.window.add(self.treeview)
 
         self.window.show_all()
+        self.update()
 
     def activate_sync(self, widget, reg):
         self.sync_reg = reg
-        self.offset = self.gshell.functions.gr(self.sync_reg)
-        self.data = self.gshell.core.addrspace.read(self.offset, 0x100)
-        self.treeview.set_model(self.get_model())
+        self.refresh()
         return True
 
+    def closed(self, widget, data=None):
+        self.frame.unsubscribe(self)
+        self.gshell.worker.cancel(("view", id(self)))
+
+    def memory_range(self):
+        if(self.sync_reg != None):
+            self.offset = self.frame.regs[self.sync_reg]
+        return (self.offset, self.length)
+
+    def update(self):
+        """Refetches the memory shown, only the latest request is served"""
+        self.gshell.run(self.fetch, self.show, key = ("view", id(self)))
+
+    def fetch(self):
+        if(self.sync_pending):
+            self.sync_pending = False
+            self.memory_range()
+        offset = self.offset
+        return self.get_rows(offset, self.frame.read(offset, self.length))
+
+    def show(self, rows):
+        """Redraws only the changed lines"""
+        update_store(self.liststore, self.rows, rows)
+        self.rows = rows
+
     def done(self, widget, data=None):
         gtk.main_quit()
         return False
@@ -198,19 +392,11 @@ class MemoryView(object):
         elif(data.direction == gdk.ScrollDirection.DOWN):
             self.offset += 0x10
         # like refresh only without updatnig offset
-        # update_context not necessary, we might want to scroll other context's memory
-        #self.gshell.functions.update_context()
-#        space = self.gshell.core.reading_context or self.gshell.core.current_context
-        space = self.gshell.core.current_EPROCESS.get_process_address_space()
-        self.data = space.read(self.offset, 0x100)
-        self.treeview.set_model(self.get_model())
+        self.update()
 
     def refresh(self):
-        if(self.sync_reg != None):
-            self.offset = self.gshell.functions.gr(self.sync_reg)
-        space = self.gshell.core.current_EPROCESS.get_process_address_space()
-        self.data = space.read(self.offset, 0x100)
-        self.treeview.set_model(self.get_model())
+        self.sync_pending = True
+        self.update()
 
     def sanitize(self, data):
         sanitized = ""
@@ -220,22 +406,29 @@ class MemoryView(object):
             sanitized += byte
         return sanitized
 
-    def get_model(self):
-        self.liststore = gtk.ListStore(str, str, str, str, str, str, str, str, str, str, str, str, str, str, str, str, str, str)
-
+    def get_rows(self, offset, data):
+        rows = []
         for i in range(0, 0x10):
-            line = ["0x%08x" % (i + self.offset)]
+            line = ["0x%08x" % (i + offset)]
             try:
-                line += ["%02x" % ord(self.data[i*0x10 + x]) for x in range(0, 0x10)]
+                line += ["%02x" % ord(data[i*0x10 + x]) for x in range(0, 0x10)]
             except Exception:
                 line += ["??" for x in range(0, 0x10)]
 
             #ASCII col
             try:
-                line.append(self.sanitize(self.data[i*0x10:i*0x10+0x10]))
+                line.append(self.sanitize(data[i*0x10:i*0x10+0x10]))
             except Exception:
                 line.append("??")
 
+            rows.append(line)
+        return rows
+
+    def get_model(self):
+        self.liststore = gtk.ListStore(str, str, str, str, str, str, str, str, str, str, str, str, str, str, str, str, str, str)
+        # Filled in once the worker has read the memory
+        self.rows = self.get_rows(self.offset, None)
+        for line in self.rows:
             self.liststore.append(line)
         return self.liststore
 
@@ -246,16 +439,20 @@ class MemoryView(object):
         return False
 
 class MemoryDwordView(MemoryView):
+    length = 0x40
+
     def __init__(self, gshell):
         self.gshell = gshell
+        self.frame = gshell.frame
         self.sync_reg = "esp"
         self.window = gtk.Window(gtk.WindowType.TOPLEVEL, title="Memory View - DWORD")
 
         self.width = 0
         self.height = 0
 #        self.vbox = gtk.VBox(False, 0)
-        self.offset = self.gshell.functions.gr(self.sync_reg)
-        self.data = self.gshell.core.addrspace.read(self.offset, 0x40)
+        self.offset = self.frame.regs[self.sync_reg]
+        self.sync_pending = False
+        self.frame.subscribe(self)
 
         self.menu = gtk.Menu()
         menu_item1 = gtk.MenuItem("Sync with eax")
@@ -321,10 +518,12 @@ class MemoryDwordView(MemoryView):
         self.treeview.append_column(self.value_col)
 
         self.window.connect('scroll-event', self.onScroll)
+        self.window.connect('destroy', self.closed)
 #        self.window.add(self.vbox)
         self.window.add(self.treeview)
 
         self.window.show_all()
+        self.update()
 
     def copy_to_clipboard(self, widget, data=None):
         selection = self.view.get_selection()
@@ -354,27 +553,24 @@ class MemoryDwordView(MemoryView):
         elif(data.direction == gdk.SCROLL_DOWN):
             self.offset += 0x4
         # like refresh only without updatnig offset
-        #self.gshell.functions.update_context()
-#        space = self.gshell.core.reading_context or self.gshell.core.current_context
-        space = self.gshell.core.current_EPROCESS.get_process_address_space()
-        self.data = space.read(self.offset, 0x40)
-        self.treeview.set_model(self.get_model())
-
-    def refresh(self):
-        self.offset = self.gshell.functions.gr(self.sync_reg)
-        space = self.gshell.core.current_EPROCESS.get_process_address_space()
-        self.data = space.read(self.offset, 0x40)
-        self.treeview.set_model(self.get_model())
-
-    def get_model(self):
-        self.liststore = gtk.ListStore(str, str)
+        self.update()
 
+    def get_rows(self, offset, data):
+        rows = []
         for i in range(0, 0x10):
-            line = ["0x%08x" % (i + self.offset)]
+            line = ["0x%08x" % (i + offset)]
             try:
-                line += ["%08x" % struct.unpack("<I", self.data[i*0x4:i*0x4+0x4])]
+                line += ["%08x" % struct.unpack("<I", data[i*0x4:i*0x4+0x4])]
             except Exception:
                 line += ["??"]
+            rows.append(line)
+        return rows
+
+    def get_model(self):
+        self.liststore = gtk.ListStore(str, str)
+        # Filled in once the worker has read the memory
+        self.rows = self.get_rows(self.offset, None)
+        for line in self.rows:
             self.liststore.append(line)
         return self.liststore
 """
@@ -393,9 +589,10 @@ class RegistersView(object):
 
         self.window = gtk.Window(gtk.WindowType.TOPLEVEL, title="Registers View")
 
-        self.regs1view = self.generate_view(self.get_regs1_model, "Register", "Value")
-        self.regs2view = self.generate_view(self.get_regs2_model, "Register", "Value")
-        self.regs3view = self.generate_view(self.get_regs3_model, "F", "V")
+        self.rows = {}
+        self.regs1view = self.generate_view(self.get_regs1_rows, "Register", "Value")
+        self.regs2view = self.generate_view(self.get_regs2_rows, "Register", "Value")
+        self.regs3view = self.generate_view(self.get_regs3_rows, "F", "V")
 
         hbox = gtk.HBox(False, 0)
         hbox.pack_start(self.regs1view, False, True, 0)
@@ -410,8 +607,10 @@ class RegistersView(object):
         self.window.add(self.notebook)
         self.window.show_all()
 
-    def generate_view(self, model_func, cap1, cap2):
-        view = gtk.TreeView(model_func())
+    def generate_view(self, rows_func, cap1, cap2):
+        rows = rows_func()
+        view = gtk.TreeView(self.get_model(rows))
+        self.rows[view] = rows
         reg_col = gtk.TreeViewColumn(cap1)
         reg_cell = gtk.CellRendererText()
         reg_col.pack_start(reg_cell, True)
@@ -425,47 +624,37 @@ class RegistersView(object):
         return view
 
     def refresh(self):
-        self.regs1view.set_model(self.get_regs1_model())
-        self.regs2view.set_model(self.get_regs2_model())
-        self.regs3view.set_model(self.get_regs3_model())
+        self.gshell.run(self.fetch, self.show, key = ("view", id(self)))
 
-    def get_regs1_model(self):
-        self.liststore = gtk.ListStore(str, str)
+    def fetch(self):
+        return [(self.regs1view, self.get_regs1_rows()),
+                (self.regs2view, self.get_regs2_rows()),
+                (self.regs3view, self.get_regs3_rows())]
 
-        regs = self.functions.regs.calculate()
+    def show(self, views):
+        for view, rows in views:
+            update_store(view.get_model(), self.rows[view], rows)
+            self.rows[view] = rows
 
-        for reg in ["eax", "ebx", "ecx", "edx", "edi", "esi", "ebp", "esp", "eip"]:
-            line = [reg, "%08x" % regs[reg]]
-            self.liststore.append(line)
-        return self.liststore
+    def get_regs1_rows(self):
+        regs = self.gshell.frame.regs
+        return [[reg, "%08x" % regs[reg]] for reg in ["eax", "ebx", "ecx", "edx", "edi", "esi", "ebp", "esp", "eip"]]
 
-    def get_regs2_model(self):
-        self.liststore = gtk.ListStore(str, str)
+    def get_regs2_rows(self):
+        regs = self.gshell.frame.regs
+        return [[reg, "%08x" % regs[reg]] for reg in ["cs", "ss", "ds", "es", "fs", "gs"]]
 
-        regs = self.functions.regs2.calculate()
+    def get_regs3_rows(self):
+        eflags = self.gshell.frame.regs["eflags"]
+        return [[flag, "%01x" % ((eflags >> bit) & 0x1)] for flag, bit in eflags_bits]
 
-        for reg in ["cs", "ss", "ds", "es", "fs", "gs"]:
-            line = [reg, "%08x" % regs[reg]]
-            self.liststore.append(line)
-        return self.liststore
-
-    def get_regs3_model(self):
-        self.liststore = gtk.ListStore(str, str)
-
-        regs = self.functions.regs3.calculate()
-
-        for reg in ["CF", "PF", "AF", "ZF", "SF", "TF", "IF", "DF", "OF"]:
-            line = [reg, "%01x" % regs[reg]]
-            self.liststore.append(line)
-        return self.liststore
+    def get_regs4_rows(self):
+        regs = self.gshell.frame.regs
+        return [[reg, "%08x" % regs[reg]] for reg in ["cr3"]]
 
-    def get_regs4_model(self):
+    def get_model(self, rows):
         self.liststore = gtk.ListStore(str, str)
-
-        regs = self.functions.regs4.calculate()
-
-        for reg in regs:
-            line = [reg, "%08x" % regs[reg]]
+        for line in rows:
             self.liststore.append(line)
         return self.liststore
 
@@ -534,6 +723,7 @@ class CodeView(object):
         swh.add(self.view)
         self.window.add(swh)
         self.window.show_all()
+        self.refresh()
 
     def copy_to_clipboard(self, widget, data=None):
         selection = self.view.get_selection()
@@ -551,11 +741,11 @@ class CodeView(object):
         if(gdk.keyval_name(data.keyval) == "F2"):
             self.activate_insert_bp(widget, data)
         if(gdk.keyval_name(data.keyval) == "F8"):
-            self.gshell.functions.ni.calculate()
+            self.gshell.run(self.gshell.functions.ni.calculate)
         if(gdk.keyval_name(data.keyval) == "F7"):
-            self.gshell.functions.si.calculate()
+            self.gshell.run(self.gshell.functions.si.calculate)
         if(gdk.keyval_name(data.keyval) == "F9"):
-            self.gshell.functions.c.calculate()
+            self.gshell.run(self.gshell.functions.c.calculate)
         if(gdk.keyval_name(data.keyval) == "g"):
             self.activate_goto_prompt(None)
         self.gshell.refresh()
@@ -575,7 +765,7 @@ class CodeView(object):
             tree_iter = model.get_iter(path)
             value = model.get_value(tree_iter,0)
             self.gshell.log("Setting breakpoint at: %s\n" % value)
-            self.gshell.core.bp_index.addBpt(Breakpoint(address=int(value, 16)))
+            self.gshell.run(lambda address = int(value, 16): self.gshell.core.bp_index.addBpt(Breakpoint(address=address)))
             if(cfg.debug == True): self.gshell.log("Current bp index: %s\n" % self.gshell.core.bp_index.bpts)
         self.refresh()
         
@@ -587,7 +777,7 @@ class CodeView(object):
             tree_iter = model.get_iter(path)
             value = model.get_value(tree_iter,0)
             self.gshell.log("Deleting breakpoint at: %s\n" % value)
-            self.gshell.core.bp_index.delBpt(int(value, 16))
+            self.gshell.run(lambda address = int(value, 16): self.gshell.core.bp_index.delBpt(address))
         self.refresh()
 
     def activate_run_until(self, widget, data=None):
@@ -598,17 +788,17 @@ class CodeView(object):
             tree_iter = model.get_iter(path)
             value = model.get_value(tree_iter,0)
         self.gshell.log("Running until: %s\n" % value)
-        self.gshell.functions.until.calculate(int(value, 16))
+        self.gshell.run(lambda: self.gshell.functions.until.calculate(int(value, 16)))
         self.gshell.refresh()
 
     def activate_run_until_return(self, widget, data=None):
         self.gshell.log("Running until return")
-        self.gshell.functions.retWait.calculate()
+        self.gshell.run(self.gshell.functions.retWait.calculate)
         self.gshell.refresh()
 
     def activate_run_until_return_scan(self, widget, data=None):
         self.gshell.log("Running until return (ret scan)")
-        self.gshell.functions.retWaitScan.calculate()
+        self.gshell.run(self.gshell.functions.retWaitScan.calculate)
         self.gshell.refresh()
 
     def activate_goto_prompt(self, widget, data=None):
@@ -631,7 +821,7 @@ class CodeView(object):
         except Exception:
             self.offset = None
         self.gshell.log("Goto: 0x%x" % self.offset)
-        self.view.set_model(self.get_model())
+        self.refresh_no_reset()
         self.dialog.hide()
 
     def activate_gotoIp(self, widget, data=None):
@@ -639,30 +829,41 @@ class CodeView(object):
         return True
 
     def activate_refresh(self, widget, data=None):
-        self.refresh()
+        self.gshell.frame.invalidate()
+        self.gshell.refresh(component = self)
         return True
 
     def refresh(self):
         self.offset = None
-        self.view.set_model(self.get_model())
+        self.refresh_no_reset()
 
     def refresh_no_reset(self):
-        self.view.set_model(self.get_model())
+        self.gshell.run(self.fetch, self.show, key = ("view", id(self)))
 
-    def get_model(self):
-        liststore = gtk.ListStore(str, str, str)
-    
-        space = self.gshell.core.current_EPROCESS.get_process_address_space()
-        for line in self.gshell.functions.dis.calculate(self.offset, space = space):
+    def fetch(self):
+        return self.get_rows(self.offset)
+
+    def show(self, rows):
+        update_store(self.liststore, self.rows, rows)
+        self.rows = rows
+
+    def get_rows(self, offset):
+        rows = []
+        eip = self.gshell.frame.regs["eip"]
+        for line in self.gshell.frame.disassemble(offset):
             addr = "0x%08x" % line[0]
-            if(addr in self.gshell.core.bp_index.bpts.keys()):
-                liststore.append([addr, line[1], "red"])
-            elif(int(addr, 16) == self.gshell.functions.regs.calculate()["eip"]):
-                liststore.append([addr, line[1], "blue"])
+            if(line[0] in self.gshell.core.bp_index):
+                rows.append([addr, line[1], "red"])
+            elif(line[0] == eip):
+                rows.append([addr, line[1], "blue"])
             else:
-                liststore.append([addr, line[1], "white"])
+                rows.append([addr, line[1], "white"])
+        return rows
 
-        return liststore
+    def get_model(self):
+        self.liststore = gtk.ListStore(str, str, str)
+        self.rows = []
+        return self.liststore
 
 class ProcessView(object):
     def __init__(self, gshell):
@@ -731,83 +932,85 @@ class ProcessView(object):
         self.view.connect_object("button_press_event", self.button_pressed, self.menu)
         self.window.add(self.view)
         self.window.show_all()
+        self.refresh()
 
-
-    def reload_kernel_symbols(self, widget, data):
+    def selected(self):
+        """Returns the _EPROCESS offsets of the selected rows"""
         selection = self.view.get_selection()
         (model, pathlist) = selection.get_selected_rows()
-        for path in pathlist :
-            tree_iter = model.get_iter(path)
-            value = model.get_value(tree_iter,1)
-            process = self.gshell.core.functions.get_EPROCESS(int(value, 16))
-            self.gshell.core.current_EPROCESS = process
+        return [int(model.get_value(model.get_iter(path), 1), 16) for path in pathlist]
+
+    def select_EPROCESS(self, offset):
+        process = self.gshell.core.functions.get_EPROCESS(offset)
+        self.gshell.core.current_EPROCESS = process
+        return process
 
-            process_name = self.gshell.functions.get_process_name(process)
-            self.gshell.core.functions.reload_kernel_symbols()
-            self.gshell.log("Applied symbols from kernel")
+
+    def reload_kernel_symbols(self, widget, data):
+        for offset in self.selected():
+            def reload(offset = offset):
+                self.select_EPROCESS(offset)
+                self.gshell.core.functions.reload_kernel_symbols()
+                self.gshell.log("Applied symbols from kernel")
+                self.gshell.frame.invalidate()
+            self.gshell.run(reload)
 
             # refresh code
+            self.gshell.refetch()
             for c in self.gshell.cs:
                 c.refresh_no_reset()
 
     def reload_process_symbols(self, widget, data):
-        selection = self.view.get_selection()
-        (model, pathlist) = selection.get_selected_rows()
-        for path in pathlist :
-            tree_iter = model.get_iter(path)
-            value = model.get_value(tree_iter,1)
-            process = self.gshell.core.functions.get_EPROCESS(int(value, 16))
-            self.gshell.core.current_EPROCESS = process
-
-            process_name = self.gshell.functions.get_process_name(process)
-            self.gshell.core.functions.reload_target_symbols(process.v())
-            self.gshell.log("Applied symbols from: %s" % process_name)
+        for offset in self.selected():
+            def reload(offset = offset):
+                process = self.select_EPROCESS(offset)
+                process_name = self.gshell.functions.get_process_name(process)
+                self.gshell.core.functions.reload_target_symbols(process.v())
+                self.gshell.log("Applied symbols from: %s" % process_name)
+                self.gshell.frame.invalidate()
+            self.gshell.run(reload)
 
             # refresh code
+            self.gshell.refetch()
             for c in self.gshell.cs:
                 c.refresh_no_reset()
 
-    def ep_goto(self, widget, data):
-        selection = self.view.get_selection()
-        (model, pathlist) = selection.get_selected_rows()
-        for path in pathlist :
-            tree_iter = model.get_iter(path)
-            value = model.get_value(tree_iter,1)
-            process = self.gshell.core.functions.get_EPROCESS(int(value, 16))
-            self.gshell.core.current_EPROCESS = process
-
-            image_base = self.gshell.core.functions.e2ib.calculate(process.v())
-            ep = self.gshell.core.functions.ib2epo.calculate(image_base)
+    def entry_point(self, offset):
+        process = self.select_EPROCESS(offset)
+        image_base = self.gshell.core.functions.e2ib.calculate(process.v())
+        ep = self.gshell.core.functions.ib2epo.calculate(image_base)
+        return process, ep
 
-            process_name = self.gshell.functions.get_process_name(process)
-            self.gshell.log("Going to: %s:0x%08x" % (process_name, ep))
-            code_view = self.gshell.cs[0]
-            code_view.offset = ep
-            code_view.refresh_no_reset()
+    def ep_goto(self, widget, data):
+        for offset in self.selected():
+            def goto(result):
+                process_name, ep = result
+                self.gshell.log("Going to: %s:0x%08x" % (process_name, ep))
+                code_view = self.gshell.cs[0]
+                code_view.offset = ep
+                code_view.refresh_no_reset()
+
+            def find(offset = offset):
+                process, ep = self.entry_point(offset)
+                return str(self.gshell.functions.get_process_name(process)), ep
+            self.gshell.run(find, goto)
 
     def ep_bp(self, widget, data):
-        selection = self.view.get_selection()
-        (model, pathlist) = selection.get_selected_rows()
-        for path in pathlist :
-            tree_iter = model.get_iter(path)
-            value = model.get_value(tree_iter,1)
-            process = self.gshell.core.functions.get_EPROCESS(int(value, 16))
-            self.gshell.core.current_EPROCESS = process
-
-            image_base = self.gshell.core.functions.e2ib.calculate(process.v())
-            ep = self.gshell.core.functions.ib2epo.calculate(image_base)
-
-            process_name = self.gshell.functions.get_process_name(process)
-            self.gshell.log("Inserted breakpoint at %s:0x%08x" % (process_name, ep))
-            self.gshell.core.functions.b.calculate(location = ep, eproc = process)
+        for offset in self.selected():
+            def insert(offset = offset):
+                process, ep = self.entry_point(offset)
+                process_name = self.gshell.functions.get_process_name(process)
+                self.gshell.log("Inserted breakpoint at %s:0x%08x" % (process_name, ep))
+                self.gshell.core.functions.b.calculate(location = ep, eproc = process)
+            self.gshell.run(insert)
 
     def symbol_system_wide_breakpoint(self, widget, data):
         self.gshell.log("Inserted breakpoint at: all:0x%08x" % data)
-        self.gshell.core.functions.swb.calculate(location = data)
+        self.gshell.run(lambda: self.gshell.core.functions.swb.calculate(location = data))
 
     def symbol_breakpoint(self, widget, data):
         self.gshell.log("Inserted breakpoint at: 0x%08x:0x%08x" % (self.gshell.core.current_EPROCESS.v() , data))
-        self.gshell.core.functions.b.calculate(location = data, eproc = self.gshell.core.current_EPROCESS)
+        self.gshell.run(lambda: self.gshell.core.functions.b.calculate(location = data, eproc = self.gshell.core.current_EPROCESS))
 
     def symbol_goto(self, widget, data):
         if(len(self.gshell.cs) < 1):
@@ -822,11 +1025,14 @@ class ProcessView(object):
     def trigger_symbols_reload(self, widget, data):
         module_name, module_menu = data
         self.activate_set_EPROCESS(widget, data)
-        self.gshell.core.functions.reload_module_symbols.calculate(module_name)
 
-        self.gshell.log("Symbols reloaded: %s" % module_name)
+        def reload():
+            self.gshell.core.functions.reload_module_symbols.calculate(module_name)
+            return self.gshell.core.current_symbols[module_name]
+        self.gshell.run(reload, lambda symbols: self.show_symbols(module_name, module_menu, symbols))
 
-        symbols = self.gshell.core.current_symbols[module_name]
+    def show_symbols(self, module_name, module_menu, symbols):
+        self.gshell.log("Symbols reloaded: %s" % module_name)
 
         for pos in module_menu.get_children():
             module_menu.remove(pos)
@@ -861,11 +1067,16 @@ class ProcessView(object):
 
     def trigger_modules_reload(self, widget, data):
         self.activate_set_EPROCESS(widget, data)
-        self.gshell.core.functions.reload_current_modules.calculate()
+
+        def reload():
+            self.gshell.core.functions.reload_current_modules.calculate()
+            return self.gshell.core.current_modules
+        self.gshell.run(reload, self.show_modules)
+
+    def show_modules(self, modules):
         self.gshell.log("Modules reloaded")
 
         symbols_menu = self.symbols_menu
-        modules = self.gshell.core.current_modules
 
         for pos in symbols_menu.get_children():
             symbols_menu.remove(pos)
@@ -889,33 +1100,34 @@ class ProcessView(object):
             menu_item.show()
 
     def activate_set_EPROCESS(self, widget, data):
-        selection = self.view.get_selection()
-        (model, pathlist) = selection.get_selected_rows()
-        for path in pathlist :
-            tree_iter = model.get_iter(path)
-            value = model.get_value(tree_iter,1)
-            self.gshell.core.current_EPROCESS = self.gshell.core.functions.get_EPROCESS(int(value, 16))
-            self.gshell.log("Current EPROCESS: 0x%x\n" % self.gshell.core.current_EPROCESS.v())
+        for offset in self.selected():
+            def select(offset = offset):
+                self.select_EPROCESS(offset)
+                self.gshell.log("Current EPROCESS: 0x%x\n" % self.gshell.core.current_EPROCESS.v())
+            self.gshell.run(select)
         self.gshell.refresh()
 
     def refresh(self):
-        self.view.set_model(self.get_model())
+        self.gshell.run(self.get_rows, self.show, key = ("view", id(self)))
 
-    def get_model(self):
-        liststore = gtk.ListStore(str, str, str)
-
-#        self.gshell.current_context = self.gshell.functions.update_context.calculate()
+    def show(self, rows):
+        update_store(self.liststore, self.rows, rows)
+        self.rows = rows
 
-        for proc in self.gshell.functions.get_process_list.calculate():
+    def get_rows(self):
+        rows = []
+        current = self.gshell.core.current_EPROCESS.v()
+        for name, offset in self.gshell.frame.processes():
             color = "white"
-            if(self.gshell.core.current_EPROCESS == proc.v()):
-                color = "green"
-#                liststore.append([self.gshell.functions.get_process_name(proc), "%08x" % proc.v(), "green"])
-            if(self.gshell.core.current_EPROCESS == proc.v()):
-#                liststore.append([self.gshell.functions.get_process_name(proc), "%08x" % proc.v(), "blue"])
+            if(current == offset):
                 color = "blue"
-            liststore.append(["%s" % self.gshell.functions.get_process_name(proc), "%08x" % proc.v(), color])
-        return liststore
+            rows.append([name, "%08x" % offset, color])
+        return rows
+
+    def get_model(self):
+        self.liststore = gtk.ListStore(str, str, str)
+        self.rows = []
+        return self.liststore
 
     def button_pressed(self, widget, event):
         if(event.button == 3):
@@ -1115,9 +1327,22 @@ class GtkConsole(tprobe.AbstractTProbePlugin):
 #        self.bp_index = BptIndex()
 
     def log(self, text):
+        # Also called from the worker, the text view belongs to the GTK thread
+        GLib.idle_add(self._log, text)
+
+    def _log(self, text):
         if(len(self.hs) > 0):
             txtBuf = self.hs[0].textBuffer
             txtBuf.insert(txtBuf.get_end_iter(), text+"\n")
+        return False
+
+    def run(self, func, callback = None, key = None):
+        """Runs func on the worker thread and callback(result) back on the GTK thread"""
+        self.worker.post(func, callback, key)
+
+    def refetch(self):
+        """Queues a refresh of the frame model, ahead of the view updates queued after it"""
+        self.run(self.frame.refresh, key = "frame")
 
     def calculate(self, core = None):
 #        self.addrspace = self.core.addrspace
@@ -1128,6 +1353,7 @@ class GtkConsole(tprobe.AbstractTProbePlugin):
 
     def refresh(self, component=None, category=None):
         #self.core.functions.uce.calculate()
+        self.refetch()
         if(component != None):
             component.refresh()
         if(category != None):
@@ -1144,6 +1370,9 @@ class GtkConsole(tprobe.AbstractTProbePlugin):
         self.home_path = self.core.config.opts['home_path']
 
         self.core.gshell = self
+        self.frame = FrameModel(self)
+        self.frame.refresh()
+        self.worker = TargetWorker()
 
         mb = MemoryView(self)
         md = MemoryDwordView(self)
@@ -1166,7 +1395,13 @@ class GtkConsole(tprobe.AbstractTProbePlugin):
         
         self.m = Main(self)
 
-#        Thread(target = gtk.main).start()
+        # gdb stays parked in this command while the GTK main loop runs,
+        # so the worker is the only thread using gdb meanwhile
+        worker = Thread(target = self.worker.run)
+        worker.daemon = True
+        worker.start()
         gtk.main()
+        self.worker.stop()
+        worker.join()
 
         return False
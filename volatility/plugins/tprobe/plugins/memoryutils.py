@@ -78,7 +78,12 @@ class DescribeObjectType(tprobe.AbstractTProbePlugin):
 		profile = (address_space or EPROCESS.obj_vm).profile
 
 		if address is not None:
-			objct = obj.Object(objct, address, address_space or EPROCESS.get_process_address_space())
+			# Read the whole struct at once instead of member by member
+			objct = obj.Object(objct, address, address_space or EPROCESS.get_process_address_space(), snapshot = True)
+		elif isinstance(objct, obj.CType):
+			# Print from a copy, the caller's object keeps reading memory
+			objct = obj.Object(objct.obj_type, objct.obj_offset, objct.obj_vm,
+				native_vm = objct.obj_native_vm, snapshot = True)
 		if return_object is True:
 			return objct
 
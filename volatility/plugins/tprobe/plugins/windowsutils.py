@@ -121,21 +121,67 @@ class GetWindowsEPROCESSByName(tprobe.AbstractTProbeApiFunction):
             return offset
 
 class GetWindowsEPROCESSByDTB(tprobe.AbstractTProbeApiFunction):
+    """ Finds the _EPROCESS of a DTB through an index of the process list.
+
+    uce asks for the process of cr3 after every step, so rather than
+    walking the process list each time, the DTB of every process is
+    indexed in one walk. The index is rebuilt when the links of the list
+    head change (a process was created or the first or last one exited),
+    when a DTB is not found, or when the process found no longer has that
+    DTB. Breakpoints on process creation can also call refresh().
+    """
     name = 'get_EPROCESS_by_dtb'
     dependencies = ['offset_to_EPROCESS','get_process_list','get_process_name', 'get_process_id', 'get_process_parent_id']
 
+    def __init__(self, *args, **kwargs):
+        tprobe.AbstractTProbeApiFunction.__init__(self, *args, **kwargs)
+        self.index = None
+        self.misses = set()
+        self.list_head = None
+        self.links = None
+
+    def read_links(self):
+        """Returns the raw Flink and Blink of the process list head"""
+        return self.core.addrspace.read(self.list_head.obj_offset, self.list_head.size())
+
+    def refresh(self):
+        """Rebuilds the index with a walk of the process list"""
+        kdbg = win32.tasks.get_kdbg(self.core.addrspace)
+        self.list_head = kdbg.PsActiveProcessHead.dereference()
+        self.links = self.read_links()
+        self.misses = set()
+        self.index = {}
+        with self.core.addrspace.read_session():
+            for process in kdbg.processes():
+                # The first process with a DTB wins, like the list walk did
+                self.index.setdefault(process.Pcb.DirectoryTableBase.v(), process.obj_offset)
+
+    def lookup(self, dtb):
+        """Returns the _EPROCESS offset of dtb, or None"""
+        if self.index is None or self.read_links() != self.links:
+            self.refresh()
+
+        offset = self.index.get(dtb)
+        if offset is not None:
+            process = obj.Object("_EPROCESS", offset = offset, vm = self.core.addrspace)
+            if process.Pcb.DirectoryTableBase.v() == dtb:
+                return offset
+        elif dtb in self.misses:
+            # Nothing was created since we last looked for it
+            return None
+
+        self.refresh()
+        offset = self.index.get(dtb)
+        if offset is None:
+            self.misses.add(dtb)
+        return offset
+
     def calculate(self, dtb):
-    	functions = self.functions
-        offsets = []
-        for process in functions.get_process_list(): #previously was _id, this was a mistake?
-            if dtb == process.Pcb.DirectoryTableBase.v():
-                offsets.append(process)
-        if not offsets:
-#            print "Unable to find process matching name {0}".format(name)
-            return self.calculate(name="System")
-        else:
-            offset = offsets[0].v()
-            return offset
+        offset = self.lookup(dtb)
+        if offset is None:
+            # No process owns it, fall back to the System process
+            return self.functions.get_EPROCESS_by_name("System")
+        return offset
 
 class GetWindowsEPROCESS(tprobe.AbstractTProbeApiFunction):
     name = 'get_EPROCESS'
@@ -0,0 +1,555 @@
+# Volatility
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+
+""" Symbol tables built from module exports.
+
+Parsing the exports of every module of a process takes a while on a live
+target, and usually only a handful of modules are ever looked at. A
+SymbolTable only records where each module lives when it is built; the
+exports of a module are parsed the first time one of its names or
+addresses is looked up.
+
+The tables are used through two dict like views, by_name ("module!name"
+to address) and by_offset (address to "module!name"), so they can stand
+in for the plain dicts the tprobe core keeps.
+
+A SymbolStore keeps the exports of modules on disk, by RVA, so a module
+seen before is not parsed again but read back and rebased to wherever
+it is loaded now. Only modules whose exports could all be read are
+stored, one with paged out parts is parsed again until it is complete.
+Symbols which belong to no module (added by hand or restored from an
+old pickle) are stored as they are, by address.
+"""
+
+import bisect
+import collections
+import sqlite3
+import threading
+
+class SymbolStore(object):
+    """ Module exports cached in an sqlite database.
+
+    Modules are identified by their name and the TimeDateStamp,
+    SizeOfImage and CheckSum of their PE header, and their exports are
+    kept as RVAs. The same DLL is thus only parsed once, whatever base
+    it is loaded at in each process, across sessions and reboots.
+
+    Modules are loaded lazily from whichever thread looks a symbol up
+    (eg. the gshell target worker), so the connection is shared between
+    threads and every use of it is serialized by a lock.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS modules (
+            id INTEGER PRIMARY KEY,
+            name TEXT, timestamp INTEGER, size INTEGER, checksum INTEGER,
+            UNIQUE (name, timestamp, size, checksum));
+        CREATE TABLE IF NOT EXISTS exports (
+            module INTEGER, name TEXT, rva INTEGER);
+        CREATE INDEX IF NOT EXISTS exports_module ON exports (module);
+        CREATE TABLE IF NOT EXISTS symbols (
+            space TEXT, name TEXT, address INTEGER,
+            UNIQUE (space, name));
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        # Export names are byte strings, not necessarily valid UTF-8
+        self.db.text_factory = str
+        self.db.executescript(self.schema)
+
+    @staticmethod
+    def is_store(path):
+        """Tells whether path is a symbol database"""
+        try:
+            with open(path, "rb") as f:
+                return f.read(16) == "SQLite format 3\x00"
+        except IOError:
+            return False
+
+    def _module_id(self, identity):
+        row = self.db.execute("SELECT id FROM modules WHERE name = ? AND timestamp = ? "
+                              "AND size = ? AND checksum = ?", identity).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def __contains__(self, identity):
+        with self.lock:
+            return self._module_id(identity) is not None
+
+    def get(self, identity):
+        """Returns a dict of export names to RVAs, or None if unknown"""
+        with self.lock:
+            module_id = self._module_id(identity)
+            if module_id is None:
+                return None
+            return dict(self.db.execute("SELECT name, rva FROM exports WHERE module = ?", (module_id,)))
+
+    def put(self, identity, rvas):
+        """Stores the dict of export names to RVAs of a module"""
+        with self.lock, self.db:
+            module_id = self._module_id(identity)
+            if module_id is not None:
+                self.db.execute("DELETE FROM exports WHERE module = ?", (module_id,))
+                self.db.execute("DELETE FROM modules WHERE id = ?", (module_id,))
+            module_id = self.db.execute("INSERT INTO modules (name, timestamp, size, checksum) "
+                                        "VALUES (?, ?, ?, ?)", identity).lastrowid
+            self.db.executemany("INSERT INTO exports (module, name, rva) VALUES (?, ?, ?)",
+                                ((module_id, name, rva) for name, rva in rvas.iteritems()))
+
+    def get_symbols(self, space):
+        """Returns a dict of the names to addresses of the symbols kept for space"""
+        with self.lock:
+            return dict(self.db.execute("SELECT name, address FROM symbols WHERE space = ?", (space,)))
+
+    def put_symbols(self, space, symbols):
+        """Replaces the symbols kept for space (eg. "kernel") by a dict of names to addresses"""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM symbols WHERE space = ?", (space,))
+            self.db.executemany("INSERT INTO symbols (space, name, address) VALUES (?, ?, ?)",
+                                ((space, name, address) for name, address in symbols.iteritems()))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class ModuleSymbols(object):
+    """ The exports of a single module, parsed on first use """
+
+    def __init__(self, module, store = None):
+        self.module = module
+        self.store = store
+        self.name = str(module.BaseDllName or '')
+        self.base = int(module.DllBase)
+        self.size = int(module.SizeOfImage)
+        self._exports = None
+        self.complete = False
+
+    def contains(self, address):
+        return self.base <= address < self.base + self.size
+
+    def identity(self):
+        """ Returns the key of the module in a SymbolStore.
+
+            This is (name, TimeDateStamp, SizeOfImage, CheckSum), or None
+            if the PE header can not be read.
+        """
+        nt_header = self.module._nt_header()
+        if not nt_header:
+            return None
+        timestamp = nt_header.FileHeader.TimeDateStamp.v()
+        checksum = nt_header.OptionalHeader.CheckSum.v()
+        if timestamp == None or checksum == None:
+            return None
+        return self.name.lower(), int(timestamp), self.size, int(checksum)
+
+    def parse(self):
+        """ Reads the exports from the module.
+
+            Returns a dict of the bare export names to their RVAs, and
+            whether every export with a name could be read (rather than
+            being skipped because part of the export table is paged).
+        """
+        rvas = {}
+        named = 0
+        for _ordinal, func_rva, name in self.module.export_symbols():
+            if name:
+                named += 1
+            # Skip forwarded exports and exports without a (readable) name
+            if func_rva is None or not name:
+                continue
+            rvas[name] = func_rva
+        return rvas, named == self.module.export_name_count()
+
+    def rvas(self):
+        """Returns a dict of the bare export names to their RVAs"""
+        if self._exports is not None:
+            return dict((name, address - self.base) for name, address in self._exports.iteritems())
+        return self.parse()[0]
+
+    def save(self, store):
+        """ Writes the exports to store unless it already has them.
+
+            Exports which were incomplete when first read are parsed
+            again. Returns False if they are still incomplete, and thus
+            were not stored.
+        """
+        identity = self.identity()
+        if identity is None or identity in store:
+            return True
+        if self._exports is not None and self.complete:
+            rvas, complete = self.rvas(), True
+        else:
+            rvas, complete = self.parse()
+        if complete:
+            store.put(identity, rvas)
+        return complete
+
+    def exports(self):
+        """Returns a dict of the bare export names to their addresses"""
+        if self._exports is None:
+            rvas = None
+            identity = None
+            if self.store is not None:
+                identity = self.identity()
+                if identity is not None:
+                    rvas = self.store.get(identity)
+            if rvas is None:
+                rvas, self.complete = self.parse()
+                if identity is not None and self.complete:
+                    self.store.put(identity, rvas)
+            else:
+                self.complete = True
+            self._exports = dict((name, self.base + rva) for name, rva in rvas.iteritems())
+        return self._exports
+
+    def symbols(self):
+        """Yields ("module!name", address) for every export"""
+        for name, address in self.exports().iteritems():
+            yield "{0}!{1}".format(self.name, name), address
+
+class SymbolIndex(object):
+    """ Address and substring lookups over a set of symbols.
+
+    The addresses are kept sorted so the symbol nearest below an address
+    is found with a bisection. Substring searches go through an index of
+    the trigrams of every name, only names holding all the trigrams of
+    the searched text are actually compared.
+    """
+
+    gram = 3
+
+    def __init__(self):
+        self.addresses = []
+        self.names = []
+        self.grams = {}
+
+    def _grams(self, text):
+        return set(text[i:i + self.gram] for i in range(len(text) - self.gram + 1))
+
+    def add(self, symbols):
+        """Inserts a batch of (name, address) symbols"""
+        symbols = list(symbols)
+        if not symbols:
+            return
+
+        # Timsort merges the two sorted runs in linear time
+        entries = zip(self.addresses, self.names)
+        entries.extend((address, name) for name, address in symbols)
+        entries.sort()
+        self.addresses = [address for address, _name in entries]
+        self.names = [name for _address, name in entries]
+
+        for name, _address in symbols:
+            for gram in self._grams(name):
+                self.grams.setdefault(gram, set()).add(name)
+
+    def remove(self, names):
+        """Drops all the symbols with the given names"""
+        names = set(names)
+        if not names:
+            return
+
+        entries = [(address, name) for address, name in zip(self.addresses, self.names) if name not in names]
+        self.addresses = [address for address, _name in entries]
+        self.names = [name for _address, name in entries]
+
+        for name in names:
+            for gram in self._grams(name):
+                holders = self.grams.get(gram)
+                if holders is not None:
+                    holders.discard(name)
+                    if not holders:
+                        del self.grams[gram]
+
+    def nearest(self, address):
+        """Returns (name, address) of the closest symbol at or below address"""
+        i = bisect.bisect_right(self.addresses, address) - 1
+        if i < 0:
+            return None
+        return self.names[i], self.addresses[i]
+
+    def search(self, text):
+        """Returns the sorted names containing text"""
+        grams = self._grams(text)
+        if not grams:
+            return sorted(set(name for name in self.names if text in name))
+
+        candidates = None
+        for holders in sorted((self.grams.get(gram, set()) for gram in grams), key = len):
+            if candidates is None:
+                candidates = set(holders)
+            else:
+                candidates &= holders
+            if not candidates:
+                return []
+        return sorted(name for name in candidates if text in name)
+
+class SymbolTable(object):
+    """ Name and address lookups over a set of lazily parsed modules """
+
+    def __init__(self, modules = (), store = None):
+        self.store = store
+        self.modules = []
+        self.modules_by_name = {}
+        self.module_ranges = []
+        self.loaded = set()
+        self.names = {}
+        # The symbols not read from a module
+        self.added = {}
+        self.offsets = {}
+        self.index = SymbolIndex()
+        self.by_name = SymbolsByName(self)
+        self.by_offset = SymbolsByOffset(self)
+        for module in modules:
+            self.add_module(module)
+
+    def add_module(self, module):
+        """Registers a module (a ModuleSymbols or an _LDR_DATA_TABLE_ENTRY)"""
+        if not isinstance(module, ModuleSymbols):
+            module = ModuleSymbols(module, self.store)
+        if module not in self.modules:
+            self.modules.append(module)
+            self.modules_by_name.setdefault(module.name, module)
+            bisect.insort(self.module_ranges, (module.base, module.size, len(self.modules), module))
+        return module
+
+    def remove_module(self, module):
+        """Drops a module (eg. once it is unloaded) and its symbols"""
+        if module not in self.modules:
+            return
+        self.modules.remove(module)
+        self.module_ranges = [entry for entry in self.module_ranges if entry[3] is not module]
+        if self.modules_by_name.get(module.name) is module:
+            del self.modules_by_name[module.name]
+            for other in self.modules:
+                if other.name == module.name:
+                    self.modules_by_name[other.name] = other
+                    break
+        if module in self.loaded:
+            self.loaded.discard(module)
+            self.remove_symbols(name for name, _address in module.symbols())
+
+    def extend(self, other):
+        """Adds the modules and symbols of another table"""
+        if other is self:
+            return
+        for module in other.modules:
+            self.add_module(module)
+            if module in other.loaded:
+                self.load(module)
+        self.add_symbols(other.added.iteritems())
+
+    def load(self, *modules):
+        """ Parses the exports of modules which were not loaded yet.
+
+            A module only counts as loaded once all its exports were
+            read, one failing (or interrupted) halfway adds nothing and is
+            parsed again next time. The modules read before it are still
+            added.
+        """
+        parsed = []
+        try:
+            for module in modules:
+                if module in self.loaded or module in [done for done, _symbols in parsed]:
+                    continue
+                parsed.append((module, list(module.symbols())))
+        finally:
+            added = []
+            for module, module_symbols in parsed:
+                for name, address in module_symbols:
+                    if name not in self.names:
+                        self.names[name] = address
+                        added.append((name, address))
+                    self.offsets.setdefault(address, name)
+            self.index.add(added)
+            self.loaded.update(module for module, _symbols in parsed)
+
+    def load_all(self):
+        self.load(*self.modules)
+
+    def set_store(self, store):
+        """Makes the modules not parsed yet look their exports up in store"""
+        self.store = store
+        for module in self.modules:
+            module.store = store
+
+    def save(self, store):
+        """ Writes the exports of all the modules to store.
+
+            Returns the modules left out because their exports could not
+            all be read.
+        """
+        return [module for module in self.modules if not module.save(store)]
+
+    def add_symbols(self, symbols):
+        """Adds (name, address) symbols, replacing existing names"""
+        symbols = dict(symbols)
+        self.index.remove(name for name in symbols if name in self.names)
+        for name, address in symbols.iteritems():
+            self.names[name] = address
+            self.offsets[address] = name
+        self.added.update(symbols)
+        self.index.add(symbols.iteritems())
+
+    def remove_symbols(self, names):
+        names = [name for name in names if name in self.names]
+        for name in names:
+            address = self.names.pop(name)
+            self.added.pop(name, None)
+            if self.offsets.get(address) == name:
+                del self.offsets[address]
+        self.index.remove(names)
+
+    def module_for_name(self, name):
+        if not isinstance(name, basestring):
+            return None
+        return self.modules_by_name.get(name.partition('!')[0])
+
+    def module_for_offset(self, address):
+        i = bisect.bisect_right(self.module_ranges, (address, ())) - 1
+        if i >= 0:
+            module = self.module_ranges[i][3]
+            if module.contains(address):
+                return module
+        return None
+
+    def symbolize(self, address):
+        """ Returns "module!name+0x1a" for address, or None.
+
+            Addresses inside a known module are given relative to the
+            nearest export of that module, anything else only resolves
+            to a symbol at exactly that address.
+        """
+        module = self.module_for_offset(address)
+        if module is not None:
+            self.load(module)
+
+        found = self.index.nearest(address)
+        if found is None:
+            return None
+        name, start = found
+        if start == address:
+            return name
+        if module is None or start < module.base:
+            return None
+        return "{0}+{1:#x}".format(name, address - start)
+
+    def search(self, text):
+        """Returns the sorted names containing text"""
+        self.load_all()
+        return self.index.search(text)
+
+class SymbolsView(collections.MutableMapping):
+    """ A dict like view of a SymbolTable which loads modules on demand.
+
+    Lookups only load the module the key belongs to, anything enumerating
+    the whole view (keys, items, len) loads all of them.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def _mapping(self):
+        raise NotImplementedError
+
+    def _module_for(self, key):
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        mapping = self._mapping()
+        if key not in mapping:
+            module = self._module_for(key)
+            if module is not None:
+                self.table.load(module)
+        return mapping[key]
+
+    def _symbol(self, key, value):
+        """Returns the (name, address) symbol for a key and value"""
+        raise NotImplementedError
+
+    def __setitem__(self, key, value):
+        self.table.add_symbols([self._symbol(key, value)])
+
+    def __delitem__(self, key):
+        name, _address = self._symbol(key, self[key])
+        self.table.remove_symbols([name])
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def has_key(self, key):
+        return key in self
+
+    def __iter__(self):
+        self.table.load_all()
+        return iter(self._mapping().keys())
+
+    def __len__(self):
+        self.table.load_all()
+        return len(self._mapping())
+
+    def update(self, *args, **kwargs):
+        """Merges another view lazily, anything else in a single batch"""
+        if len(args) == 1 and not kwargs and isinstance(args[0], SymbolsView):
+            self.table.extend(args[0].table)
+        else:
+            items = dict(*args, **kwargs)
+            self.table.add_symbols(self._symbol(key, value) for key, value in items.iteritems())
+
+    def __reduce__(self):
+        # Pickle as a plain dict so stored symbols do not need the target
+        return (dict, (dict(self.items()),))
+
+class SymbolsByName(SymbolsView):
+    """ "module!name" to address """
+
+    def _mapping(self):
+        return self.table.names
+
+    def _module_for(self, key):
+        return self.table.module_for_name(key)
+
+    def _symbol(self, key, value):
+        return key, value
+
+    def search(self, text):
+        """Returns the sorted names containing text"""
+        return self.table.search(text)
+
+class SymbolsByOffset(SymbolsView):
+    """ address to "module!name" """
+
+    def _mapping(self):
+        return self.table.offsets
+
+    def _module_for(self, key):
+        return self.table.module_for_offset(key)
+
+    def _symbol(self, key, value):
+        return value, key
+
+    def symbolize(self, address):
+        """Returns "module!name+0x1a" for address, or None"""
+        return self.table.symbolize(address)
@@ -0,0 +1,219 @@
+# Volatility
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+
+""" Compact execution traces.
+
+A trace holds one record per stop of the target: the address it stopped
+at and the registers which changed since the previous stop. Records are
+packed as varints, the address and register values as zigzag encoded
+deltas from the previous record, so a stop usually takes a few bytes.
+
+Records are kept in chunks. Every chunk starts again from an address and
+registers of zero, so each one can be decoded on its own. A TraceBuffer
+keeps the most recent chunks in memory up to a byte budget, dropping the
+oldest ones, and optionally streams every finished chunk to a file.
+
+A trace file is made of
+
+    magic, varint dtb, varint register count, the register names
+    (each as a varint length and the name), then the chunks, each as
+    a varint record count, a varint byte length and the records.
+"""
+
+import collections
+
+magic = "TPTRACE\x01"
+
+## The registers recorded with every stop
+registers = ["eax", "ebx", "ecx", "edx", "esi", "edi", "ebp", "esp", "eflags"]
+
+def encode_varint(out, value):
+    """Appends the unsigned value to the bytearray out"""
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varint(data, pos):
+    """Returns (value, pos after it) for the varint at data[pos]"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def zigzag(value):
+    if value < 0:
+        return (-value << 1) - 1
+    return value << 1
+
+def unzigzag(value):
+    if value & 1:
+        return -((value + 1) >> 1)
+    return value >> 1
+
+def decode_chunk(data, names):
+    """Yields (address, changed) for every record of a chunk.
+
+    changed maps the name of each register which changed at that stop
+    to its new value.
+    """
+    data = bytearray(data)
+    address = 0
+    values = [0] * len(names)
+    pos = 0
+    while pos < len(data):
+        delta, pos = decode_varint(data, pos)
+        address += unzigzag(delta)
+        mask, pos = decode_varint(data, pos)
+        changed = {}
+        i = 0
+        while mask:
+            if mask & 1:
+                delta, pos = decode_varint(data, pos)
+                values[i] += unzigzag(delta)
+                changed[names[i]] = values[i]
+            mask >>= 1
+            i += 1
+        yield address, changed
+
+class TraceBuffer(object):
+    """ A memory bounded ring of trace chunks.
+
+    record() packs each stop into the current chunk. Once a chunk grows
+    past chunk_size it is sealed, written to the stream (if any) and
+    kept in memory while the chunks stay within budget bytes.
+    """
+    def __init__(self, names = registers, budget = 0x100000, chunk_size = 0x10000, stream = None, dtb = 0):
+        self.names = list(names)
+        self.budget = budget
+        self.chunk_size = chunk_size
+        self.stream = stream
+        self.chunks = collections.deque()
+        self.size = 0
+        self.count = 0
+        self.dropped = 0
+        self._start_chunk()
+        if stream is not None:
+            self._write_header(dtb)
+
+    def _write_header(self, dtb):
+        header = bytearray(magic)
+        encode_varint(header, dtb)
+        encode_varint(header, len(self.names))
+        for name in self.names:
+            encode_varint(header, len(name))
+            header.extend(name)
+        self.stream.write(str(header))
+
+    def _start_chunk(self):
+        self.current = bytearray()
+        self.current_count = 0
+        self.address = 0
+        self.values = [0] * len(self.names)
+
+    def record(self, address, regs):
+        """Records a stop at address, regs maps register names to values"""
+        out = self.current
+        encode_varint(out, zigzag(address - self.address))
+        self.address = address
+
+        mask = 0
+        deltas = bytearray()
+        for i, name in enumerate(self.names):
+            value = regs[name]
+            if value != self.values[i]:
+                mask |= 1 << i
+                encode_varint(deltas, zigzag(value - self.values[i]))
+                self.values[i] = value
+        encode_varint(out, mask)
+        out.extend(deltas)
+
+        self.current_count += 1
+        self.count += 1
+        if len(out) >= self.chunk_size:
+            self.seal()
+
+    def seal(self):
+        """Finishes the current chunk and starts a new one"""
+        if not self.current_count:
+            return
+        chunk = (self.current_count, str(self.current))
+        if self.stream is not None:
+            out = bytearray()
+            encode_varint(out, chunk[0])
+            encode_varint(out, len(chunk[1]))
+            self.stream.write(str(out))
+            self.stream.write(chunk[1])
+
+        self.chunks.append(chunk)
+        self.size += len(chunk[1])
+        while self.size > self.budget and len(self.chunks) > 1:
+            count, data = self.chunks.popleft()
+            self.size -= len(data)
+            self.dropped += count
+        self._start_chunk()
+
+    def close(self):
+        self.seal()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def records(self):
+        """Yields (address, changed) for the records still in memory"""
+        for _count, data in self.chunks:
+            for record in decode_chunk(data, self.names):
+                yield record
+        for record in decode_chunk(self.current, self.names):
+            yield record
+
+class TraceReader(object):
+    """ Reads back a trace file written by a TraceBuffer """
+    def __init__(self, path):
+        self.path = path
+        f = open(path, "rb")
+        try:
+            self.data = bytearray(f.read())
+        finally:
+            f.close()
+
+        if str(self.data[:len(magic)]) != magic:
+            raise ValueError("{0} is not a trace file".format(path))
+        pos = len(magic)
+        self.dtb, pos = decode_varint(self.data, pos)
+        count, pos = decode_varint(self.data, pos)
+        self.names = []
+        for _ in range(count):
+            length, pos = decode_varint(self.data, pos)
+            self.names.append(str(self.data[pos:pos + length]))
+            pos += length
+        self.start = pos
+
+    def records(self):
+        """Yields (address, changed) for every record of the file"""
+        pos = self.start
+        while pos < len(self.data):
+            _count, pos = decode_varint(self.data, pos)
+            length, pos = decode_varint(self.data, pos)
+            for record in decode_chunk(self.data[pos:pos + length], self.names):
+                yield record
+            pos += length